@@ -0,0 +1,85 @@
+"""add tracking indexes
+
+Revision ID: 5f0c2d9a7b41
+Revises: 4183de971218
+Create Date: 2026-10-16 10:12:44.518203
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "5f0c2d9a7b41"
+down_revision: Union[str, None] = "4183de971218"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Latest location of a session, and the locations of a session in a time window.
+    op.create_index(
+        "ix_van_location_session_id_created_at",
+        "van_location",
+        ["session_id", "created_at"],
+    )
+
+    # Latest session of every van.
+    op.create_index(
+        "ix_van_tracker_session_van_guid_created_at",
+        "van_tracker_session",
+        ["van_guid", "created_at"],
+    )
+    # Sessions that are still running, which are only a sliver of the table.
+    op.create_index(
+        "ix_van_tracker_session_alive",
+        "van_tracker_session",
+        ["van_guid", "created_at"],
+        postgresql_where=sa.text("dead = false"),
+    )
+
+    # Ridership by route over a date range. Lookups by session are already covered by
+    # the unique constraint on (session_id, datetime).
+    op.create_index(
+        "ix_ridership_analytics_route_id_datetime",
+        "ridership_analytics",
+        ["route_id", "datetime"],
+    )
+    op.create_index(
+        "ix_ridership_analytics_datetime", "ridership_analytics", ["datetime"]
+    )
+
+    # Stops of a route in order, and routes of a stop. Lookups by route alone are
+    # covered by the unique constraint on (route_id, stop_id).
+    op.create_index(
+        "ix_route_stops_route_id_position", "route_stops", ["route_id", "position"]
+    )
+    op.create_index("ix_route_stops_stop_id", "route_stops", ["stop_id"])
+
+    # Disables of an alert, and the cascades when a stop or route is deleted.
+    op.create_index(
+        "ix_stop_disables_alert_id_stop_id", "stop_disables", ["alert_id", "stop_id"]
+    )
+    op.create_index("ix_stop_disables_stop_id", "stop_disables", ["stop_id"])
+    op.create_index(
+        "ix_route_disables_alert_id_route_id",
+        "route_disables",
+        ["alert_id", "route_id"],
+    )
+    op.create_index("ix_route_disables_route_id", "route_disables", ["route_id"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_route_disables_route_id", "route_disables")
+    op.drop_index("ix_route_disables_alert_id_route_id", "route_disables")
+    op.drop_index("ix_stop_disables_stop_id", "stop_disables")
+    op.drop_index("ix_stop_disables_alert_id_stop_id", "stop_disables")
+    op.drop_index("ix_route_stops_stop_id", "route_stops")
+    op.drop_index("ix_route_stops_route_id_position", "route_stops")
+    op.drop_index("ix_ridership_analytics_datetime", "ridership_analytics")
+    op.drop_index("ix_ridership_analytics_route_id_datetime", "ridership_analytics")
+    op.drop_index("ix_van_tracker_session_alive", "van_tracker_session")
+    op.drop_index("ix_van_tracker_session_van_guid_created_at", "van_tracker_session")
+    op.drop_index("ix_van_location_session_id_created_at", "van_location")
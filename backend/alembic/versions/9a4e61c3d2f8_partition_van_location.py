@@ -0,0 +1,132 @@
+"""partition van_location
+
+Revision ID: 9a4e61c3d2f8
+Revises: 5f0c2d9a7b41
+Create Date: 2026-10-16 14:03:27.905116
+
+"""
+
+from datetime import datetime, timedelta, timezone
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "9a4e61c3d2f8"
+down_revision: Union[str, None] = "5f0c2d9a7b41"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Kept in sync with src/vantracking/retention.py at the time of writing.
+RETENTION_DAYS = 14
+PARTITIONS_AHEAD = 2
+
+
+def upgrade() -> None:
+    op.create_table(
+        "van_location_history",
+        sa.Column("id", sa.Integer, primary_key=True),
+        sa.Column(
+            "session_id",
+            sa.Integer,
+            sa.ForeignKey("van_tracker_session.id"),
+            nullable=False,
+        ),
+        sa.Column("bucket", sa.DateTime, nullable=False),
+        sa.Column("lat", sa.Float, nullable=False),
+        sa.Column("lon", sa.Float, nullable=False),
+        sa.Column("samples", sa.Integer, nullable=False),
+        sa.UniqueConstraint("session_id", "bucket"),
+    )
+
+    today = datetime.now(timezone.utc).replace(
+        tzinfo=None, hour=0, minute=0, second=0, microsecond=0
+    )
+    cutoff = today - timedelta(days=RETENTION_DAYS)
+
+    op.execute("ALTER TABLE van_location RENAME TO van_location_legacy")
+    op.execute(
+        "ALTER INDEX ix_van_location_session_id_created_at "
+        "RENAME TO ix_van_location_legacy_session_id_created_at"
+    )
+
+    # Everything past the retention period goes straight to the history table.
+    op.execute(
+        f"""
+        INSERT INTO van_location_history (session_id, bucket, lat, lon, samples)
+        SELECT session_id, date_trunc('minute', created_at), avg(lat), avg(lon), count(*)
+        FROM van_location_legacy
+        WHERE created_at < '{cutoff.isoformat()}'
+        GROUP BY 1, 2
+    """
+    )
+
+    # Partitioned tables need the partition key in their primary key.
+    op.execute(
+        """
+        CREATE TABLE van_location (
+            id integer NOT NULL DEFAULT nextval('van_location_id_seq'),
+            created_at timestamp without time zone NOT NULL DEFAULT now(),
+            session_id integer NOT NULL REFERENCES van_tracker_session (id),
+            lat double precision NOT NULL,
+            lon double precision NOT NULL,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    """
+    )
+    op.execute("ALTER SEQUENCE van_location_id_seq OWNED BY van_location.id")
+    op.create_index(
+        "ix_van_location_session_id_created_at",
+        "van_location",
+        ["session_id", "created_at"],
+    )
+    # Catches anything outside of the daily partitions, such as clock errors.
+    op.execute("CREATE TABLE van_location_default PARTITION OF van_location DEFAULT")
+    for day in range(-RETENTION_DAYS, PARTITIONS_AHEAD + 1):
+        start = today + timedelta(days=day)
+        end = start + timedelta(days=1)
+        op.execute(
+            f"CREATE TABLE van_location_p{start:%Y%m%d} PARTITION OF van_location "
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        )
+
+    op.execute(
+        f"""
+        INSERT INTO van_location (id, created_at, session_id, lat, lon)
+        SELECT id, created_at, session_id, lat, lon
+        FROM van_location_legacy
+        WHERE created_at >= '{cutoff.isoformat()}'
+    """
+    )
+    op.execute("DROP TABLE van_location_legacy")
+
+
+def downgrade() -> None:
+    # Rolled up history cannot be turned back into raw locations, so it is lost.
+    op.execute(
+        """
+        CREATE TABLE van_location_flat (
+            id integer NOT NULL DEFAULT nextval('van_location_id_seq') PRIMARY KEY,
+            created_at timestamp without time zone NOT NULL DEFAULT now(),
+            session_id integer NOT NULL REFERENCES van_tracker_session (id),
+            lat double precision NOT NULL,
+            lon double precision NOT NULL
+        )
+    """
+    )
+    op.execute(
+        """
+        INSERT INTO van_location_flat (id, created_at, session_id, lat, lon)
+        SELECT id, created_at, session_id, lat, lon FROM van_location
+    """
+    )
+    op.execute("ALTER SEQUENCE van_location_id_seq OWNED BY van_location_flat.id")
+    op.execute("DROP TABLE van_location CASCADE")
+    op.execute("ALTER TABLE van_location_flat RENAME TO van_location")
+    op.create_index(
+        "ix_van_location_session_id_created_at",
+        "van_location",
+        ["session_id", "created_at"],
+    )
+    op.drop_table("van_location_history")
@@ -0,0 +1,44 @@
+"""create van_trail table
+
+Revision ID: c71b0e5f8a23
+Revises: 9a4e61c3d2f8
+Create Date: 2026-10-16 16:41:09.226481
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "c71b0e5f8a23"
+down_revision: Union[str, None] = "9a4e61c3d2f8"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "van_trail",
+        sa.Column(
+            "session_id",
+            sa.Integer,
+            sa.ForeignKey("van_tracker_session.id"),
+            primary_key=True,
+        ),
+        sa.Column(
+            "created_at",
+            sa.DateTime,
+            nullable=False,
+            server_default=sa.func.now(),  # pylint: disable=all
+        ),
+        sa.Column("tolerance_m", sa.Float, nullable=False),
+        sa.Column("raw_count", sa.Integer, nullable=False),
+        sa.Column("point_count", sa.Integer, nullable=False),
+        sa.Column("points", sa.LargeBinary, nullable=False),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("van_trail")
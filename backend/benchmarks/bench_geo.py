@@ -0,0 +1,101 @@
+"""
+Microbenchmarks for the geo kernels, comparing the scalar distance in Python loops
+against the vectorized versions and the route index on routes of increasing size.
+
+Run from the backend folder with `python -m benchmarks.bench_geo`.
+"""
+
+import random
+import timeit
+from typing import Callable, List
+
+from src.vantracking.geo import StopArray, distance_matrix_meters, distance_meters
+from src.vantracking.ingest import initial_stop_index
+from src.vantracking.spatial import RouteIndex
+from src.vantracking.state import StopPoint
+
+STOP_COUNTS = [20, 200, 2000]
+VAN_COUNT = 20
+
+
+def random_stops(rng: random.Random, count: int) -> List[StopPoint]:
+    return [
+        StopPoint(i, 39.75 + rng.uniform(0, 0.02), -105.22 + rng.uniform(0, 0.02))
+        for i in range(count)
+    ]
+
+
+def scalar_initial_stop_index(stops: List[StopPoint], lat: float, lon: float) -> int:
+    stop_pairs = []
+    for i in range(len(stops) - 1):
+        left, right = stops[i], stops[i + 1]
+        l_distance = distance_meters(lat, lon, left.lat, left.lon)
+        r_distance = distance_meters(lat, lon, right.lat, right.lon)
+        stop_pairs.append((i, i + 1, l_distance, r_distance))
+    closest_stop_pair = min(stop_pairs, key=lambda x: min(x[2], x[3]))
+    if closest_stop_pair[2] >= closest_stop_pair[3]:
+        return closest_stop_pair[1]
+    return closest_stop_pair[0]
+
+
+def best_of(func: Callable[[], object]) -> float:
+    """
+    Returns the fastest time of a call in microseconds.
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=5, number=number)) / number * 1e6
+
+
+def report(name: str, scalar: Callable[[], object], vector: Callable[[], object]):
+    scalar_us = best_of(scalar)
+    vector_us = best_of(vector)
+    print(
+        f"  {name:<24}{scalar_us:>12.1f} us{vector_us:>12.1f} us"
+        f"{scalar_us / vector_us:>10.1f}x"
+    )
+
+
+def main() -> None:
+    rng = random.Random(0)
+    for count in STOP_COUNTS:
+        stops = random_stops(rng, count)
+        vans = random_stops(rng, VAN_COUNT)
+        points = StopArray(stops)
+        index = RouteIndex(stops)
+        van_points = StopArray(vans)
+        lat, lon = vans[0].lat, vans[0].lon
+
+        print(f"{f'{count} stops':<26}{'scalar':>15}{'vector':>15}{'speedup':>11}")
+        report(
+            "one to many",
+            lambda: [distance_meters(lat, lon, s.lat, s.lon) for s in stops],
+            lambda: points.distances_from(lat, lon),
+        )
+        report(
+            "initial stop",
+            lambda: scalar_initial_stop_index(stops, lat, lon),
+            lambda: initial_stop_index(index, lat, lon, -1),
+        )
+        report(
+            "route segments",
+            lambda: [
+                distance_meters(stops[i].lat, stops[i].lon, b.lat, b.lon)
+                for i, b in enumerate(stops[-1:] + stops[:-1])
+            ],
+            points.segment_lengths,
+        )
+        report(
+            f"{VAN_COUNT} vans to every stop",
+            lambda: [
+                [distance_meters(v.lat, v.lon, s.lat, s.lon) for s in stops]
+                for v in vans
+            ],
+            lambda: distance_matrix_meters(
+                van_points.lats, van_points.lons, points.lats, points.lons
+            ),
+        )
+
+
+if __name__ == "__main__":
+    main()
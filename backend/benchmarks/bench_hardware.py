@@ -0,0 +1,168 @@
+"""
+Compares the CPU time spent on every hardware request by the API, which runs it
+through CORS, the hardware exception middleware and FastAPI's routing and dependency
+resolution, against the hardware fast path under /hardware/.
+
+Requests are sent straight to the ASGI app of the backend, so no time goes to a
+server or a socket, and cover a location report, a report rejected with an error code
+and the list of routes. Only the CPU time of the event loop thread is counted, which
+is where the middleware and routing run, so the queries both paths hand to threads
+and the database writes of the ingest pipeline are left out.
+
+Run from the backend folder with `python -m benchmarks.bench_hardware`. The database
+is a temporary SQLite file.
+"""
+
+import argparse
+import asyncio
+import os
+import struct
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Callable, List, Tuple
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from src.db import Base
+from src.handlers.vans import accept_session
+from src.main import app
+from src.model.route import Route
+from src.vantracking.ingest import IngestPipeline
+from src.vantracking.state import FleetState
+
+ROUTE_COUNT = 4
+
+
+class FileDB:
+    """
+    Stands in for DBWrapper.
+    """
+
+    def __init__(self, url: str):
+        self.engine = create_engine(url, pool_size=15, max_overflow=5)
+
+    def session(self) -> Session:
+        return Session(self.engine)
+
+
+def seed(db: FileDB) -> None:
+    Base.metadata.create_all(db.engine)
+    with db.session() as session:
+        for route_id in range(1, ROUTE_COUNT + 1):
+            session.add(Route(id=route_id, name=f"Route {route_id}", color="#FF0000"))
+        session.commit()
+
+
+def location_body() -> bytes:
+    return struct.pack(
+        "<Qdd", int(datetime.now(timezone.utc).timestamp() * 1000), 39.75, -105.22
+    )
+
+
+async def call(method: str, path: str, body: bytes = b"") -> int:
+    """
+    Sends one request through the whole ASGI app, and returns the status code.
+    """
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [
+            (b"host", b"localhost"),
+            (b"content-type", b"application/octet-stream"),
+            (b"content-length", str(len(body)).encode()),
+        ],
+        "client": ("127.0.0.1", 50000),
+        "server": ("localhost", 8000),
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    status = 0
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        # Only reached once the response was sent, by middleware waiting for a
+        # disconnect.
+        await asyncio.Event().wait()
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    return status
+
+
+# Every case is a name and the method, path and body of a request to the API and to
+# the fast path.
+Case = Tuple[str, str, str, str, Callable[[], bytes]]
+CASES: List[Case] = [
+    ("location", "POST", "/vans/location/1", "/hardware/location/1", location_body),
+    ("error code", "POST", "/vans/location/2", "/hardware/location/2", location_body),
+    ("routes", "GET", "/routes/hardware", "/hardware/routes", lambda: b""),
+]
+
+
+async def measure(requests: int, method: str, path: str, body: Callable[[], bytes]):
+    """
+    Returns the CPU time spent per request, in microseconds. The ingest pipeline is
+    flushed between requests, so that no request is measured while it is busy.
+    """
+    elapsed = 0.0
+    for _ in range(requests):
+        request_body = body()
+        started = time.thread_time()
+        await call(method, path, request_body)
+        elapsed += time.thread_time() - started
+        await app.state.ingest.flush()
+    return elapsed / requests * 1e6
+
+
+async def run(requests: int) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        db = FileDB(f"sqlite:///{os.path.join(directory, 'bench.db')}")
+        seed(db)
+        app.state.db = db
+        app.state.fleet = FleetState()
+        with db.session() as session:
+            app.state.fleet.load(session)
+        app.state.ingest = IngestPipeline(db, app.state.fleet)
+        # Van 1 reports, while van 2 never began a session and is told to.
+        await accept_session(app.state, "1", struct.pack("<i", 1))
+
+        for name, method, api_path, fast_path, body in CASES:
+            # Warm up both paths, which also builds the middleware stack.
+            await measure(50, method, api_path, body)
+            await measure(50, method, fast_path, body)
+            api_us = await measure(requests, method, api_path, body)
+            fast_us = await measure(requests, method, fast_path, body)
+            print(
+                f"{name:<12}{api_us:>12.1f} us{fast_us:>12.1f} us"
+                f"{api_us / fast_us:>10.1f}x"
+            )
+
+        await app.state.ingest.close()
+        db.engine.dispose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--requests", type=int, default=2000, help="requests per path and case"
+    )
+    args = parser.parse_args()
+
+    print(f"{'':<12}{'API':>15}{'fast path':>15}{'speedup':>11}")
+    asyncio.run(run(args.requests))
+
+
+if __name__ == "__main__":
+    main()
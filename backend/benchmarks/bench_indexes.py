@@ -0,0 +1,322 @@
+"""
+Benchmarks the tracking queries against months of synthetic history, before and after
+the indexes added by the tracking indexes migration, and prints the plan of every
+query.
+
+Run from the backend folder with `python -m benchmarks.bench_indexes`. This uses
+DATABASE_URL when it is set, which should point to a scratch database since every
+table is dropped and recreated. Otherwise it falls back to an in-memory SQLite
+database.
+"""
+
+import argparse
+import os
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Tuple
+
+from sqlalchemy import Engine, Index, create_engine, insert, text
+from sqlalchemy.orm import Session
+from src.db import Base
+from src.model.alert import Alert
+from src.model.ridership_analytics import RidershipAnalytics
+from src.model.route import Route
+from src.model.route_disable import RouteDisable
+from src.model.route_stop import RouteStop
+from src.model.stop import Stop
+from src.model.stop_disable import StopDisable
+from src.model.van_location import VanLocation
+from src.model.van_tracker_session import VanTrackerSession
+
+ROUTE_COUNT = 4
+STOPS_PER_ROUTE = 12
+ALERT_COUNT = 200
+INSERT_CHUNK = 10000
+
+
+def tracking_indexes() -> List[Index]:
+    return [
+        index
+        for model in (
+            VanLocation,
+            VanTrackerSession,
+            RidershipAnalytics,
+            RouteStop,
+            StopDisable,
+            RouteDisable,
+        )
+        for index in model.__table__.indexes  # type: ignore[attr-defined]
+    ]
+
+
+def insert_chunked(session: Session, model, rows: List[dict]) -> None:
+    for start in range(0, len(rows), INSERT_CHUNK):
+        session.execute(insert(model), rows[start : start + INSERT_CHUNK])
+
+
+def seed(engine: Engine, days: int, vans: int, fixes: int, rng: random.Random):
+    """
+    Creates a network of routes and stops, and a session per van per day with its
+    locations and ridership.
+    """
+    now = datetime.now(timezone.utc)
+    with Session(engine) as session:
+        stop_count = ROUTE_COUNT * STOPS_PER_ROUTE
+        insert_chunked(
+            session,
+            Stop,
+            [
+                {
+                    "id": i + 1,
+                    "name": f"Stop {i + 1}",
+                    "lat": 39.75 + rng.uniform(0, 0.01),
+                    "lon": -105.22 + rng.uniform(0, 0.01),
+                    "active": True,
+                }
+                for i in range(stop_count)
+            ],
+        )
+        insert_chunked(
+            session,
+            Route,
+            [
+                {"id": i + 1, "name": f"Route {i + 1}", "color": "#FF0000"}
+                for i in range(ROUTE_COUNT)
+            ],
+        )
+        insert_chunked(
+            session,
+            RouteStop,
+            [
+                {
+                    "route_id": route_id,
+                    "stop_id": (route_id - 1) * STOPS_PER_ROUTE + position + 1,
+                    "position": position,
+                }
+                for route_id in range(1, ROUTE_COUNT + 1)
+                for position in range(STOPS_PER_ROUTE)
+            ],
+        )
+        insert_chunked(
+            session,
+            Alert,
+            [
+                {
+                    "id": i + 1,
+                    "text": "Closed",
+                    "start_datetime": now - timedelta(days=i),
+                    "end_datetime": now - timedelta(days=i) + timedelta(hours=2),
+                }
+                for i in range(ALERT_COUNT)
+            ],
+        )
+        insert_chunked(
+            session,
+            StopDisable,
+            [
+                {"alert_id": i + 1, "stop_id": rng.randint(1, stop_count)}
+                for i in range(ALERT_COUNT)
+            ],
+        )
+        insert_chunked(
+            session,
+            RouteDisable,
+            [
+                {"alert_id": i + 1, "route_id": rng.randint(1, ROUTE_COUNT)}
+                for i in range(ALERT_COUNT)
+            ],
+        )
+
+        session_id = 0
+        for day in range(days, -1, -1):
+            sessions, locations, ridership = [], [], []
+            for van in range(vans):
+                session_id += 1
+                started = now - timedelta(days=day, hours=12)
+                route_id = van % ROUTE_COUNT + 1
+                sessions.append(
+                    {
+                        "id": session_id,
+                        "created_at": started,
+                        "updated_at": started,
+                        "van_guid": str(van),
+                        "route_id": route_id,
+                        "stop_index": -1,
+                        "dead": day > 0,
+                    }
+                )
+                for fix in range(fixes):
+                    created_at = started + timedelta(seconds=2 * fix)
+                    lat = 39.75 + rng.uniform(0, 0.01)
+                    lon = -105.22 + rng.uniform(0, 0.01)
+                    locations.append(
+                        {
+                            "session_id": session_id,
+                            "created_at": created_at,
+                            "lat": lat,
+                            "lon": lon,
+                        }
+                    )
+                    if fix % 50 == 0:
+                        ridership.append(
+                            {
+                                "session_id": session_id,
+                                "route_id": route_id,
+                                "entered": rng.randint(0, 5),
+                                "exited": rng.randint(0, 5),
+                                "lat": lat,
+                                "lon": lon,
+                                "datetime": created_at,
+                            }
+                        )
+            insert_chunked(session, VanTrackerSession, sessions)
+            insert_chunked(session, VanLocation, locations)
+            insert_chunked(session, RidershipAnalytics, ridership)
+        session.commit()
+        return session_id
+
+
+def queries(last_session: int) -> Dict[str, Tuple[str, dict]]:
+    # Timestamps are stored as naive UTC.
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return {
+        "latest location of a session": (
+            "SELECT created_at, lat, lon FROM van_location WHERE session_id = :session "
+            "ORDER BY created_at DESC LIMIT 1",
+            {"session": last_session},
+        ),
+        "dwell window of a session": (
+            "SELECT created_at, lat, lon FROM van_location WHERE session_id = :session "
+            "AND created_at > :since ORDER BY created_at",
+            {"session": last_session, "since": now - timedelta(seconds=300)},
+        ),
+        "latest session of every van": (
+            "SELECT s.id FROM van_tracker_session s JOIN (SELECT van_guid, "
+            "max(created_at) AS created_at FROM van_tracker_session GROUP BY "
+            "van_guid) latest ON s.van_guid = latest.van_guid AND s.created_at = "
+            "latest.created_at",
+            {},
+        ),
+        "alive session of a van": (
+            "SELECT id FROM van_tracker_session WHERE van_guid = :guid AND dead = false "
+            "AND created_at > :since",
+            {"guid": "0", "since": now - timedelta(hours=12)},
+        ),
+        "latest ridership of a session": (
+            "SELECT datetime FROM ridership_analytics WHERE session_id = :session "
+            "ORDER BY datetime DESC LIMIT 1",
+            {"session": last_session},
+        ),
+        "ridership of a route for a week": (
+            "SELECT sum(entered), sum(exited) FROM ridership_analytics WHERE route_id "
+            "= :route AND datetime BETWEEN :start AND :end",
+            {"route": 1, "start": now - timedelta(days=14), "end": now},
+        ),
+        "stops of a route in order": (
+            "SELECT stop_id FROM route_stops WHERE route_id = :route ORDER BY position",
+            {"route": 1},
+        ),
+        "routes of a stop": (
+            "SELECT route_id FROM route_stops WHERE stop_id = :stop",
+            {"stop": 1},
+        ),
+        "disables of a stop": (
+            "SELECT id FROM stop_disables WHERE alert_id = :alert AND stop_id = :stop",
+            {"alert": 1, "stop": 1},
+        ),
+        "disables of a route": (
+            "SELECT id FROM route_disables WHERE alert_id = :alert AND route_id = "
+            ":route",
+            {"alert": 1, "route": 1},
+        ),
+    }
+
+
+def explain(engine: Engine, sql: str, params: dict) -> str:
+    prefix = "EXPLAIN QUERY PLAN " if engine.dialect.name == "sqlite" else "EXPLAIN "
+    with engine.connect() as connection:
+        rows = connection.execute(text(prefix + sql), params).all()
+    # SQLite reports (id, parent, notused, detail), PostgreSQL a single column.
+    return "\n".join(f"      {row[-1]}" for row in rows)
+
+
+def best_of(run: Callable[[], object], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def measure(engine: Engine, last_session: int, repeat: int) -> Dict[str, float]:
+    timings = {}
+    with engine.connect() as connection:
+        for name, (sql, params) in queries(last_session).items():
+            statement = text(sql)
+            timings[name] = best_of(
+                lambda: connection.execute(statement, params).all(), repeat
+            )
+    return timings
+
+
+def analyze(engine: Engine) -> None:
+    with engine.begin() as connection:
+        connection.execute(text("ANALYZE"))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--days", type=int, default=90, help="days of history")
+    parser.add_argument("--vans", type=int, default=4, help="vans running every day")
+    parser.add_argument(
+        "--fixes", type=int, default=2000, help="locations per van per day"
+    )
+    parser.add_argument("--repeat", type=int, default=20, help="runs per query")
+    parser.add_argument("--plans", action="store_true", help="print query plans")
+    args = parser.parse_args()
+
+    url = os.environ.get("DATABASE_URL", "sqlite://")
+    engine = create_engine(url)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    indexes = tracking_indexes()
+    for index in indexes:
+        index.drop(engine)
+
+    started = time.perf_counter()
+    last_session = seed(engine, args.days, args.vans, args.fixes, random.Random(0))
+    print(
+        f"Seeded {args.days} days of history for {args.vans} vans on "
+        f"{engine.dialect.name} in {time.perf_counter() - started:.1f} s"
+    )
+
+    analyze(engine)
+    before = measure(engine, last_session, args.repeat)
+    plans_before = {
+        name: explain(engine, sql, params)
+        for name, (sql, params) in queries(last_session).items()
+    }
+    for index in indexes:
+        index.create(engine)
+    analyze(engine)
+    after = measure(engine, last_session, args.repeat)
+
+    print(f"{'query':<34}{'before':>12}{'after':>12}{'speedup':>10}")
+    for name, (sql, params) in queries(last_session).items():
+        print(
+            f"{name:<34}{before[name]:>9.3f} ms{after[name]:>9.3f} ms"
+            f"{before[name] / after[name]:>9.1f}x"
+        )
+        if args.plans:
+            print("    before:")
+            print(plans_before[name])
+            print("    after:")
+            print(explain(engine, sql, params))
+
+    Base.metadata.drop_all(engine)
+
+
+if __name__ == "__main__":
+    main()
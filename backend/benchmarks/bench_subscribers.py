@@ -0,0 +1,307 @@
+"""
+Load test for websocket subscribers, showing that thousands of connected riders on slow
+links neither hold database connections nor slow down location reports.
+
+Vans report through post_location, first with nobody subscribed and then with
+thousands of subscribers split between the v1 broadcast, v2 van subscriptions and
+arrivals. Every subscriber takes a while to accept each message, like a phone on a
+weak connection. The latency of every report is measured from when it was due, so
+any time the event loop spends on subscribers shows up next to the time spent in the
+handler itself, and the database pool is watched for the most connections checked out
+at once.
+
+Run from the backend folder with `python -m benchmarks.bench_subscribers`. The
+database is a temporary SQLite file behind a pool sized like DBWrapper's.
+"""
+
+import argparse
+import asyncio
+import os
+import struct
+import tempfile
+import time
+from datetime import datetime, timezone
+from statistics import median, quantiles
+from types import SimpleNamespace
+from typing import Any, List, Tuple, cast
+
+from fastapi import WebSocket, WebSocketDisconnect
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+from src.db import Base
+from src.handlers.vans import (
+    begin_session,
+    post_location,
+    query_locations_v1,
+    subscribe_arrivals,
+    subscribe_location_v1,
+    subscribe_vans,
+)
+from src.model.route import Route
+from src.model.route_stop import RouteStop
+from src.model.stop import Stop
+from src.vantracking.arrivals import ArrivalEngine
+from src.vantracking.broadcast import Broadcaster
+from src.vantracking.changelog import ChangeLog
+from src.vantracking.ingest import IngestPipeline
+from src.vantracking.state import FleetState
+from src.vantracking.subscriptions import (
+    ArrivalSubscriptionRegistry,
+    VanSubscriptionRegistry,
+)
+
+ROUTE_COUNT = 4
+STOPS_PER_ROUTE = 12
+
+
+class PooledDB:
+    """
+    Stands in for DBWrapper, keeping track of how many connections are checked out.
+    """
+
+    def __init__(self, url: str):
+        self.engine = create_engine(url, pool_size=15, max_overflow=5)
+        self.checked_out = 0
+        self.max_checked_out = 0
+        event.listen(self.engine, "checkout", self._checkout)
+        event.listen(self.engine, "checkin", self._checkin)
+
+    def _checkout(self, *_) -> None:
+        self.checked_out += 1
+        self.max_checked_out = max(self.max_checked_out, self.checked_out)
+
+    def _checkin(self, *_) -> None:
+        self.checked_out -= 1
+
+    def session(self) -> Session:
+        return Session(self.engine)
+
+
+class SlowWebSocket:
+    """
+    A connected client that takes a while to accept every message it is sent.
+    """
+
+    def __init__(self, app, send_delay: float):
+        self.app = app
+        self.incoming: asyncio.Queue = asyncio.Queue()
+        self.send_delay = send_delay
+        self.received = 0
+
+    async def accept(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def receive_json(self):
+        msg = await self.incoming.get()
+        if msg is None:
+            raise WebSocketDisconnect()
+        return msg
+
+    async def receive_text(self):
+        return await self.receive_json()
+
+    async def _send(self) -> None:
+        await asyncio.sleep(self.send_delay)
+        self.received += 1
+
+    async def send_json(self, _):
+        await self._send()
+
+    async def send_text(self, _):
+        await self._send()
+
+    async def send_bytes(self, _):
+        await self._send()
+
+
+def seed(db: PooledDB) -> None:
+    Base.metadata.create_all(db.engine)
+    with db.session() as session:
+        for route_id in range(1, ROUTE_COUNT + 1):
+            session.add(Route(id=route_id, name=f"Route {route_id}", color="#FF0000"))
+            for position in range(STOPS_PER_ROUTE):
+                stop_id = (route_id - 1) * STOPS_PER_ROUTE + position + 1
+                session.add(
+                    Stop(
+                        id=stop_id,
+                        name=f"Stop {stop_id}",
+                        lat=39.75 + 0.001 * position,
+                        lon=-105.22 + 0.001 * route_id,
+                        active=True,
+                    )
+                )
+                session.add(
+                    RouteStop(route_id=route_id, stop_id=stop_id, position=position)
+                )
+        session.commit()
+
+
+def make_app(db: PooledDB) -> SimpleNamespace:
+    state = SimpleNamespace(db=db, fleet=FleetState())
+    with db.session() as session:
+        state.fleet.load(session)
+    state.change_log = ChangeLog()
+    state.fleet.add_listener(state.change_log.notify)
+    state.van_subscriptions = VanSubscriptionRegistry()
+    state.fleet.add_listener(state.van_subscriptions.notify)
+    state.arrival_subscriptions = ArrivalSubscriptionRegistry()
+    state.fleet.add_listener(state.arrival_subscriptions.notify)
+    state.arrivals = ArrivalEngine(state.fleet)
+    state.fleet.add_listener(state.arrivals.notify)
+    state.ingest = IngestPipeline(db, state.fleet)
+    state.location_broadcaster = Broadcaster(
+        lambda: query_locations_v1(state.fleet, datetime.now(timezone.utc)),
+        interval=2,
+    )
+    return SimpleNamespace(state=state)
+
+
+def request(app: SimpleNamespace, body: bytes) -> Any:
+    """
+    Stands in for the request of a hardware route, which only reads the body.
+    """
+
+    async def read_body():
+        return body
+
+    return SimpleNamespace(app=app, body=read_body)
+
+
+async def subscribe(app: SimpleNamespace, count: int, send_delay: float):
+    """
+    Connects subscribers, a fifth of them to the v1 broadcast, a fifth to arrivals and
+    the rest to van subscriptions split between all vans and a single route. Arrivals
+    subscribers keep their filter standing.
+    """
+    websockets: List[SlowWebSocket] = []
+    tasks: List[asyncio.Task] = []
+    for i in range(count):
+        websocket = SlowWebSocket(app, send_delay)
+        kind = i % 5
+        if kind == 0:
+            tasks.append(
+                asyncio.create_task(subscribe_location_v1(cast(WebSocket, websocket)))
+            )
+        elif kind == 1:
+            tasks.append(
+                asyncio.create_task(
+                    subscribe_arrivals(cast(WebSocket, websocket), subscribe=True)
+                )
+            )
+            route_id = i % ROUTE_COUNT + 1
+            websocket.incoming.put_nowait(
+                {str((route_id - 1) * STOPS_PER_ROUTE + 1): [route_id]}
+            )
+        else:
+            tasks.append(
+                asyncio.create_task(subscribe_vans(cast(WebSocket, websocket)))
+            )
+            query: dict = {"type": "vans"}
+            if kind == 3:
+                query["routeIds"] = [i % ROUTE_COUNT + 1]
+            websocket.incoming.put_nowait(
+                {
+                    "include": ["location", "color"],
+                    "query": query,
+                    "subscribe": True,
+                    "deltas": kind == 4,
+                }
+            )
+        websockets.append(websocket)
+    await asyncio.sleep(0.5)
+    return websockets, tasks
+
+
+async def report_locations(
+    app: SimpleNamespace, vans: int, reports: int, interval: float
+) -> Tuple[List[float], List[float]]:
+    """
+    Posts locations for every van in turn, and returns how long each report spent in
+    post_location and how long it took from when it was due, in milliseconds.
+    """
+    durations, latencies = [], []
+    started = time.perf_counter()
+    for i in range(reports):
+        due = started + i * interval
+        await asyncio.sleep(max(due - time.perf_counter(), 0))
+        guid = str(i % vans + 1)
+        body = struct.pack(
+            "<Qdd",
+            int(datetime.now(timezone.utc).timestamp() * 1000),
+            39.75 + 0.0001 * (i % 100),
+            -105.22,
+        )
+        called = time.perf_counter()
+        await post_location(request(app, body), guid)
+        returned = time.perf_counter()
+        durations.append((returned - called) * 1000)
+        latencies.append((returned - due) * 1000)
+    return durations, latencies
+
+
+async def run(
+    subscribers: int,
+    vans: int,
+    reports: int,
+    interval: float,
+    send_delay: float,
+) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        db = PooledDB(f"sqlite:///{os.path.join(directory, 'bench.db')}")
+        seed(db)
+        app = make_app(db)
+        for guid in range(1, vans + 1):
+            body = struct.pack("<i", guid % ROUTE_COUNT + 1)
+            await begin_session(request(app, body), str(guid))
+
+        websockets, tasks = await subscribe(app, subscribers, send_delay)
+        db.max_checked_out = db.checked_out
+        durations, latencies = await report_locations(app, vans, reports, interval)
+        await app.state.ingest.flush()
+
+        for websocket in websockets:
+            websocket.incoming.put_nowait(None)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await app.state.ingest.close()
+        db.engine.dispose()
+
+    received = sum(websocket.received for websocket in websockets)
+    print(
+        f"{subscribers:>11}{median(durations):>12.3f} ms"
+        f"{quantiles(durations, n=100)[98]:>9.3f} ms"
+        f"{median(latencies):>9.3f} ms{quantiles(latencies, n=100)[98]:>9.3f} ms"
+        f"{received:>12}{db.max_checked_out:>15}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--subscribers", type=int, default=2000, help="websockets connected"
+    )
+    parser.add_argument("--vans", type=int, default=20, help="vans reporting")
+    parser.add_argument("--reports", type=int, default=300, help="locations posted")
+    parser.add_argument(
+        "--interval", type=float, default=0.05, help="seconds between reports"
+    )
+    parser.add_argument(
+        "--send-delay", type=float, default=0.5, help="seconds per websocket send"
+    )
+    args = parser.parse_args()
+
+    print(f"{'':>11}{'handler':>27}{'since due':>24}")
+    print(
+        f"{'subscribers':>11}{'p50':>15}{'p99':>12}{'p50':>12}{'p99':>12}"
+        f"{'messages':>12}{'db connections':>15}"
+    )
+    for subscribers in (0, args.subscribers):
+        asyncio.run(
+            run(subscribers, args.vans, args.reports, args.interval, args.send_delay)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,18 @@ class DBWrapper:
         return Session(self.engine)
 
 
+def connect_unpooled(engine: sqlalchemy.Engine):
+    """
+    Opens a DBAPI connection of its own in autocommit mode, outside of the pool, for
+    something that holds it for as long as the worker runs.
+    """
+    dialect = engine.dialect
+    cargs, cparams = dialect.create_connect_args(engine.url)
+    connection = dialect.connect(*cargs, **cparams)
+    connection.autocommit = True
+    return connection
+
+
 class Base(DeclarativeBase):
     """
     This makes an instance of DeclarativeBase which is the inherited model for all models.
@@ -4,7 +4,7 @@ Routes for tracking ridership statistics.
 
 import struct
 from datetime import datetime, timedelta, timezone
-from typing import Dict, List, Optional, Union
+from typing import Any, Dict, List, Optional, Union
 
 from fastapi import APIRouter, Request
 from fastapi.responses import JSONResponse
@@ -102,8 +102,16 @@ async def post_ridership_stats(req: Request, van_guid: int):
         - lon (double-precision float, current longitude of the van at the stop)
     """
 
+    await accept_ridership(req.app.state, str(van_guid), await req.body())
+    return HardwareOKResponse()
+
+
+async def accept_ridership(state: Any, van_guid: str, body: bytes) -> None:
+    """
+    Validates and stores the ridership statistics packed in the body, laid out as
+    described for the ridership route.
+    """
     # Unpack the byte body sent by the hardware into their corresponding values
-    body = await req.body()
     timestamp_ms, entered, exited, lat, lon = struct.unpack("<Qbbdd", body)
     timestamp = datetime.fromtimestamp(timestamp_ms / 1000.0, timezone.utc)
 
@@ -123,15 +131,19 @@ async def post_ridership_stats(req: Request, van_guid: int):
             status_code=400, error_code=HardwareErrorCode.TIMESTAMP_IN_FUTURE
         )
 
-    with req.app.state.db.session() as session:
+    with state.db.session() as session:
         # Find the route that the van is currently on, required by the ridership database.
         # If there is no route, then the van does not exist or is not running.
-        tracker_session = session.query(VanTrackerSession).filter(
-            VanTrackerSession.van_guid == van_guid,
-            VanTrackerSession.dead == False,
-            now - VanTrackerSession.created_at < timedelta(hours=12),
+        tracker_session = (
+            session.query(VanTrackerSession)
+            .filter(
+                VanTrackerSession.van_guid == van_guid,
+                VanTrackerSession.dead == False,
+                now - VanTrackerSession.created_at < timedelta(hours=12),
+            )
+            .first()
         )
-        if not tracker_session:
+        if tracker_session is None:
             raise HardwareHTTPException(
                 status_code=404, error_code=HardwareErrorCode.VAN_NOT_ACTIVE
             )
@@ -161,5 +173,3 @@ async def post_ridership_stats(req: Request, van_guid: int):
         )
         session.add(new_ridership)
         session.commit()
-
-    return HardwareOKResponse()
@@ -0,0 +1,254 @@
+"""
+Routes for trackers that keep one connection open instead of making an HTTP request for
+every fix, which on a cellular link costs a connection setup and a full set of headers
+for a few dozen bytes.
+
+A tracker can either open a websocket, or connect to the raw TCP listener when one is
+configured. Either way it sends frames made of a frame type byte followed by the same
+packed body the HTTP route for it takes, and every frame is answered in order by a
+single byte, which is OK_CODE or the HardwareErrorCode the HTTP route would have sent.
+Frames go through the very same validation and ingest as over HTTP.
+
+Over TCP, every frame is prefixed by its length as an unsigned byte, and the first
+frame has to be a hello carrying the van's GUID, since there is no URL to carry it.
+
+Trackers that stay on HTTP can use the routes under HTTP_PREFIX, which take the same
+bodies and give the same responses as the hardware routes elsewhere. They are served
+by a bare ASGI app dispatched to before the middleware and routing of the API, which
+would only spend CPU time on requests carrying a few dozen bytes of binary.
+"""
+
+import asyncio
+import logging
+import struct
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple
+
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+from src.handlers.analytics import accept_ridership
+from src.handlers.routes import pack_routes
+from src.handlers.vans import accept_location, accept_location_batch, accept_session
+from src.hardware import (
+    HardwareErrorCode,
+    HardwareErrorTranslator,
+    HardwareHTTPException,
+    pack_error_code,
+    send_octets,
+)
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import ClientDisconnect
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+router = APIRouter(prefix="/hardware", tags=["hardware"])
+
+# Frame types. The body of a hello is the van's GUID in ASCII, and the others carry the
+# body of the location, ridership and route select routes respectively.
+FRAME_HELLO = 0
+FRAME_LOCATION = 1
+FRAME_RIDERSHIP = 2
+FRAME_ROUTE_SELECT = 3
+
+# Sent back for every frame that was accepted. Error codes are never negative.
+OK_CODE = struct.pack("!b", -1)
+
+# Trackers send a fix every few seconds, so a TCP tracker silent for this long has lost
+# its connection without it being closed, and is disconnected.
+TCP_READ_TIMEOUT = 120.0
+
+logger = logging.getLogger(__name__)
+
+FRAME_HANDLERS: Dict[int, Callable[[Any, str, bytes], Awaitable[None]]] = {
+    FRAME_LOCATION: accept_location,
+    FRAME_RIDERSHIP: accept_ridership,
+    FRAME_ROUTE_SELECT: accept_session,
+}
+
+
+class HardwareProtocolError(Exception):
+    """
+    Raised when a tracker sends something that is not a valid frame, after which the
+    connection is closed.
+    """
+
+
+async def handle_frame(state: Any, van_guid: str, frame: bytes) -> bytes:
+    """
+    Handles one frame from a tracker like the HTTP route for it would, and returns
+    the byte to answer with.
+    """
+    handler = FRAME_HANDLERS.get(frame[0]) if frame else None
+    if handler is None:
+        raise HardwareProtocolError("Unknown frame type")
+    try:
+        await handler(state, van_guid, frame[1:])
+    except HardwareHTTPException as e:
+        return pack_error_code(e.error_code)
+    except struct.error as e:
+        raise HardwareProtocolError("Malformed frame") from e
+    except Exception:  # pylint: disable=broad-exception-caught
+        # Over HTTP this would have been a 500, which the connection outlives too.
+        logger.exception("Failed to handle a frame from tracker %s", van_guid)
+        return pack_error_code(HardwareErrorCode.SERVER_ERROR)
+    return OK_CODE
+
+
+@router.websocket("/{van_guid}")
+async def hardware_websocket(websocket: WebSocket, van_guid: str) -> None:
+    """
+    Takes frames from a tracker as binary messages, without the length prefix, and
+    answers every one with a binary message of a single byte.
+    """
+    await websocket.accept()
+    try:
+        while True:
+            frame = await websocket.receive_bytes()
+            await websocket.send_bytes(
+                await handle_frame(websocket.app.state, van_guid, frame)
+            )
+    except WebSocketDisconnect:
+        return
+    except HardwareProtocolError as e:
+        logger.info("Disconnecting tracker %s: %s", van_guid, e)
+    await websocket.close()
+
+
+async def read_tcp_frame(reader: asyncio.StreamReader, timeout: float) -> bytes:
+    async with asyncio.timeout(timeout):
+        (length,) = await reader.readexactly(1)
+        return await reader.readexactly(length)
+
+
+async def serve_tcp_tracker(
+    state: Any,
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    read_timeout: float = TCP_READ_TIMEOUT,
+) -> None:
+    """
+    Takes length prefixed frames from a tracker connected over TCP until it
+    disconnects, goes silent for read_timeout seconds or sends something invalid.
+    """
+    try:
+        hello = await read_tcp_frame(reader, read_timeout)
+        if not hello or hello[0] != FRAME_HELLO:
+            raise HardwareProtocolError("Expected a hello")
+        van_guid = hello[1:].decode("ascii")
+        writer.write(OK_CODE)
+        while True:
+            frame = await read_tcp_frame(reader, read_timeout)
+            writer.write(await handle_frame(state, van_guid, frame))
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    except TimeoutError:
+        logger.info("Disconnecting a TCP tracker silent for %ss", read_timeout)
+    except (HardwareProtocolError, UnicodeDecodeError) as e:
+        logger.info("Disconnecting a TCP tracker: %s", e)
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+class TcpTrackerServer:
+    """
+    Listens for trackers over TCP. It has to be closed on shutdown, which disconnects
+    every tracker still connected, since the server alone would wait for them.
+    """
+
+    def __init__(self, state: Any, read_timeout: float = TCP_READ_TIMEOUT):
+        self._state = state
+        self._read_timeout = read_timeout
+        self._writers: Set[asyncio.StreamWriter] = set()
+        self._server: Optional[asyncio.Server] = None
+
+    async def start(self, host: str, port: int) -> asyncio.Server:
+        self._server = await asyncio.start_server(self._serve, host, port)
+        return self._server
+
+    async def _serve(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        self._writers.add(writer)
+        try:
+            await serve_tcp_tracker(self._state, reader, writer, self._read_timeout)
+        finally:
+            self._writers.discard(writer)
+
+    async def close(self) -> None:
+        if self._server is None:
+            return
+        self._server.close()
+        for writer in list(self._writers):
+            writer.close()
+        await self._server.wait_closed()
+        self._server = None
+
+
+HTTP_PREFIX = "/hardware/"
+
+# The hardware HTTP routes taking a van's GUID, by their method, the path segment
+# before the GUID and the ones after it.
+HTTP_HANDLERS: Dict[Tuple[str, ...], Callable[[Any, str, bytes], Awaitable[None]]] = {
+    ("POST", "location"): accept_location,
+    ("POST", "location", "batch"): accept_location_batch,
+    ("POST", "ridership"): accept_ridership,
+    ("POST", "routeselect"): accept_session,
+}
+
+
+async def read_body(receive: Receive) -> bytes:
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ClientDisconnect()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return body
+
+
+def query_routes_binary(state: Any) -> bytes:
+    with state.db.session() as session:
+        return pack_routes(session)
+
+
+async def hardware_http(scope: Scope, receive: Receive, send: Send) -> None:
+    """
+    Serves a request under HTTP_PREFIX, with nothing but a lookup of its path.
+    """
+    state = scope["app"].state
+    segments = scope["path"][len(HTTP_PREFIX) :].split("/")
+    if scope["method"] == "GET" and segments == ["routes"]:
+        # The query blocks, so it is run off the event loop like FastAPI would.
+        body = await run_in_threadpool(query_routes_binary, state)
+        await send_octets(send, 200, body)
+        return
+
+    key = (scope["method"], segments[0], *segments[2:])
+    handler = HTTP_HANDLERS.get(key) if len(segments) > 1 else None
+    if handler is None:
+        await send_octets(send, 404)
+        return
+    await handler(state, segments[1], await read_body(receive))
+    await send_octets(send, 200)
+
+
+class HardwareFastPath:
+    """
+    Sends HTTP requests under HTTP_PREFIX to the hardware HTTP app and everything else
+    on to the API. It has to be the outermost middleware added to the API, so that
+    hardware requests skip every other one.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.hardware = HardwareErrorTranslator(hardware_http)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and scope["path"].startswith(HTTP_PREFIX):
+            await self.hardware(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
@@ -19,7 +19,7 @@ from pygeoif.geometry import Point, Polygon
 from src.hardware import HardwareErrorCode, HardwareHTTPException, HardwareOKResponse
 from src.model.alert import Alert
 from src.model.pickup_spot import PickupSpot
-from src.model.route import Route
+from src.model.route import COLOR_PATTERN, Route
 from src.model.route_disable import RouteDisable
 from src.model.route_stop import RouteStop
 from src.model.stop import Stop
@@ -27,6 +27,7 @@ from src.model.stop_disable import StopDisable
 from src.model.van_tracker_session import VanTrackerSession
 from src.model.waypoint import Waypoint
 from src.request import process_include
+from src.vantracking.bus import refresh_routes
 
 # JSON field names/include values
 FIELD_ID = "id"
@@ -110,26 +111,34 @@ def get_routes_hardware(req: Request):
     """
 
     with req.app.state.db.session() as session:
-        routes = session.query(Route).all()
-        routes_length = len(routes)
-        if routes_length > 255:
-            raise HardwareHTTPException(400, HardwareErrorCode.TOO_MANY_ROUTES)
+        return HardwareOKResponse(pack_routes(session))
 
-        routes_binary = struct.pack("B", routes_length)
-        for route in routes:
-            route_id_binary = struct.pack(">I", route.id)
-            route_name_binary = route.name.encode("utf-8")
-            route_name_length = len(route_name_binary)
-            if route_name_length > 255:
-                raise HardwareHTTPException(400, HardwareErrorCode.ROUTE_NAME_TOO_LONG)
-
-            routes_binary += (
-                route_id_binary
-                + struct.pack("B", route_name_length)
-                + struct.pack(f"{route_name_length}s", route_name_binary)
-            )
 
-        return HardwareOKResponse(routes_binary)
+def pack_routes(session) -> bytes:
+    """
+    Packs the ID and name of every route, laid out as the hardware routes route
+    returns them.
+    """
+    routes = session.query(Route).all()
+    routes_length = len(routes)
+    if routes_length > 255:
+        raise HardwareHTTPException(400, HardwareErrorCode.TOO_MANY_ROUTES)
+
+    routes_binary = struct.pack("B", routes_length)
+    for route in routes:
+        route_id_binary = struct.pack(">I", route.id)
+        route_name_binary = route.name.encode("utf-8")
+        route_name_length = len(route_name_binary)
+        if route_name_length > 255:
+            raise HardwareHTTPException(400, HardwareErrorCode.ROUTE_NAME_TOO_LONG)
+
+        routes_binary += (
+            route_id_binary
+            + struct.pack("B", route_name_length)
+            + struct.pack(f"{route_name_length}s", route_name_binary)
+        )
+
+    return routes_binary
 
 
 @router.get("/kmlfile")
@@ -453,6 +462,10 @@ async def create_route(req: Request, kml_file: UploadFile):
                 return HTTPException(status_code=400, detail="bad kml file")
 
             description = entries[0]
+            if not COLOR_PATTERN.fullmatch(color):
+                raise HTTPException(
+                    status_code=400, detail=f"Invalid color {color} for {route_name}"
+                )
             route_model = Route(name=route_name, color=color, description=description)
             session.add(route_model)
             session.flush()
@@ -500,6 +513,9 @@ async def create_route(req: Request, kml_file: UploadFile):
 
         session.commit()
 
+        req.app.state.fleet.kill_all()
+        refresh_routes(req.app.state, session)
+
     return JSONResponse(status_code=200, content={"message": "OK"})
 
 
@@ -534,8 +550,16 @@ def delete_route(req: Request):
         session.query(Waypoint).delete()
         session.query(Stop).delete()
         session.query(RouteStop).delete()
+
+        # Every van was running on one of the deleted routes.
+        tracker_sessions = session.query(VanTrackerSession).all()
+        for tracker_session in tracker_sessions:
+            tracker_session.dead = True
         session.commit()
 
+        req.app.state.fleet.kill_all()
+        refresh_routes(req.app.state, session)
+
     return JSONResponse(status_code=200, content={"message": "OK"})
 
 
@@ -14,6 +14,7 @@ from src.model.route_stop import RouteStop
 from src.model.stop import Stop
 from src.model.stop_disable import StopDisable
 from src.request import process_include
+from src.vantracking.bus import refresh_routes
 
 # JSON field names/include values
 FIELD_ID = "id"
@@ -328,6 +329,8 @@ def update_stop(
 
         session.commit()
 
+        refresh_routes(req.app.state, session)
+
     return {"message": "OK"}
 
 
@@ -349,4 +352,6 @@ def delete_stop(req: Request, stop_id: int) -> dict[str, str]:
         session.query(Stop).filter(Stop.id == stop_id).delete()
         session.commit()
 
+        refresh_routes(req.app.state, session)
+
     return {"message": "OK"}
@@ -1,29 +1,73 @@
 import asyncio
+import logging
 import struct
 from datetime import datetime, timedelta, timezone
-from math import cos, radians, sqrt
-from typing import Annotated, Any, Dict, List, Optional, Union
+from functools import partial
+from typing import (
+    AbstractSet,
+    Annotated,
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    FrozenSet,
+    Hashable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 from fastapi import (
     APIRouter,
     HTTPException,
     Query,
     Request,
+    Response,
     WebSocket,
     WebSocketDisconnect,
 )
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from sqlalchemy import func
 from src.hardware import HardwareErrorCode, HardwareHTTPException, HardwareOKResponse
-from src.model.route import Route
-from src.model.route_stop import RouteStop
-from src.model.stop import Stop
-from src.model.van_location import VanLocation
+from src.model.route import COLOR_PATTERN, Route
 from src.model.van_tracker_session import VanTrackerSession
 from src.request import process_include
+from src.vantracking.arrivals import ARRIVALS_TICK, AVERAGE_VAN_SPEED_MPS, ArrivalEngine
+from src.vantracking.broadcast import (
+    FORMAT_BINARY,
+    FORMAT_JSON,
+    Broadcaster,
+    encode_json,
+)
+from src.vantracking.changelog import ChangeLog, ChangeSet
+from src.vantracking.compaction import TrailCompactor
+from src.vantracking.geo import MICRODEGREES, distance_meters
+from src.vantracking.ingest import IngestItem, IngestPipeline, initial_stop_index
+from src.vantracking.outbox import Frame, Outbox
+from src.vantracking.spatial import BoundingBox
+from src.vantracking.state import SESSION_LIFETIME, FleetState, LocationFix, VanState
+from src.vantracking.streams import (
+    EVENT_STREAM_HEADERS,
+    POLL_TIMEOUT,
+    EventStream,
+    PollResult,
+    stream_events,
+)
+from src.vantracking.subscriptions import (
+    ArrivalSubscription,
+    ArrivalSubscriptionRegistry,
+    StopFilter,
+    VanSubscription,
+    VanSubscriptionRegistry,
+)
 
 router = APIRouter(prefix="/vans", tags=["vans"])
 
+logger = logging.getLogger(__name__)
+
 FIELD_ID = "id"
 FIELD_GUID = "guid"
 FIELD_LATITUDE = "latitude"
@@ -39,92 +83,168 @@ FIELD_TYPE = "type"
 FIELD_ARRIVALS = "arrivals"
 FIELD_VAN = "van"
 FIELD_VANS = "vans"
+FIELD_SEQUENCE = "sequence"
+FIELD_EPOCH = "epoch"
+FIELD_REMOVED = "removed"
+FIELD_VIEWPORT = "viewport"
+FIELD_SUBSCRIPTIONS = "subscriptions"
+FIELD_CLIENTS = "clients"
+FIELD_LARGEST = "largest"
 TYPE_ERROR = "error"
+TYPE_SNAPSHOT = "snapshot"
+TYPE_DELTA = "delta"
 INCLUDES_V1 = {FIELD_LOCATION}
 INCLUDES_V2 = {FIELD_COLOR, FIELD_LOCATION}
 
-THRESHOLD_RADIUS_M = 30.48  # 100 ft
-THRESHOLD_TIME = timedelta(seconds=10)
-AVERAGE_VAN_SPEED_MPS = 8.9408  # 20 mph
-
-KM_LAT_RATIO = 111.32  # km/degree latitude
-EARTH_CIRCUFERENCE_KM = 40075  # km
-DEGREES_IN_CIRCLE = 360  # degrees
+# Standing arrivals subscriptions are pushed to at most once per interval, and
+# recomputed at least once per refresh interval since vans also expire without any
+# change to the fleet.
+ARRIVALS_PUSH_INTERVAL = 2.0  # seconds
+ARRIVALS_REFRESH_INTERVAL = 30.0  # seconds
+
+# Hardware location record: long long for timestamp, double for lat, double for lon
+LOCATION_FORMAT = "<Qdd"
+
+# Binary subscription frames, for riders that opt into them. A frame is a header of
+# unsigned char for the frame type and unsigned short for the record count, followed by
+# the records. Coordinates are quantized to int microdegrees, and vans are identified
+# by their numeric guid like the v1 id field, as an unsigned int.
+FRAME_HEADER = struct.Struct("<BH")
+FRAME_LOCATIONS_V1 = 1
+FRAME_VAN = 2
+FRAME_VANS = 3
+# Van id, timestamp, lat, lon, next stop id, seconds to next stop
+LOCATION_RECORD_V1 = struct.Struct("<IIiiHH")
+# Van id, flags, started, updated, lat, lon, route color as RGB
+VAN_RECORD = struct.Struct("<IBIIii3s")
+VAN_FLAG_ALIVE = 1
+VAN_FLAG_LOCATION = 2
+VAN_FLAG_COLOR = 4
+# Snapshot and delta frames start with unsigned char for the frame type, unsigned ints
+# for the epoch and sequence number and unsigned shorts for the van and removed van
+# counts instead. The van records are followed by the ids of the removed vans as unsigned
+# ints.
+DELTA_HEADER = struct.Struct("<BIIHH")
+REMOVED_RECORD = struct.Struct("<I")
+FRAME_SNAPSHOT = 4
+FRAME_DELTA = 5
+WIRE_FORMATS = {FORMAT_JSON, FORMAT_BINARY}
 
 
 @router.get("/")
 async def get_van_v1(
     req: Request,
     include: Annotated[List[str] | None, Query()] = None,
-) -> List[Dict[str, Union[int, str]]]:
+) -> List[Dict[str, Union[int, str, Dict[str, float]]]]:
     include_set = process_include(include, INCLUDES_V1)
-    with req.app.state.db.session() as session:
-        tracker_sessions = (
-            session.query(VanTrackerSession)
-            .order_by(VanTrackerSession.van_guid, VanTrackerSession.created_at.desc())
-            .distinct(VanTrackerSession.van_guid)
-            .all()
-        )
-        locations_json: List[Dict[str, Union[int, str]]] = []
-        for tracker_session in tracker_sessions:
-            van_json = {
-                FIELD_ID: int(tracker_session.van_guid),
-                FIELD_ROUTE_ID: tracker_session.route_id,
-                FIELD_GUID: tracker_session.van_guid,
+    locations_json: List[Dict[str, Union[int, str, Dict[str, float]]]] = []
+    for van in req.app.state.fleet.vans():
+        van_json: Dict[str, Union[int, str, Dict[str, float]]] = {
+            FIELD_ID: int(van.guid),
+            FIELD_ROUTE_ID: van.route_id,
+            FIELD_GUID: van.guid,
+        }
+        if FIELD_LOCATION in include_set and van.located_at is not None:
+            van_json[FIELD_LOCATION] = {
+                FIELD_LATITUDE: van.lat,
+                FIELD_LONGITUDE: van.lon,
             }
-            if FIELD_LOCATION in include_set:
-                van_json[FIELD_LOCATION] = query_most_recent_location(
-                    session, tracker_session
-                )
-            locations_json.append(van_json)
-        return locations_json
+        locations_json.append(van_json)
+    return locations_json
 
 
 @router.websocket("/location/subscribe/")
-async def subscribe_location_v1(websocket: WebSocket):
+async def subscribe_location_v1(
+    websocket: WebSocket,
+    wire_format: Annotated[str, Query(alias="format")] = FORMAT_JSON,
+):
     await websocket.accept()
 
-    while True:
-        now = datetime.now(timezone.utc)
-        with websocket.app.state.db.session() as session:
-            tracker_sessions = (
-                session.query(VanTrackerSession)
-                .filter(
-                    VanTrackerSession.dead == False,
-                    not_stale(now, VanTrackerSession.created_at),
-                )
-                .order_by(
-                    VanTrackerSession.van_guid, VanTrackerSession.created_at.desc()
-                )
-                .distinct(VanTrackerSession.van_guid)
-                .all()
-            )
-            locations_json: Dict[int, Dict[str, Union[str, int, float]]] = {}
-            for tracker_session in tracker_sessions:
-                location = query_most_recent_location(session, tracker_session)
-                stops = (
-                    session.query(Stop)
-                    .join(RouteStop)
-                    .filter(RouteStop.route_id == tracker_session.route_id)
-                    .order_by(RouteStop.position)
-                    .all()
-                )
-                next_stop_index = (tracker_session.stop_index + 1) % len(stops)
-                stop = stops[next_stop_index]
-                distance_m = distance_meters(
-                    stop.lat, stop.lon, location.lat, location.lon
-                )
-                seconds_to_next_stop = distance_m / AVERAGE_VAN_SPEED_MPS
-                location_json: Dict[str, Union[str, int, float]] = {
-                    "timestamp": int(location.created_at.timestamp()),
-                    "latitude": location.lat,
-                    "longitude": location.lon,
-                    "nextStopId": stop.id,
-                    "secondsToNextStop": seconds_to_next_stop,
-                }
-                locations_json[tracker_session.van_guid] = location_json
-            await websocket.send_json(locations_json)
-            await asyncio.sleep(2)
+    # Every v1 client receives the same payload, so a single shared broadcaster
+    # computes and serializes it once per tick for all of them.
+    broadcaster: Broadcaster = websocket.app.state.location_broadcaster
+    if not broadcaster.supports(wire_format):
+        await websocket.send_json(
+            {FIELD_TYPE: TYPE_ERROR, TYPE_ERROR: f"Invalid format {wire_format}"}
+        )
+        await websocket.close()
+        return
+    outbox = Outbox(websocket)
+    broadcaster.add(outbox, wire_format)
+    try:
+        while True:
+            # v1 clients never send anything, this only waits for the disconnect.
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        broadcaster.discard(outbox)
+        await outbox.close()
+
+
+def query_locations_v1(
+    fleet: FleetState, now: datetime
+) -> Dict[str, Dict[str, Union[str, int, float]]]:
+    locations_json: Dict[str, Dict[str, Union[str, int, float]]] = {}
+    for van in fleet.vans():
+        if not van.is_alive(now) or van.located_at is None:
+            continue
+        route = fleet.route(van.route_id)
+        if route is None or not route.stops:
+            continue
+        next_stop_index = (van.stop_index + 1) % len(route.stops)
+        stop = route.stops[next_stop_index]
+        distance_m = distance_meters(stop.lat, stop.lon, van.lat, van.lon)
+        seconds_to_next_stop = distance_m / AVERAGE_VAN_SPEED_MPS
+        location_json: Dict[str, Union[str, int, float]] = {
+            "timestamp": int(van.located_at.timestamp()),
+            "latitude": van.lat,
+            "longitude": van.lon,
+            "nextStopId": stop.id,
+            "secondsToNextStop": seconds_to_next_stop,
+        }
+        locations_json[van.guid] = location_json
+    return locations_json
+
+
+def encode_locations_v1(
+    locations_json: Dict[str, Dict[str, Union[str, int, float]]]
+) -> bytes:
+    records: List[bytes] = []
+    for guid, location_json in locations_json.items():
+        record = pack_record(
+            LOCATION_RECORD_V1,
+            guid,
+            location_json["timestamp"],
+            round(float(location_json["latitude"]) * MICRODEGREES),
+            round(float(location_json["longitude"]) * MICRODEGREES),
+            location_json["nextStopId"],
+            min(round(float(location_json["secondsToNextStop"])), 0xFFFF),
+        )
+        if record is not None:
+            records.append(record)
+    return FRAME_HEADER.pack(FRAME_LOCATIONS_V1, len(records)) + b"".join(records)
+
+
+def pack_record(record: struct.Struct, guid: str, *values: Any) -> Optional[bytes]:
+    """
+    Packs the record of a van in a binary frame. Returns None for a van that does not
+    fit in it, which is left out of the frame so that the other vans still go out.
+    """
+    try:
+        return record.pack(int(guid), *values)
+    except (ValueError, struct.error):
+        logger.debug("Leaving van %s out of a binary frame", guid, exc_info=True)
+        return None
+
+
+def pack_color(color: Any) -> Optional[bytes]:
+    """
+    Packs a route color as RGB, or returns None if it is not #RRGGBB.
+    """
+    if not isinstance(color, str) or not COLOR_PATTERN.fullmatch(color):
+        return None
+    return bytes.fromhex(color[1:])
 
 
 @router.get("/v2")
@@ -136,9 +256,7 @@ async def get_vans_v2(
 ) -> List[Dict[str, Union[bool, float, str, int, Dict[str, float]]]]:
     include_set = process_include(include, INCLUDES_V2)
     now = datetime.now(timezone.utc)
-    with req.app.state.db.session() as session:
-        result = query_latest_vans(session, now, alive, route_ids, include_set)
-        return result
+    return query_latest_vans(req.app.state.fleet, now, alive, route_ids, include_set)
 
 
 @router.get("/v2/{van_guid}")
@@ -149,8 +267,51 @@ async def get_van_v2(
 ) -> Dict[str, Union[bool, float, str, int, Dict[str, float]]]:
     include_set = process_include(include, INCLUDES_V2)
     now = datetime.now(timezone.utc)
+    return query_latest_van(req.app.state.fleet, now, van_guid, include_set)
+
+
+@router.get("/v2/subscriptions/stats")
+async def get_subscription_stats(req: Request) -> Dict[str, Dict[str, int]]:
+    """
+    Returns how many distinct van and arrival subscriptions there are, how many
+    clients share them and how many share the most popular one. Clients with the same
+    query share one subscription, which is computed once per change for all of them.
+    """
+    registries: Dict[str, Union[VanSubscriptionRegistry, ArrivalSubscriptionRegistry]]
+    registries = {
+        FIELD_VANS: req.app.state.van_subscriptions,
+        FIELD_ARRIVALS: req.app.state.arrival_subscriptions,
+    }
+    return {
+        name: {
+            FIELD_SUBSCRIPTIONS: len(registry),
+            FIELD_CLIENTS: registry.clients(),
+            FIELD_LARGEST: max(registry.group_sizes(), default=0),
+        }
+        for name, registry in registries.items()
+    }
+
+
+@router.get("/v2/sessions/{session_id}/trail")
+async def get_session_trail(
+    req: Request, session_id: int
+) -> List[Dict[str, Union[float, int]]]:
+    """
+    Returns where a van went during a tracker session, oldest first. Finished
+    sessions are simplified, so consecutive points can be far apart.
+    """
     with req.app.state.db.session() as session:
-        return query_latest_van(session, now, van_guid, include_set)
+        fixes = TrailCompactor.trail(session, session_id)
+    if fixes is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return [
+        {
+            "timestamp": int(fix.timestamp.timestamp()),
+            FIELD_LATITUDE: fix.lat,
+            FIELD_LONGITUDE: fix.lon,
+        }
+        for fix in fixes
+    ]
 
 
 class VanSubscriptionQueryModel(BaseModel):
@@ -163,250 +324,1185 @@ class VanSubscriptionQueryModel(BaseModel):
 class VanSubscriptionMessageModel(BaseModel):
     include: List[str]
     query: VanSubscriptionQueryModel
+    # When set, the query is registered as a standing subscription and the server
+    # pushes a fresh result whenever a matching van changes.
+    subscribe: bool = False
+    # Either json or binary. Errors are always sent as json.
+    format: str = FORMAT_JSON
+    # When set along with subscribe, the first message is a snapshot of every matching
+    # van, and later ones only carry the vans that changed and the vans that no longer
+    # match. Every message carries the fleet's sequence number at the time, along with
+    # its epoch. Reconnecting with both as the since and epoch query parameters turns
+    # the first snapshot into a delta of what changed in between, if possible.
+    deltas: bool = False
+    # As [min latitude, min longitude, max latitude, max longitude], limits a delta
+    # subscription to the vans located within it. Sending a message with only a new
+    # viewport afterwards moves it, and the client is sent the vans that came into
+    # view and the ones that left it.
+    viewport: Optional[List[float]] = None
+
+
+VanJson = Dict[str, Union[float, str, bool, int, Dict[str, float]]]
+
+VanSubscriptionResponse = Dict[
+    str,
+    Union[
+        str,
+        int,
+        Dict[str, Union[float, str, bool, int, dict[str, float]]],
+        List[Dict[str, Union[float, str, bool, int, dict[str, float]]]],
+        List[str],
+    ],
+]
 
 
 @router.websocket("/v2/subscribe/")
-async def subscribe_vans(websocket: WebSocket) -> None:
+async def subscribe_vans(
+    websocket: WebSocket,
+    since: Annotated[Optional[int], Query()] = None,
+    epoch: Annotated[Optional[int], Query()] = None,
+) -> None:
     await websocket.accept()
-    while True:
-        try:
-            # Given the dynamic nature of subscribing, we actually overload the message
-            # sent such that you can specify a vanguid or a route filter rather than
-            # having 2 separate http routes.
-            msg_json = await websocket.receive_json()
-        except WebSocketDisconnect:
-            break
-        try:
-            msg = VanSubscriptionMessageModel(**msg_json)
-            include_set = process_include(msg.include, INCLUDES_V2)
-            now = datetime.now(timezone.utc)
-            with websocket.app.state.db.session() as session:
-                resp: Dict[
-                    str,
-                    Union[
-                        str,
-                        Dict[str, Union[float, str, bool, int, dict[str, float]]],
-                        List[Dict[str, Union[float, str, bool, int, dict[str, float]]]],
-                    ],
-                ] = {
-                    FIELD_TYPE: msg.query.type,
-                }
-                if msg.query.type == FIELD_VAN:
-                    if msg.query.guid is None:
-                        raise HTTPException(
-                            status_code=400, detail="GUID must be specified"
+    # Like every websocket here, this only reads the in-memory fleet state and never
+    # opens a database session, so a slow client cannot pin a pooled connection
+    # across its sends. Every message goes through the outbox, so a slow client only
+    # ever holds up itself.
+    outbox = Outbox(websocket)
+    fleet: FleetState = websocket.app.state.fleet
+    registry: VanSubscriptionRegistry = websocket.app.state.van_subscriptions
+    subscription: Optional[VanSubscription] = None
+    # The message behind the standing subscription, if there is one.
+    msg: Optional[VanSubscriptionMessageModel] = None
+    include_set: set[str] = set(INCLUDES_V2)
+    try:
+        while True:
+            try:
+                # Given the dynamic nature of subscribing, we actually overload the message
+                # sent such that you can specify a vanguid or a route filter rather than
+                # having 2 separate http routes.
+                msg_json = await websocket.receive_json()
+            except WebSocketDisconnect:
+                break
+
+            # A bare viewport moves that of the standing subscription.
+            if set(msg_json) == {FIELD_VIEWPORT}:
+                if subscription is None or subscription.viewport is None or msg is None:
+                    outbox.put(
+                        encode_json(
+                            {
+                                FIELD_TYPE: TYPE_ERROR,
+                                TYPE_ERROR: "No viewport subscription to move",
+                            }
                         )
-                    resp[FIELD_VAN] = query_latest_van(
-                        session, now, msg.query.guid, include_set
                     )
-                elif msg.query.type == FIELD_VANS:
-                    resp[FIELD_VANS] = query_latest_vans(
-                        session,
-                        now,
-                        msg.query.alive,
-                        msg.query.routeIds,
+                    continue
+                try:
+                    delta = move_van_viewport(
+                        registry,
+                        fleet,
+                        subscription,
+                        msg,
                         include_set,
+                        parse_viewport(msg_json[FIELD_VIEWPORT]),
+                    )
+                    if delta is not None:
+                        outbox.put(encode_van_response(delta, msg.format))
+                except HTTPException as e:
+                    outbox.put(
+                        encode_json({FIELD_TYPE: TYPE_ERROR, TYPE_ERROR: e.detail})
                     )
-                else:
+                continue
+
+            # Any new message replaces the standing subscription, if there is one.
+            if subscription is not None:
+                await leave_van_subscription(registry, subscription, outbox)
+                subscription = None
+
+            try:
+                msg = VanSubscriptionMessageModel(**msg_json)
+                include_set = process_include(msg.include, INCLUDES_V2)
+                if msg.format not in WIRE_FORMATS:
                     raise HTTPException(
-                        status_code=400,
-                        detail="Invalid filter " + msg.query.type + " specified",
+                        status_code=400, detail=f"Invalid format {msg.format}"
                     )
-                await websocket.send_json(resp)
-        except HTTPException as e:
-            resp = {
-                FIELD_TYPE: TYPE_ERROR,
-                TYPE_ERROR: e.detail,
-            }
-            await websocket.send_json(resp)
+                subscription, resp = open_van_subscription(
+                    websocket.app.state, outbox, msg, include_set, since, epoch
+                )
+                # Only the first subscription can resume where the last connection
+                # left off.
+                since = None
+                outbox.put(encode_van_response(resp, msg.format))
+            except HTTPException as e:
+                resp = {
+                    FIELD_TYPE: TYPE_ERROR,
+                    TYPE_ERROR: e.detail,
+                }
+                outbox.put(encode_json(resp))
+                continue
+    finally:
+        if subscription is not None:
+            await leave_van_subscription(registry, subscription, outbox)
+        # The outbox may already have closed the connection of a slow client.
+        await outbox.close(disconnect=True)
+
+
+def open_van_subscription(
+    state: Any,
+    outbox: Outbox,
+    msg: VanSubscriptionMessageModel,
+    include_set: set[str],
+    since: Optional[int],
+    epoch: Optional[int],
+) -> Tuple[Optional[VanSubscription], VanSubscriptionResponse]:
+    """
+    Answers a subscription message, and registers it as a standing subscription if it
+    asks to be. A delta subscription resuming from a sequence number is answered with
+    what changed since, if possible.
+    """
+    fleet: FleetState = state.fleet
+    registry: VanSubscriptionRegistry = state.van_subscriptions
+    now = datetime.now(timezone.utc)
+    if msg.viewport is not None and not (msg.subscribe and msg.deltas):
+        raise HTTPException(
+            status_code=400,
+            detail="A viewport needs a subscription with deltas",
+        )
+    if not msg.subscribe or not msg.deltas:
+        resp = query_van_subscription(fleet, now, msg, include_set)
+        if not msg.subscribe:
+            return None, resp
+        return (
+            join_van_subscription(registry, fleet, outbox, msg, include_set, now),
+            resp,
+        )
+    check_van_query(msg.query)
+    subscription = join_van_subscription(registry, fleet, outbox, msg, include_set, now)
+    changes = query_changes(state, since, epoch)
+    if changes is not None:
+        return subscription, query_van_catch_up(fleet, subscription, changes)
+    return subscription, query_subscription_snapshot(fleet, subscription)
+
+
+@router.get("/v2/subscribe/events")
+async def stream_vans(
+    req: Request,
+    guid: Optional[str] = None,
+    alive: Optional[bool] = None,
+    route_ids: Annotated[List[int] | None, Query()] = None,
+    include: Annotated[List[str] | None, Query()] = None,
+    deltas: bool = False,
+    since: Optional[int] = None,
+    epoch: Optional[int] = None,
+) -> StreamingResponse:
+    """
+    Streams a van subscription as server-sent events, for clients that cannot keep a
+    websocket open. The query is that of GET /vans/v2, or a GUID to follow one van,
+    and every event is the json message a websocket subscribed to the same query is
+    sent, down to the very same frame. Resuming with since and epoch works the same
+    way too.
+    """
+    include_set = process_include(include, INCLUDES_V2)
+    msg = van_stream_message(guid, alive, route_ids, include_set, deltas)
+    if guid is not None and not deltas and req.app.state.fleet.van(guid) is None:
+        # The first event would be the van, so the request fails like GET /vans/v2.
+        raise HTTPException(status_code=404, detail="Van not found")
+    stream = EventStream()
+    outbox = Outbox(stream)
+
+    def join() -> Callable[[], Awaitable[None]]:
+        subscription, resp = open_van_subscription(
+            req.app.state, outbox, msg, include_set, since, epoch
+        )
+        assert subscription is not None
+        outbox.put(encode_json(resp))
+        return partial(
+            leave_van_subscription,
+            req.app.state.van_subscriptions,
+            subscription,
+            outbox,
+        )
+
+    return StreamingResponse(
+        stream_events(stream, outbox, join),
+        media_type="text/event-stream",
+        headers=EVENT_STREAM_HEADERS,
+    )
+
+
+@router.get("/v2/subscribe/poll")
+async def poll_vans(
+    req: Request,
+    guid: Optional[str] = None,
+    alive: Optional[bool] = None,
+    route_ids: Annotated[List[int] | None, Query()] = None,
+    include: Annotated[List[str] | None, Query()] = None,
+    since: Optional[int] = None,
+    epoch: Optional[int] = None,
+) -> Response:
+    """
+    Long polls a van delta subscription, for clients that cannot keep a websocket
+    open. Without since and epoch, or if the server can no longer tell what changed
+    since, the response is a snapshot like the first message on a websocket, and
+    otherwise it is a delta of what changed. A client that is already up to date
+    waits for the next change and is handed the same delta frame as the websockets
+    with its query, or no content if nothing changes for a while.
+    """
+    include_set = process_include(include, INCLUDES_V2)
+    msg = van_stream_message(guid, alive, route_ids, include_set, deltas=True)
+    result = PollResult()
+    outbox = Outbox(result)
+    subscription, resp = open_van_subscription(
+        req.app.state, outbox, msg, include_set, since, epoch
+    )
+    assert subscription is not None
+    frame: Optional[Frame] = None
+    try:
+        # Vans elsewhere in the fleet may have changed, but none that the client could
+        # have been sent.
+        if resp[FIELD_TYPE] == TYPE_DELTA and not (
+            resp[FIELD_VANS] or resp[FIELD_REMOVED]
+        ):
+            frame = await result.wait(POLL_TIMEOUT)
+        else:
+            frame = encode_json(resp)
+    finally:
+        await outbox.close()
+        await leave_van_subscription(
+            req.app.state.van_subscriptions, subscription, outbox
+        )
+    return poll_response(frame)
+
+
+def van_stream_message(
+    guid: Optional[str],
+    alive: Optional[bool],
+    route_ids: Optional[List[int]],
+    include_set: set[str],
+    deltas: bool,
+) -> VanSubscriptionMessageModel:
+    """
+    Returns the websocket message equivalent to the query parameters of an event
+    stream or long poll, so that they join the same subscriptions.
+    """
+    return VanSubscriptionMessageModel(
+        include=sorted(include_set),
+        query=VanSubscriptionQueryModel(
+            type=FIELD_VANS if guid is None else FIELD_VAN,
+            guid=guid,
+            alive=alive,
+            routeIds=route_ids,
+        ),
+        subscribe=True,
+        deltas=deltas,
+    )
+
+
+def poll_response(frame: Optional[Frame]) -> Response:
+    if frame is None:
+        return Response(status_code=204)
+    return Response(content=frame, media_type="application/json")
+
+
+def van_subscription_key(
+    msg: VanSubscriptionMessageModel, include_set: set[str]
+) -> Hashable:
+    """
+    Returns the canonical form of a subscription, which is the same for every message
+    that gets the same pushes however its query was written.
+    """
+    query: tuple
+    if msg.query.type == FIELD_VAN:
+        query = (FIELD_VAN, msg.query.guid)
+    else:
+        route_ids = (
+            tuple(sorted(set(msg.query.routeIds)))
+            if msg.query.routeIds is not None
+            else None
+        )
+        query = (msg.query.type, msg.query.alive, route_ids)
+    return (query, tuple(sorted(include_set)), msg.format, msg.deltas)
+
+
+def join_van_subscription(
+    registry: VanSubscriptionRegistry,
+    fleet: FleetState,
+    outbox: Outbox,
+    msg: VanSubscriptionMessageModel,
+    include_set: set[str],
+    now: datetime,
+) -> VanSubscription:
+    """
+    Adds a client to the subscription for its query, and starts pushing to it if it is
+    the first one with that query. A client with a viewport always gets a
+    subscription of its own.
+    """
+    key = van_subscription_key(msg, include_set)
+    viewport = None
+    if msg.viewport is not None:
+        viewport = parse_viewport(msg.viewport)
+        key = (key, outbox)
+    subscription = registry.join(
+        key,
+        outbox,
+        guid=msg.query.guid if msg.query.type == FIELD_VAN else None,
+        route_ids=(set(msg.query.routeIds) if msg.query.routeIds is not None else None),
+        viewport=viewport,
+    )
+    if subscription.task is None:
+        if msg.deltas:
+            subscription.sent = {}
+            query_van_snapshot(
+                fleet, now, msg, include_set, subscription.sent, viewport
+            )
+            subscription.sequence = fleet.sequence
+        subscription.task = asyncio.create_task(
+            push_van_subscription(fleet, subscription, msg, include_set)
+        )
+    return subscription
+
+
+def parse_viewport(viewport: List[float]) -> BoundingBox:
+    if len(viewport) != 4 or viewport[0] > viewport[2] or viewport[1] > viewport[3]:
+        raise HTTPException(
+            status_code=400,
+            detail="Viewport must be [min latitude, min longitude, max latitude, max longitude]",
+        )
+    return BoundingBox(*viewport)
+
+
+def move_van_viewport(
+    registry: VanSubscriptionRegistry,
+    fleet: FleetState,
+    subscription: VanSubscription,
+    msg: VanSubscriptionMessageModel,
+    include_set: set[str],
+    viewport: BoundingBox,
+) -> Optional[VanSubscriptionResponse]:
+    """
+    Moves the viewport of a subscription, and returns the vans that came into view
+    and the ones that left it, or None if nothing did.
+    """
+    assert subscription.sent is not None
+    registry.move_viewport(subscription, viewport)
+    now = datetime.now(timezone.utc)
+    in_view = {van.guid for van in fleet.vans_within(viewport)}
+    # Every van in view or already sent is brought up to date, so what was sent is
+    # now current.
+    delta = query_van_delta(
+        fleet, now, msg, include_set, subscription.sent, in_view, viewport
+    )
+    subscription.sequence = fleet.sequence
+    return delta
+
+
+async def leave_van_subscription(
+    registry: VanSubscriptionRegistry, subscription: VanSubscription, outbox: Outbox
+) -> None:
+    if registry.leave(subscription, outbox) and subscription.task is not None:
+        await cancel_task(subscription.task)
+
+
+async def push_van_subscription(
+    fleet: FleetState,
+    subscription: VanSubscription,
+    msg: VanSubscriptionMessageModel,
+    include_set: set[str],
+) -> None:
+    """
+    Evaluates a subscription whenever a van it could be interested in changes, and
+    puts the same frame on the outbox of every client sharing it.
+    """
+    while True:
+        guids = await subscription.wait()
+        try:
+            push_van_changes(fleet, subscription, msg, include_set, guids)
+        except Exception:  # pylint: disable=broad-exception-caught
+            # A van that cannot be encoded must not stop the pushes for good.
+            logger.exception("Failed to push to van subscription %r", subscription.key)
+
+
+def push_van_changes(
+    fleet: FleetState,
+    subscription: VanSubscription,
+    msg: VanSubscriptionMessageModel,
+    include_set: set[str],
+    guids: Set[str],
+) -> None:
+    now = datetime.now(timezone.utc)
+    if subscription.sent is not None:
+        delta = query_van_delta(
+            fleet,
+            now,
+            msg,
+            include_set,
+            subscription.sent,
+            guids,
+            subscription.viewport,
+        )
+        subscription.sequence = fleet.sequence
+        if delta is not None:
+            push_van_delta(fleet, subscription, delta, msg.format)
+        return
+    try:
+        resp = query_van_subscription(fleet, now, msg, include_set)
+    except HTTPException:
+        # The query was valid when it was registered, so the only way for it to
+        # fail now is if the van is gone. Wait for it to come back.
+        return
+    frame = encode_van_response(resp, msg.format)
+    for outbox in subscription.members:
+        # Every push holds the whole result, so it replaces any the client has not
+        # received yet.
+        outbox.put(frame, snapshot=True)
+
+
+def push_van_delta(
+    fleet: FleetState,
+    subscription: VanSubscription,
+    delta: VanSubscriptionResponse,
+    wire_format: str,
+) -> None:
+    frame = encode_van_response(delta, wire_format)
+    snapshot: Optional[Frame] = None
+    for outbox in subscription.members:
+        if outbox.put(frame):
             continue
-        except Exception as e:
-            await websocket.close()
-            raise e
-    await websocket.close()
+        # The client fell too far behind to take another delta, so it starts over
+        # from a snapshot instead. It is only built if someone needs it.
+        if snapshot is None:
+            snapshot = encode_van_response(
+                query_subscription_snapshot(fleet, subscription), wire_format
+            )
+        outbox.put(snapshot, snapshot=True)
+
+
+def encode_van_response(resp: VanSubscriptionResponse, wire_format: str) -> Frame:
+    if wire_format == FORMAT_BINARY:
+        return encode_van_subscription(resp)
+    return encode_json(resp)
+
+
+def encode_van_subscription(resp: VanSubscriptionResponse) -> bytes:
+    resp_type = resp[FIELD_TYPE]
+    vans_json: List[Dict[str, Any]]
+    if resp_type == FIELD_VAN:
+        vans_json = [resp[FIELD_VAN]]  # type: ignore[list-item]
+    else:
+        vans_json = resp[FIELD_VANS]  # type: ignore[assignment]
+    removed: List[str] = resp.get(FIELD_REMOVED, [])  # type: ignore[assignment]
+    records: List[bytes] = []
+    for van_json in vans_json:
+        flags = VAN_FLAG_ALIVE if van_json[FIELD_ALIVE] else 0
+        lat = lon = 0
+        location = van_json.get(FIELD_LOCATION)
+        if location is not None:
+            flags |= VAN_FLAG_LOCATION
+            lat = round(location[FIELD_LATITUDE] * MICRODEGREES)
+            lon = round(location[FIELD_LONGITUDE] * MICRODEGREES)
+        color = pack_color(van_json.get(FIELD_COLOR))
+        if color is not None:
+            flags |= VAN_FLAG_COLOR
+        record = pack_record(
+            VAN_RECORD,
+            van_json[FIELD_GUID],
+            flags,
+            van_json[FIELD_CREATED_AT],
+            van_json[FIELD_UPDATED_AT],
+            lat,
+            lon,
+            color or b"\0\0\0",
+        )
+        if record is not None:
+            records.append(record)
+    removed_records: List[bytes] = []
+    for guid in removed:
+        record = pack_record(REMOVED_RECORD, guid)
+        if record is not None:
+            removed_records.append(record)
+
+    if resp_type in (TYPE_SNAPSHOT, TYPE_DELTA):
+        header = DELTA_HEADER.pack(
+            FRAME_SNAPSHOT if resp_type == TYPE_SNAPSHOT else FRAME_DELTA,
+            resp[FIELD_EPOCH],
+            resp[FIELD_SEQUENCE],
+            len(records),
+            len(removed_records),
+        )
+    else:
+        header = FRAME_HEADER.pack(
+            FRAME_VAN if resp_type == FIELD_VAN else FRAME_VANS, len(records)
+        )
+    return header + b"".join(records) + b"".join(removed_records)
+
+
+async def cancel_task(task: asyncio.Task) -> None:
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+def query_van_subscription(
+    fleet: FleetState,
+    now: datetime,
+    msg: VanSubscriptionMessageModel,
+    include_set: set[str],
+) -> VanSubscriptionResponse:
+    check_van_query(msg.query)
+    resp: VanSubscriptionResponse = {
+        FIELD_TYPE: msg.query.type,
+    }
+    if msg.query.type == FIELD_VAN:
+        assert msg.query.guid is not None
+        resp[FIELD_VAN] = query_latest_van(fleet, now, msg.query.guid, include_set)
+    else:
+        resp[FIELD_VANS] = query_latest_vans(
+            fleet,
+            now,
+            msg.query.alive,
+            msg.query.routeIds,
+            include_set,
+        )
+    return resp
+
+
+def check_van_query(query: VanSubscriptionQueryModel) -> None:
+    if query.type == FIELD_VAN and query.guid is None:
+        raise HTTPException(status_code=400, detail="GUID must be specified")
+    if query.type not in (FIELD_VAN, FIELD_VANS):
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid filter " + query.type + " specified",
+        )
 
 
 def query_latest_van(
-    session, now: datetime, guid: str, include_set: set[str]
+    fleet: FleetState, now: datetime, guid: str, include_set: set[str]
 ) -> Dict[str, Union[float, str, bool, int, Dict[str, float]]]:
-    tracker_session = (
-        session.query(VanTrackerSession)
-        .filter(VanTrackerSession.van_guid == guid)
-        .first()
-    )
-    if tracker_session is None:
+    van = fleet.van(guid)
+    if van is None:
         raise HTTPException(status_code=404, detail="Van not found")
-    return base_query_van(session, now, tracker_session, include_set)
+    return base_query_van(fleet, now, van, include_set)
 
 
 def query_latest_vans(
-    session,
+    fleet: FleetState,
     now: datetime,
     alive: Optional[bool],
     route_ids: Optional[List[int]],
     include_set: set[str],
 ) -> List[Dict[str, Union[float, str, bool, int, Dict[str, float]]]]:
-    tracker_query = (
-        session.query(VanTrackerSession)
-        .order_by(VanTrackerSession.van_guid, VanTrackerSession.created_at.desc())
-        .distinct(VanTrackerSession.van_guid)
+    return [
+        base_query_van(fleet, now, van, include_set)
+        for van in fleet.vans()
+        if van_matches(now, van, alive, route_ids)
+    ]
+
+
+def van_matches(
+    now: datetime, van: VanState, alive: Optional[bool], route_ids: Optional[List[int]]
+) -> bool:
+    if alive is not None and not (
+        (not van.dead) == alive and not_stale(now, van.created_at)
+    ):
+        return False
+    return route_ids is None or van.route_id in route_ids
+
+
+def van_subscription_matches(
+    now: datetime,
+    van: VanState,
+    query: VanSubscriptionQueryModel,
+    viewport: Optional[BoundingBox] = None,
+) -> bool:
+    if viewport is not None and (
+        van.located_at is None or not viewport.contains(van.lat, van.lon)
+    ):
+        return False
+    if query.type == FIELD_VAN:
+        return van.guid == query.guid
+    return van_matches(now, van, query.alive, query.routeIds)
+
+
+def query_van_snapshot(
+    fleet: FleetState,
+    now: datetime,
+    msg: VanSubscriptionMessageModel,
+    include_set: set[str],
+    sent: Dict[str, VanJson],
+    viewport: Optional[BoundingBox] = None,
+) -> VanSubscriptionResponse:
+    """
+    Returns every van matching a subscription, and remembers what was sent so that
+    later messages can be deltas against it. With a viewport, only the vans within it
+    are looked at.
+    """
+    check_van_query(msg.query)
+    sent.clear()
+    vans = fleet.vans() if viewport is None else fleet.vans_within(viewport)
+    for van in vans:
+        if van_subscription_matches(now, van, msg.query, viewport):
+            sent[van.guid] = base_query_van(fleet, now, van, include_set)
+    return {
+        FIELD_TYPE: TYPE_SNAPSHOT,
+        FIELD_EPOCH: fleet.epoch,
+        FIELD_SEQUENCE: fleet.sequence,
+        FIELD_VANS: list(sent.values()),
+    }
+
+
+def query_subscription_snapshot(
+    fleet: FleetState, subscription: VanSubscription
+) -> VanSubscriptionResponse:
+    """
+    Returns what a subscription last sent its clients in full, for a client that joins
+    it or falls too far behind, so that the deltas sent to everyone apply on top.
+    """
+    assert subscription.sent is not None
+    return {
+        FIELD_TYPE: TYPE_SNAPSHOT,
+        FIELD_EPOCH: fleet.epoch,
+        FIELD_SEQUENCE: subscription.sequence,
+        FIELD_VANS: list(subscription.sent.values()),
+    }
+
+
+def query_van_catch_up(
+    fleet: FleetState, subscription: VanSubscription, changes: ChangeSet
+) -> VanSubscriptionResponse:
+    """
+    Returns the vans that changed since a reconnecting client last heard from the
+    server, as a delta against what it already has.
+    """
+    sent = subscription.sent
+    assert sent is not None
+    # Only vans that matched the query before or after changing could have been sent
+    # to the client, so only those can have been removed.
+    guids = sorted(
+        {
+            change.van.guid
+            for change in changes.changes
+            if subscription.touched_by(change)
+        }
     )
+    return {
+        FIELD_TYPE: TYPE_DELTA,
+        FIELD_EPOCH: fleet.epoch,
+        FIELD_SEQUENCE: subscription.sequence,
+        FIELD_VANS: [sent[guid] for guid in guids if guid in sent],
+        FIELD_REMOVED: [guid for guid in guids if guid not in sent],
+    }
 
-    tracker_sessions = tracker_query.all()
-
-    if alive is not None:
-        tracker_sessions = [
-            tracker_session
-            for tracker_session in tracker_sessions
-            if not tracker_session.dead == alive
-            and not_stale(now, tracker_session.created_at)
-        ]
-
-    if route_ids is not None:
-        tracker_sessions = [
-            tracker_session
-            for tracker_session in tracker_sessions
-            if tracker_session.route_id in route_ids
-        ]
-
-    locations_json: List[Dict[str, Union[float, str, bool, int, Dict[str, float]]]] = []
-    for tracker_session in tracker_sessions:
-        locations_json.append(
-            base_query_van(session, now, tracker_session, include_set)
-        )
-    return locations_json
+
+def query_changes(
+    state: Any, since: Optional[int], epoch: Optional[int]
+) -> Optional[ChangeSet]:
+    """
+    Returns what changed since a reconnecting client's sequence number, or None if it
+    has to start over from a snapshot.
+    """
+    fleet: FleetState = state.fleet
+    if since is None or epoch != fleet.epoch:
+        return None
+    change_log: ChangeLog = state.change_log
+    return change_log.since(since)
+
+
+def query_van_delta(
+    fleet: FleetState,
+    now: datetime,
+    msg: VanSubscriptionMessageModel,
+    include_set: set[str],
+    sent: Dict[str, VanJson],
+    guids: Set[str],
+    viewport: Optional[BoundingBox] = None,
+) -> Optional[VanSubscriptionResponse]:
+    """
+    Returns the vans that changed since the last message and the ones that no longer
+    match, updating what was sent, or None if the client is already up to date. Only
+    vans that changed or expired are serialized again.
+    """
+    changed: List[VanJson] = []
+    removed: List[str] = []
+    for guid in sorted(guids | sent.keys()):
+        van = fleet.van(guid)
+        if van is None or not van_subscription_matches(now, van, msg.query, viewport):
+            if sent.pop(guid, None) is not None:
+                removed.append(guid)
+            continue
+        previous = sent.get(guid)
+        if (
+            guid not in guids
+            and previous is not None
+            and previous[FIELD_ALIVE] == van.is_alive(now)
+        ):
+            continue
+        van_json = base_query_van(fleet, now, van, include_set)
+        if van_json != previous:
+            sent[guid] = van_json
+            changed.append(van_json)
+    if not changed and not removed:
+        return None
+    return {
+        FIELD_TYPE: TYPE_DELTA,
+        FIELD_EPOCH: fleet.epoch,
+        FIELD_SEQUENCE: fleet.sequence,
+        FIELD_VANS: changed,
+        FIELD_REMOVED: removed,
+    }
 
 
 def base_query_van(
-    session, now: datetime, tracker_session: VanTrackerSession, include_set: set[str]
+    fleet: FleetState, now: datetime, van: VanState, include_set: set[str]
 ) -> Dict[str, Union[float, str, bool, int, Dict[str, float]]]:
     van_json: Dict[str, Union[float, str, bool, int, Dict[str, float]]] = {
-        FIELD_GUID: str(tracker_session.van_guid),
-        FIELD_ALIVE: not tracker_session.dead
-        and not_stale(now, tracker_session.created_at),
-        FIELD_CREATED_AT: int(tracker_session.created_at.timestamp()),
-        FIELD_UPDATED_AT: int(tracker_session.updated_at.timestamp()),
+        FIELD_GUID: van.guid,
+        FIELD_ALIVE: van.is_alive(now),
+        FIELD_CREATED_AT: int(van.created_at.timestamp()),
+        FIELD_UPDATED_AT: int(van.updated_at.timestamp()),
     }
-    if FIELD_LOCATION in include_set:
-        location = query_most_recent_location(session, tracker_session)
-        if location is not None:
-            van_json[FIELD_LOCATION] = {
-                FIELD_LATITUDE: location.lat,
-                FIELD_LONGITUDE: location.lon,
-            }
+    if FIELD_LOCATION in include_set and van.located_at is not None:
+        van_json[FIELD_LOCATION] = {
+            FIELD_LATITUDE: van.lat,
+            FIELD_LONGITUDE: van.lon,
+        }
     if FIELD_COLOR in include_set:
-        route = (
-            session.query(Route).filter(Route.id == tracker_session.route_id).first()
-        )
-        van_json[FIELD_COLOR] = route.color
+        route = fleet.route(van.route_id)
+        if route is not None:
+            van_json[FIELD_COLOR] = route.color
     return van_json
 
 
 @router.websocket("/v2/arrivals/subscribe")
-async def subscribe_arrivals(websocket: WebSocket) -> None:
+async def subscribe_arrivals(
+    websocket: WebSocket,
+    since: Annotated[Optional[int], Query()] = None,
+    epoch: Annotated[Optional[int], Query()] = None,
+    subscribe: Annotated[bool, Query()] = False,
+) -> None:
+    """
+    Sends the arrivals for every stop filter received. A client reconnecting with the
+    epoch and sequence number of the last message it got as the since and epoch query
+    parameters is only sent the arrivals on routes that changed in between for its
+    first filter, where a null means there is no longer a van to arrive.
+
+    With subscribe set, a filter stays registered until the next one, and whenever a
+    van on one of its routes changes the client is sent the arrivals that changed in
+    the same form, at most once every few seconds.
+    """
     await websocket.accept()
-    while True:
-        try:
-            stop_filter: Dict[str, List[int]] = await websocket.receive_json()
-        except WebSocketDisconnect:
-            break
-        # Make sure stop filter confiorms to expected format
-        if not all(
-            isinstance(k, str) and isinstance(v, list) for k, v in stop_filter.items()
-        ):
-            await websocket.send_json(
-                {FIELD_TYPE: TYPE_ERROR, TYPE_ERROR: "Invalid stop filter"}
+    outbox = Outbox(websocket)
+    registry: ArrivalSubscriptionRegistry = websocket.app.state.arrival_subscriptions
+    subscription: Optional[ArrivalSubscription] = None
+    try:
+        while True:
+            try:
+                stop_filter: Dict[str, List[int]] = await websocket.receive_json()
+            except WebSocketDisconnect:
+                break
+            # Make sure stop filter confiorms to expected format
+            if not all(
+                isinstance(k, str) and isinstance(v, list)
+                for k, v in stop_filter.items()
+            ):
+                outbox.put(
+                    encode_json(
+                        {FIELD_TYPE: TYPE_ERROR, TYPE_ERROR: "Invalid stop filter"}
+                    )
+                )
+                continue
+            now = datetime.now(timezone.utc)
+            changes = query_changes(websocket.app.state, since, epoch)
+            since = None
+            if subscription is not None:
+                await leave_arrivals_subscription(registry, subscription, outbox)
+            stops = arrivals_key(stop_filter)
+            subscription = registry.join((stops, subscribe), outbox, stops)
+            if subscribe:
+                frame = join_arrivals_subscription(
+                    websocket.app.state, subscription, now, changes
+                )
+            else:
+                frame = query_arrivals_response(
+                    websocket.app.state, subscription, now, stop_filter, changes
+                )
+            # Full arrivals replace any the client has not received yet, but deltas
+            # only make sense on top of what came before them.
+            outbox.put(frame, snapshot=changes is None)
+    finally:
+        if subscription is not None:
+            await leave_arrivals_subscription(registry, subscription, outbox)
+        # The outbox may already have closed the connection of a slow client.
+        await outbox.close(disconnect=True)
+
+
+@router.get("/v2/arrivals/events")
+async def stream_arrivals(
+    req: Request,
+    stops: Annotated[List[str], Query()],
+    since: Optional[int] = None,
+    epoch: Optional[int] = None,
+) -> StreamingResponse:
+    """
+    Streams the arrivals at a set of stops as server-sent events, for clients that
+    cannot keep a websocket open. Every stop is given as its ID followed by the routes
+    asked about there, like 12:1,2, and the events are the frames sent to the standing
+    websocket subscriptions with the same stops.
+    """
+    stop_filter = parse_stop_filter(stops)
+    stream = EventStream()
+    outbox = Outbox(stream)
+
+    def join() -> Callable[[], Awaitable[None]]:
+        subscription, frame = open_arrivals_subscription(
+            req.app.state,
+            outbox,
+            stop_filter,
+            query_changes(req.app.state, since, epoch),
+        )
+        outbox.put(frame)
+        return partial(
+            leave_arrivals_subscription,
+            req.app.state.arrival_subscriptions,
+            subscription,
+            outbox,
+        )
+
+    return StreamingResponse(
+        stream_events(stream, outbox, join),
+        media_type="text/event-stream",
+        headers=EVENT_STREAM_HEADERS,
+    )
+
+
+@router.get("/v2/arrivals/poll")
+async def poll_arrivals(
+    req: Request,
+    stops: Annotated[List[str], Query()],
+    since: Optional[int] = None,
+    epoch: Optional[int] = None,
+) -> Response:
+    """
+    Long polls the arrivals at a set of stops, given like for the event stream. A
+    client that is not up to date is answered right away like a reconnecting
+    websocket, and one that is waits for the next change, or gets no content if
+    nothing changes for a while.
+    """
+    result = PollResult()
+    outbox = Outbox(result)
+    changes = query_changes(req.app.state, since, epoch)
+    subscription, frame = open_arrivals_subscription(
+        req.app.state, outbox, parse_stop_filter(stops), changes
+    )
+    response: Optional[Frame] = frame
+    try:
+        # Vans elsewhere in the fleet may have changed, but none on the routes asked
+        # about.
+        if changes is not None and changes.route_ids.isdisjoint(subscription.route_ids):
+            response = await result.wait(POLL_TIMEOUT)
+    finally:
+        await outbox.close()
+        await leave_arrivals_subscription(
+            req.app.state.arrival_subscriptions, subscription, outbox
+        )
+    return poll_response(response)
+
+
+def parse_stop_filter(stops: List[str]) -> Dict[str, List[int]]:
+    """
+    Turns stops given as query parameters into the stop filter a websocket would
+    send.
+    """
+    stop_filter: Dict[str, List[int]] = {}
+    try:
+        for stop in stops:
+            stop_id, route_ids = stop.split(":")
+            stop_filter.setdefault(str(int(stop_id)), []).extend(
+                int(route_id) for route_id in route_ids.split(",")
             )
-            continue
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail="Invalid stop filter") from e
+    return stop_filter
+
+
+def open_arrivals_subscription(
+    state: Any,
+    outbox: Outbox,
+    stop_filter: Dict[str, List[int]],
+    changes: Optional[ChangeSet],
+) -> Tuple[ArrivalSubscription, Frame]:
+    """
+    Joins the standing subscription for a stop filter, and returns it along with the
+    first message for the client, which only covers the changes given if it is
+    reconnecting.
+    """
+    registry: ArrivalSubscriptionRegistry = state.arrival_subscriptions
+    stops = arrivals_key(stop_filter)
+    subscription = registry.join((stops, True), outbox, stops)
+    now = datetime.now(timezone.utc)
+    return subscription, join_arrivals_subscription(state, subscription, now, changes)
+
+
+def arrivals_key(stop_filter: Dict[str, List[int]]) -> StopFilter:
+    """
+    Returns the canonical form of a stop filter, which is the same for every filter
+    asking for the same arrivals however it was written.
+    """
+    return tuple(
+        sorted(
+            (int(stop_id), tuple(sorted(set(route_ids))))
+            for stop_id, route_ids in stop_filter.items()
+        )
+    )
+
+
+def query_arrivals_response(
+    state: Any,
+    subscription: ArrivalSubscription,
+    now: datetime,
+    stop_filter: Dict[str, List[int]],
+    changes: Optional[ChangeSet],
+) -> Frame:
+    fleet: FleetState = state.fleet
+    if changes is None:
+        return query_shared_arrivals(
+            state.arrivals, fleet, subscription, now, stop_filter
+        )
+    return encode_json(
+        {
+            FIELD_TYPE: TYPE_DELTA,
+            FIELD_EPOCH: fleet.epoch,
+            FIELD_SEQUENCE: fleet.sequence,
+            FIELD_ARRIVALS: query_arrivals_delta(
+                state.arrivals, now, stop_filter, changes.route_ids
+            ),
+        }
+    )
+
+
+def query_shared_arrivals(
+    arrivals: ArrivalEngine,
+    fleet: FleetState,
+    subscription: ArrivalSubscription,
+    now: datetime,
+    stop_filter: Dict[str, List[int]],
+) -> Frame:
+    """
+    Returns the arrivals of a stop filter, serialized. Clients with the same filter
+    share the frame until a van on one of its routes changes or the arrivals tick runs
+    out.
+    """
+    if (
+        subscription.frame is None
+        or subscription.computed_at is None
+        or now - subscription.computed_at >= ARRIVALS_TICK
+    ):
+        subscription.frame = encode_json(
+            {
+                FIELD_TYPE: FIELD_ARRIVALS,
+                FIELD_EPOCH: fleet.epoch,
+                FIELD_SEQUENCE: fleet.sequence,
+                FIELD_ARRIVALS: query_arrivals(arrivals, now, stop_filter),
+            }
+        )
+        subscription.computed_at = now
+    return subscription.frame
+
+
+def join_arrivals_subscription(
+    state: Any,
+    subscription: ArrivalSubscription,
+    now: datetime,
+    changes: Optional[ChangeSet],
+) -> Frame:
+    """
+    Starts pushing to a standing subscription if the client is the first one with its
+    filter, and returns the first message for the client, which is what was last sent
+    to everyone else or, for a reconnecting client, what changed on its routes since.
+    """
+    fleet: FleetState = state.fleet
+    if subscription.task is None:
+        subscription.sent = {}
+        update_arrivals(state.arrivals, now, subscription, subscription.route_ids)
+        subscription.sequence = fleet.sequence
+        subscription.task = asyncio.create_task(
+            push_arrivals_subscription(state.arrivals, fleet, subscription)
+        )
+    if changes is None:
+        return query_arrivals_snapshot(fleet, subscription)
+    sent = subscription.sent
+    assert sent is not None
+    arrivals_json: Dict[int, Dict[int, Optional[float]]] = {}
+    for stop_id, route_ids in subscription.stops:
+        stop_sent = sent.get(stop_id, {})
+        for route_id in route_ids:
+            if route_id in changes.route_ids:
+                arrivals_json.setdefault(stop_id, {})[route_id] = stop_sent.get(
+                    route_id
+                )
+    return encode_arrivals_delta(fleet, subscription, arrivals_json)
+
+
+async def leave_arrivals_subscription(
+    registry: ArrivalSubscriptionRegistry,
+    subscription: ArrivalSubscription,
+    outbox: Outbox,
+) -> None:
+    if registry.leave(subscription, outbox) and subscription.task is not None:
+        await cancel_task(subscription.task)
+
+
+async def push_arrivals_subscription(
+    arrivals: ArrivalEngine, fleet: FleetState, subscription: ArrivalSubscription
+) -> None:
+    """
+    Recomputes the arrivals of a standing subscription on the routes that changed, and
+    puts the ones that differ from what was last sent on every client's outbox. After
+    every push it holds off for a while, so that a client is pushed to at most once
+    per interval and the changes in between go out together.
+    """
+    while True:
+        route_ids = await subscription.wait(ARRIVALS_REFRESH_INTERVAL)
         now = datetime.now(timezone.utc)
-        with websocket.app.state.db.session() as session:
-            try:
-                arrivals = query_arrivals(session, now, stop_filter)
-            except Exception as e:
-                await websocket.close()
-                raise e
-            response = {FIELD_TYPE: FIELD_ARRIVALS, FIELD_ARRIVALS: arrivals}
-            await websocket.send_json(response)
-    await websocket.close()
+        changed = update_arrivals(arrivals, now, subscription, route_ids)
+        subscription.sequence = fleet.sequence
+        if not changed:
+            continue
+        frame = encode_arrivals_delta(fleet, subscription, changed)
+        snapshot: Optional[Frame] = None
+        for outbox in subscription.members:
+            if outbox.put(frame):
+                continue
+            # The client fell too far behind to take another delta, so it starts over
+            # from everything instead.
+            if snapshot is None:
+                snapshot = query_arrivals_snapshot(fleet, subscription)
+            outbox.put(snapshot, snapshot=True)
+        await asyncio.sleep(ARRIVALS_PUSH_INTERVAL)
+
+
+def update_arrivals(
+    arrivals: ArrivalEngine,
+    now: datetime,
+    subscription: ArrivalSubscription,
+    route_ids: AbstractSet[int],
+) -> Dict[int, Dict[int, Optional[float]]]:
+    """
+    Recomputes the arrivals of a standing subscription at the stops on the given
+    routes, and returns the ones that differ from what was last sent, with None where
+    there is no longer a van to arrive.
+    """
+    sent = subscription.sent
+    assert sent is not None
+    changed: Dict[int, Dict[int, Optional[float]]] = {}
+    for stop_id, stop_route_ids in subscription.stops:
+        for route_id in stop_route_ids:
+            if route_id not in route_ids:
+                continue
+            seconds = arrivals.seconds_to(route_id, stop_id, now)
+            stop_sent = sent.get(stop_id)
+            if seconds == (stop_sent.get(route_id) if stop_sent else None):
+                continue
+            if seconds is not None:
+                sent.setdefault(stop_id, {})[route_id] = seconds
+            elif stop_sent is not None:
+                del stop_sent[route_id]
+                if not stop_sent:
+                    del sent[stop_id]
+            changed.setdefault(stop_id, {})[route_id] = seconds
+    if changed:
+        subscription.frame = None
+    return changed
+
+
+def query_arrivals_snapshot(
+    fleet: FleetState, subscription: ArrivalSubscription
+) -> Frame:
+    """
+    Returns everything last sent to the clients of a standing subscription, for a
+    client that joins it or falls too far behind.
+    """
+    if subscription.frame is None:
+        subscription.frame = encode_json(
+            {
+                FIELD_TYPE: FIELD_ARRIVALS,
+                FIELD_EPOCH: fleet.epoch,
+                FIELD_SEQUENCE: subscription.sequence,
+                FIELD_ARRIVALS: subscription.sent,
+            }
+        )
+    return subscription.frame
+
+
+def encode_arrivals_delta(
+    fleet: FleetState,
+    subscription: ArrivalSubscription,
+    arrivals_json: Dict[int, Dict[int, Optional[float]]],
+) -> Frame:
+    return encode_json(
+        {
+            FIELD_TYPE: TYPE_DELTA,
+            FIELD_EPOCH: fleet.epoch,
+            FIELD_SEQUENCE: subscription.sequence,
+            FIELD_ARRIVALS: arrivals_json,
+        }
+    )
 
 
 def query_arrivals(
-    session, now: datetime, stop_filter: Dict[str, List[int]]
-) -> Dict[int, Dict[int, int]]:
-    arrivals_json: Dict[int, Dict[int, int]] = {}
+    arrivals: ArrivalEngine, now: datetime, stop_filter: Dict[str, List[int]]
+) -> Dict[int, Dict[int, float]]:
+    arrivals_json: Dict[int, Dict[int, float]] = {}
     for stop_id_str in stop_filter:
         stop_id = int(stop_id_str)
-        stop_arrivals_json: Dict[int, int] = {}
+        stop_arrivals_json: Dict[int, float] = {}
         for route_id in stop_filter[stop_id_str]:
-            stops = (
-                session.query(Stop)
-                .join(RouteStop)
-                .filter(RouteStop.route_id == route_id)
-                .order_by(RouteStop.position)
-                .all()
-            )
-            if not stops:
-                continue
-            stop_index = next(
-                (index for index, stop in enumerate(stops) if stop.id == stop_id),
-                None,
-            )
-            if stop_index is None:
-                continue
-            distance_m = calculate_van_distance(
-                session, now, stops, stop_index, route_id
-            )
-            if not distance_m:
-                continue
-            stop_arrivals_json[route_id] = distance_m / AVERAGE_VAN_SPEED_MPS
+            seconds = arrivals.seconds_to(route_id, stop_id, now)
+            if seconds is not None:
+                stop_arrivals_json[route_id] = seconds
         if stop_arrivals_json:
             arrivals_json[stop_id] = stop_arrivals_json
     return arrivals_json
 
 
-def calculate_van_distance(
-    session, now: datetime, stops: List[Stop], stop_index: int, route_id: int
-):
-    current_distance = 0.0
-    current_stop = stops[stop_index]
-    start = stop_index
-    while True:
-        arriving_session = active_session_query(
-            session,
-            now,
-            VanTrackerSession.route_id == route_id,
-            VanTrackerSession.stop_index == (stop_index - 1) % len(stops),
-        ).first()
-        if arriving_session is not None:
-            location = query_most_recent_location(session, arriving_session)
-            if location is not None:
-                current_distance += distance_meters(
-                    location.lat,
-                    location.lon,
-                    current_stop.lat,
-                    current_stop.lon,
-                )
-                return current_distance
-        # backtrack by decrementing stop_index, wrapping around if necessary
-        stop_index = (stop_index - 1) % len(stops)
-        if stop_index == start:
-            break
-        last_stop = current_stop
-        current_stop = stops[stop_index]
-        current_distance += distance_meters(
-            last_stop.lat,
-            last_stop.lon,
-            current_stop.lat,
-            current_stop.lon,
-        )
+def query_arrivals_delta(
+    arrivals: ArrivalEngine,
+    now: datetime,
+    stop_filter: Dict[str, List[int]],
+    route_ids: FrozenSet[int],
+) -> Dict[int, Dict[int, Optional[float]]]:
+    """
+    Returns the arrivals of a stop filter on the given routes only, with None where no
+    van is arriving anymore.
+    """
+    arrivals_json: Dict[int, Dict[int, Optional[float]]] = {}
+    for stop_id_str, stop_route_ids in stop_filter.items():
+        stop_id = int(stop_id_str)
+        stop_arrivals_json = {
+            route_id: arrivals.seconds_to(route_id, stop_id, now)
+            for route_id in stop_route_ids
+            if route_id in route_ids
+        }
+        if stop_arrivals_json:
+            arrivals_json[stop_id] = stop_arrivals_json
+    return arrivals_json
 
 
 @router.post("/routeselect/{van_guid}")  # Called routeselect for backwards compat
 async def begin_session(req: Request, van_guid: str) -> HardwareOKResponse:
-    body = await req.body()
-    route_id = struct.unpack("<i", body)
+    await accept_session(req.app.state, van_guid, await req.body())
+    return HardwareOKResponse()
 
-    with req.app.state.db.session() as session:
+
+async def accept_session(state: Any, van_guid: str, body: bytes) -> None:
+    """
+    Starts a new tracker session for a van on the route packed in the body, ending
+    every earlier one.
+    """
+    (route_id,) = struct.unpack("<i", body)
+
+    with state.db.session() as session:
         if not session.query(Route).filter_by(id=route_id).first():
             raise HardwareHTTPException(
                 status_code=400, error_code=HardwareErrorCode.INVALID_ROUTE_ID
@@ -424,17 +1520,56 @@ async def begin_session(req: Request, van_guid: str) -> HardwareOKResponse:
         session.add(new_van_tracker_session)
         session.commit()
 
-    return HardwareOKResponse()
+        state.fleet.begin_session(new_van_tracker_session)
 
 
 @router.post("/location/{van_guid}")
 async def post_location(req: Request, van_guid: str) -> HardwareOKResponse:
-    # byte body: long long for timestamp, double for lat, double for lon
-    body = await req.body()
-    timestamp_ms, lat, lon = struct.unpack("<Qdd", body)
-    timestamp = datetime.fromtimestamp(timestamp_ms / 1000.0, timezone.utc)
+    await accept_location(req.app.state, van_guid, await req.body())
+    return HardwareOKResponse()
+
+
+async def accept_location(state: Any, van_guid: str, body: bytes) -> None:
+    """
+    Validates and ingests the single location packed in the body.
+    """
+    timestamp_ms, lat, lon = struct.unpack(LOCATION_FORMAT, body)
+    now = datetime.now(timezone.utc)
+    fix = validate_location(now, timestamp_ms, lat, lon)
+    await ingest_locations(state, now, van_guid, [fix])
+
+
+@router.post("/location/{van_guid}/batch")
+async def post_location_batch(req: Request, van_guid: str) -> HardwareOKResponse:
+    """
+    ## Upload several locations at once <br>
+    A batch variant of the location route for trackers that buffer their fixes. The
+    body is a packed array of the same records the single location route accepts,
+    in any order. If any fix fails validation, the whole batch is rejected with that
+    fix's error code and nothing is stored.
+    """
+
+    await accept_location_batch(req.app.state, van_guid, await req.body())
+    return HardwareOKResponse()
 
+
+async def accept_location_batch(state: Any, van_guid: str, body: bytes) -> None:
+    """
+    Validates and ingests every location packed in the body, or none of them.
+    """
     now = datetime.now(timezone.utc)
+    fixes = sorted(
+        validate_location(now, timestamp_ms, lat, lon)
+        for timestamp_ms, lat, lon in struct.iter_unpack(LOCATION_FORMAT, body)
+    )
+    if fixes:
+        await ingest_locations(state, now, van_guid, fixes)
+
+
+def validate_location(
+    now: datetime, timestamp_ms: int, lat: float, lon: float
+) -> LocationFix:
+    timestamp = datetime.fromtimestamp(timestamp_ms / 1000.0, timezone.utc)
 
     # Check that the timestamp is not too far in the past. This implies a statistics
     # update that was delayed in transit and may be irrelevant now.
@@ -450,141 +1585,39 @@ async def post_location(req: Request, van_guid: str) -> HardwareOKResponse:
             status_code=400, error_code=HardwareErrorCode.TIMESTAMP_IN_FUTURE
         )
 
-    with req.app.state.db.session() as session:
-        tracker_session = active_session_query(
-            session, now, VanTrackerSession.van_guid == van_guid
-        ).first()
-        if tracker_session is None:
-            raise HardwareHTTPException(
-                status_code=400, error_code=HardwareErrorCode.CREATE_NEW_SESSION
-            )
+    return LocationFix(timestamp, lat, lon)
 
-        stops = (
-            session.query(Stop)  # Query Stop instead of RouteStop
-            .join(RouteStop, RouteStop.stop_id == Stop.id)
-            .filter(RouteStop.route_id == tracker_session.route_id)
-            .order_by(RouteStop.position)
-            .all()
-        )
 
-        # Add location to session
-        new_location = VanLocation(
-            session_id=tracker_session.id, created_at=timestamp, lat=lat, lon=lon
-        )
-        session.add(new_location)
-
-        if tracker_session.created_at == tracker_session.updated_at:
-            stop_pairs = []
-            for i in range(len(stops) - 1):
-                left, right = stops[i], stops[i + 1]
-                l_distance = distance_meters(lat, lon, left.lat, left.lon)
-                r_distance = distance_meters(lat, lon, right.lat, right.lon)
-                stop_pairs.append((i, i + 1, l_distance, r_distance))
-            closest_stop_pair = min(stop_pairs, key=lambda x: min(x[2], x[3]))
-            if closest_stop_pair[2] >= closest_stop_pair[3]:
-                tracker_session.stop_index = closest_stop_pair[1]
-            else:
-                tracker_session.stop_index = closest_stop_pair[0]
-
-        tracker_session.updated_at = timestamp
-        session.commit()
+async def ingest_locations(
+    state: Any, now: datetime, van_guid: str, fixes: List[LocationFix]
+) -> None:
+    """
+    Accepts fixes for a van, ordered from oldest to newest. The fleet state is
+    updated right away, while the database writes and stop detection happen behind
+    the response in the ingest pipeline.
+    """
 
-        # To find an accurate time estimate for a stop, we need to remove vans that are not arriving at a stop, either
-        # because they aren't arriving at the stop or because they have departed it. We achieve this currently by
-        # implementing a state machine that tracks the (guessed) current stop of each van. We can then use that to find
-        # the next logical stop and estimate the time to arrive to that.
-
-        # We want to consider all of the stops that are coming up for this van, as that allows to handle cases where a
-        # stop is erroneously skipped. Also make sure we include subsequent stops that wrap around. The wrap around slice
-        # needs to be bounded to 0 to prevent a negative index causing weird slicing behavior.
-        subsequent_stops = (
-            stops[tracker_session.stop_index + 1 :]
-            + stops[: max(tracker_session.stop_index - 1, 0)]
+    fleet: FleetState = state.fleet
+    van = fleet.active_van(van_guid, now)
+    if van is None:
+        raise HardwareHTTPException(
+            status_code=400, error_code=HardwareErrorCode.CREATE_NEW_SESSION
         )
-        locations = (
-            session.query(VanLocation)
-            .filter(
-                VanLocation.session_id == tracker_session.id,
-                VanLocation.created_at > now - timedelta(seconds=300),
+
+    stop_index = van.stop_index
+    if van.located_at is None:
+        route = fleet.route(van.route_id)
+        if route is not None:
+            stop_index = initial_stop_index(
+                route.index, fixes[0].lat, fixes[0].lon, stop_index
             )
-            .order_by(VanLocation.created_at)
-        )
-        for i, stop in enumerate(subsequent_stops):
-            longest_subset: List[datetime] = []
-            current_subset: List[datetime] = []
-
-            # Find the longest consequtive subset (i.e streak) where the distance of the past couple of
-            # van locations is consistently within this stop's radius.
-            for location in locations:
-                stop_distance_meters = distance_meters(
-                    location.lat,
-                    location.lon,
-                    stop.lat,
-                    stop.lon,
-                )
-                if stop_distance_meters < THRESHOLD_RADIUS_M:
-                    current_subset.append(location.created_at)
-                else:
-                    if len(current_subset) > len(longest_subset):
-                        longest_subset = current_subset
-                    current_subset = []
-            if len(current_subset) > len(longest_subset):
-                longest_subset = current_subset
-
-            if longest_subset:
-                # A streak exists, find the overall duration that this van was within the stop's radius. Since locations
-                # are ordered from oldest to newest, we can just subtract the first and last timestamps.
-                duration = longest_subset[-1] - longest_subset[0]
-            else:
-                # No streak, so we weren't at the stop for any amount of time.
-                duration = timedelta(seconds=0)
-
-            if duration >= THRESHOLD_TIME:
-                # We were at this stop for long enough, move to it. Since the stops iterated through are relative to the
-                # current stop, we have to add the current stop index to the current index in the loop to get the actual
-                # stop index.
-                # Note: It's possible that the van was at another stop's radius for even longer, but this is not considered
-                # until real-world testing shows this edge case to be important.
-                tracker_session.stop_index = (tracker_session.stop_index + i + 1) % len(
-                    stops
-                )
-                session.commit()
-                break
 
-    return HardwareOKResponse()
+    latest = fixes[-1]
+    fleet.record_fix(van, latest.timestamp, latest.lat, latest.lon, stop_index)
 
-
-def active_session_query(session, now: datetime, *filters):
-    query = session.query(VanTrackerSession).filter(
-        VanTrackerSession.dead == False,
-        not_stale(now, VanTrackerSession.created_at),
-        *filters
-    )
-    return query
+    pipeline: IngestPipeline = state.ingest
+    await pipeline.submit(IngestItem(van.session_id, van.guid, fixes))
 
 
 def not_stale(now: datetime, datetimeish) -> bool:
-    return now - datetimeish < timedelta(hours=12)
-
-
-def query_most_recent_location(
-    session, tracker_session: VanTrackerSession
-) -> VanLocation:
-    return (
-        session.query(VanLocation)
-        .filter_by(session_id=tracker_session.id)
-        .order_by(VanLocation.created_at.desc())
-        .first()
-    )
-
-
-def distance_meters(alat: float, alon: float, blat: float, blon: float) -> float:
-    dlat = blat - alat
-    dlon = blon - alon
-
-    # Simplified distance calculation that assumes the earth is a sphere. This is good enough for our purposes.
-    # https://stackoverflow.com/a/39540339
-    dlatkm = dlat * KM_LAT_RATIO
-    dlonkm = dlon * EARTH_CIRCUFERENCE_KM * cos(radians(alat)) / DEGREES_IN_CIRCLE
-
-    return sqrt(dlatkm**2 + dlonkm**2) * 1000
+    return now - datetimeish < SESSION_LIFETIME
@@ -9,6 +9,9 @@ from enum import Enum
 from fastapi import Request
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.responses import Response
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+OCTET_STREAM = (b"content-type", b"application/octet-stream")
 
 
 class HardwareOKResponse(Response):
@@ -44,6 +47,12 @@ class HardwareErrorCode(Enum):
     ROUTE_NAME_TOO_LONG = 6
     CREATE_NEW_SESSION = 7
     INVALID_ROUTE_ID = 8
+    # Only sent over a connection kept open, in place of a 500 over HTTP.
+    SERVER_ERROR = 9
+
+
+def pack_error_code(error_code: HardwareErrorCode) -> bytes:
+    return struct.pack("!b", error_code.value)
 
 
 class HardwareHTTPException(Exception):
@@ -71,7 +80,7 @@ class HardwareExceptionMiddleware(BaseHTTPMiddleware):
         except HardwareHTTPException as exc:
             # Is a hardware error, respond with a packed error code byte.
             response = Response(
-                content=struct.pack("!b", exc.error_code.value),
+                content=pack_error_code(exc.error_code),
                 status_code=exc.status_code,
                 media_type="application/octet-stream",
             )
@@ -79,3 +88,35 @@ class HardwareExceptionMiddleware(BaseHTTPMiddleware):
             # Forward exception to base middleware (hopefully the default error handler)
             raise exc
         return response
+
+
+async def send_octets(send: Send, status_code: int, body: bytes = b"") -> None:
+    """
+    Sends a whole binary response straight over ASGI, without building a Response.
+    """
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": [(b"content-length", str(len(body)).encode()), OCTET_STREAM],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+class HardwareErrorTranslator:
+    """
+    Does what HardwareExceptionMiddleware does as a bare ASGI middleware, which costs
+    a try block instead of a task and a pair of streams for every request. The app
+    it wraps must not start a response before it is done raising, which holds for
+    the hardware routes since they respond only once the body was handled.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await self.app(scope, receive, send)
+        except HardwareHTTPException as exc:
+            await send_octets(send, exc.status_code, pack_error_code(exc.error_code))
@@ -1,11 +1,28 @@
+import asyncio
+import os
+from datetime import datetime, timezone
+
 from dotenv import load_dotenv
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from .db import DBWrapper
-from .handlers import ada, alert, analytics, routes, stops, vans
+from .handlers import ada, alert, analytics, hardware, routes, stops, vans
 from .hardware import HardwareExceptionMiddleware
 from .model.van_tracker_session import VanTrackerSession
+from .vantracking.arrivals import ArrivalEngine
+from .vantracking.broadcast import FORMAT_BINARY, FORMAT_JSON, Broadcaster, encode_json
+from .vantracking.bus import FleetBus, PostgresTransport
+from .vantracking.changelog import ChangeLog
+from .vantracking.compaction import TrailCompactor, run_compaction
+from .vantracking.ingest import IngestPipeline
+from .vantracking.jobs import WorkerRegistration
+from .vantracking.retention import LocationPartitions, run_retention
+from .vantracking.state import FleetState
+from .vantracking.subscriptions import (
+    ArrivalSubscriptionRegistry,
+    VanSubscriptionRegistry,
+)
 
 load_dotenv()
 
@@ -20,19 +37,90 @@ app.add_middleware(
 )
 
 app.add_middleware(HardwareExceptionMiddleware)
+# Added last so that it runs first, and hardware requests skip the middleware above.
+app.add_middleware(hardware.HardwareFastPath)
 app.include_router(ada.router)
 app.include_router(routes.router)
 app.include_router(stops.router)
 app.include_router(alert.router)
 app.include_router(analytics.router)
 app.include_router(vans.router)
+app.include_router(hardware.router)
 
 
 @app.on_event("startup")
 def startup_event():
     app.state.db = DBWrapper()
+    app.state.fleet = FleetState()
+    app.state.change_log = ChangeLog()
+    app.state.fleet.add_listener(app.state.change_log.notify)
+    app.state.ingest = IngestPipeline(app.state.db, app.state.fleet)
+    # Running more than one worker needs every change to reach every worker, which
+    # goes through Postgres.
+    app.state.fleet_bus = None
+    if os.environ.get("FLEET_BUS") == "postgres":
+        app.state.fleet_bus = FleetBus(
+            app.state.fleet, PostgresTransport(app.state.db.engine), app.state.db
+        )
+        app.state.fleet.add_listener(app.state.fleet_bus.notify)
+    app.state.van_subscriptions = VanSubscriptionRegistry()
+    app.state.fleet.add_listener(app.state.van_subscriptions.notify)
+    app.state.arrival_subscriptions = ArrivalSubscriptionRegistry()
+    app.state.fleet.add_listener(app.state.arrival_subscriptions.notify)
+    app.state.arrivals = ArrivalEngine(app.state.fleet)
+    app.state.fleet.add_listener(app.state.arrivals.notify)
+    app.state.location_broadcaster = Broadcaster(
+        lambda: vans.query_locations_v1(app.state.fleet, datetime.now(timezone.utc)),
+        interval=2,
+        encoders={FORMAT_JSON: encode_json, FORMAT_BINARY: vans.encode_locations_v1},
+    )
+    app.state.location_partitions = LocationPartitions()
+    app.state.trail_compactor = TrailCompactor()
+    # Only the first worker to start cleans up after the last run, or it would kill
+    # the sessions that trackers just began on the others.
+    app.state.workers = WorkerRegistration(app.state.db)
+    app.state.workers.join(clean_up_last_run)
+    with app.state.db.session() as session:
+        app.state.fleet.load(session)
+
+
+def clean_up_last_run():
     with app.state.db.session() as session:
+        # Locations must always have a partition to land in.
+        app.state.location_partitions.ensure(session, datetime.now(timezone.utc))
         tracker_sessions = session.query(VanTrackerSession).all()
         for tracker_session in tracker_sessions:
             tracker_session.dead = True
         session.commit()
+
+
+@app.on_event("startup")
+async def start_jobs():
+    if app.state.fleet_bus is not None:
+        await app.state.fleet_bus.start()
+    app.state.retention = asyncio.create_task(
+        run_retention(app.state.db, app.state.location_partitions)
+    )
+    app.state.compaction = asyncio.create_task(
+        run_compaction(app.state.db, app.state.trail_compactor)
+    )
+    # Trackers can also keep a raw TCP connection open, if a port is set aside for it.
+    app.state.hardware_server = None
+    if "HARDWARE_TCP_PORT" in os.environ:
+        app.state.hardware_server = hardware.TcpTrackerServer(app.state)
+        await app.state.hardware_server.start(
+            "0.0.0.0", int(os.environ["HARDWARE_TCP_PORT"])
+        )
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    app.state.retention.cancel()
+    app.state.compaction.cancel()
+    if app.state.hardware_server is not None:
+        await app.state.hardware_server.close()
+    # Make sure every accepted location reaches the database before exiting.
+    await app.state.ingest.close()
+    if app.state.fleet_bus is not None:
+        await app.state.fleet_bus.close()
+    app.state.workers.close()
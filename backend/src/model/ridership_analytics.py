@@ -1,6 +1,6 @@
 from datetime import datetime
 
-from sqlalchemy import ForeignKeyConstraint, UniqueConstraint
+from sqlalchemy import ForeignKeyConstraint, Index, UniqueConstraint
 from sqlalchemy.orm import Mapped, mapped_column
 from src.db import Base
 from src.model.types import TZDateTime
@@ -12,6 +12,8 @@ class RidershipAnalytics(Base):
         ForeignKeyConstraint(["session_id"], ["van_tracker_session.id"]),
         ForeignKeyConstraint(["route_id"], ["routes.id"]),
         UniqueConstraint("session_id", "datetime"),
+        Index("ix_ridership_analytics_route_id_datetime", "route_id", "datetime"),
+        Index("ix_ridership_analytics_datetime", "datetime"),
     )
     id: Mapped[int] = mapped_column(
         primary_key=True, autoincrement=True, nullable=False
@@ -1,8 +1,13 @@
+import re
+
 from sqlalchemy import String, UniqueConstraint
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from src.db import Base
 from src.model.waypoint import Waypoint  # pylint: disable=unused-import
 
+# Route colors are #RRGGBB, which Postgres checks on write.
+COLOR_PATTERN = re.compile("#[A-Fa-f0-9]{6}")
+
 
 class Route(Base):
     __tablename__ = "routes"
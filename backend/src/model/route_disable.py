@@ -1,4 +1,4 @@
-from sqlalchemy import ForeignKeyConstraint
+from sqlalchemy import ForeignKeyConstraint, Index
 from sqlalchemy.orm import Mapped, mapped_column
 from src.db import Base
 
@@ -8,6 +8,8 @@ class RouteDisable(Base):
     __table_args__ = (
         ForeignKeyConstraint(["alert_id"], ["alerts.id"]),
         ForeignKeyConstraint(["route_id"], ["routes.id"]),
+        Index("ix_route_disables_alert_id_route_id", "alert_id", "route_id"),
+        Index("ix_route_disables_route_id", "route_id"),
     )
     id: Mapped[int] = mapped_column(
         primary_key=True, autoincrement=True, nullable=False
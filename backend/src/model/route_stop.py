@@ -1,4 +1,4 @@
-from sqlalchemy import ForeignKeyConstraint, UniqueConstraint
+from sqlalchemy import ForeignKeyConstraint, Index, UniqueConstraint
 from sqlalchemy.orm import Mapped, mapped_column
 from src.db import Base
 
@@ -9,6 +9,8 @@ class RouteStop(Base):
         ForeignKeyConstraint(["route_id"], ["routes.id"]),
         ForeignKeyConstraint(["stop_id"], ["stops.id"]),
         UniqueConstraint("route_id", "stop_id"),
+        Index("ix_route_stops_route_id_position", "route_id", "position"),
+        Index("ix_route_stops_stop_id", "stop_id"),
     )
     id: Mapped[int] = mapped_column(
         primary_key=True, autoincrement=True, nullable=False
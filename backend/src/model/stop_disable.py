@@ -1,4 +1,4 @@
-from sqlalchemy import ForeignKeyConstraint
+from sqlalchemy import ForeignKeyConstraint, Index
 from sqlalchemy.orm import Mapped, mapped_column
 from src.db import Base
 
@@ -8,6 +8,8 @@ class StopDisable(Base):
     __table_args__ = (
         ForeignKeyConstraint(["alert_id"], ["alerts.id"]),
         ForeignKeyConstraint(["stop_id"], ["stops.id"]),
+        Index("ix_stop_disables_alert_id_stop_id", "alert_id", "stop_id"),
+        Index("ix_stop_disables_stop_id", "stop_id"),
     )
     id: Mapped[int] = mapped_column(
         primary_key=True, autoincrement=True, nullable=False
@@ -1,6 +1,6 @@
 from datetime import datetime
 
-from sqlalchemy import ForeignKey, ForeignKeyConstraint, func
+from sqlalchemy import ForeignKey, ForeignKeyConstraint, Index, func
 from sqlalchemy.orm import Mapped, mapped_column
 from sqlalchemy.sql import func
 from src.db import Base
@@ -9,7 +9,10 @@ from src.model.types import TZDateTime
 
 class VanLocation(Base):
     __tablename__ = "van_location"
-    __table_args__ = (ForeignKeyConstraint(["session_id"], ["van_tracker_session.id"]),)
+    __table_args__ = (
+        ForeignKeyConstraint(["session_id"], ["van_tracker_session.id"]),
+        Index("ix_van_location_session_id_created_at", "session_id", "created_at"),
+    )
 
     id: Mapped[int] = mapped_column(
         primary_key=True, autoincrement=True, nullable=False
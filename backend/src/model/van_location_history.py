@@ -0,0 +1,40 @@
+from datetime import datetime
+
+from sqlalchemy import ForeignKeyConstraint, UniqueConstraint
+from sqlalchemy.orm import Mapped, mapped_column
+from src.db import Base
+from src.model.types import TZDateTime
+
+
+class VanLocationHistory(Base):
+    """
+    Locations older than the retention period, averaged over every minute of a session.
+    """
+
+    __tablename__ = "van_location_history"
+    __table_args__ = (
+        ForeignKeyConstraint(["session_id"], ["van_tracker_session.id"]),
+        UniqueConstraint("session_id", "bucket"),
+    )
+
+    id: Mapped[int] = mapped_column(
+        primary_key=True, autoincrement=True, nullable=False
+    )
+    session_id: Mapped[int] = mapped_column(nullable=False)
+    bucket: Mapped[datetime] = mapped_column(TZDateTime, nullable=False)
+    lat: Mapped[float] = mapped_column(nullable=False)
+    lon: Mapped[float] = mapped_column(nullable=False)
+    samples: Mapped[int] = mapped_column(nullable=False)
+
+    def __eq__(self, other: object) -> bool:
+        return (
+            isinstance(other, VanLocationHistory)
+            and self.session_id == other.session_id
+            and self.bucket == other.bucket
+            and self.lat == other.lat
+            and self.lon == other.lon
+            and self.samples == other.samples
+        )
+
+    def __repr__(self) -> str:
+        return f"<VanLocationHistory id={self.id} session_id={self.session_id} bucket={self.bucket} lat={self.lat} lon={self.lon} samples={self.samples}>"
@@ -1,6 +1,6 @@
 from datetime import datetime
 
-from sqlalchemy import Boolean, Integer, String, func
+from sqlalchemy import Boolean, Index, Integer, String, func, text
 from sqlalchemy.orm import Mapped, mapped_column
 from sqlalchemy.sql import func
 from src.db import Base
@@ -9,6 +9,15 @@ from src.model.types import TZDateTime
 
 class VanTrackerSession(Base):
     __tablename__ = "van_tracker_session"
+    __table_args__ = (
+        Index("ix_van_tracker_session_van_guid_created_at", "van_guid", "created_at"),
+        Index(
+            "ix_van_tracker_session_alive",
+            "van_guid",
+            "created_at",
+            postgresql_where=text("dead = false"),
+        ),
+    )
 
     id: Mapped[int] = mapped_column(
         primary_key=True, autoincrement=True, nullable=False
@@ -0,0 +1,29 @@
+from datetime import datetime
+
+from sqlalchemy import ForeignKeyConstraint, LargeBinary
+from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy.sql import func
+from src.db import Base
+from src.model.types import TZDateTime
+
+
+class VanTrail(Base):
+    """
+    The simplified trajectory of a finished tracker session, packed into a single
+    binary column in place of its raw locations.
+    """
+
+    __tablename__ = "van_trail"
+    __table_args__ = (ForeignKeyConstraint(["session_id"], ["van_tracker_session.id"]),)
+
+    session_id: Mapped[int] = mapped_column(primary_key=True, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(
+        TZDateTime, nullable=False, server_default=func.now()  # pylint: disable=all
+    )
+    tolerance_m: Mapped[float] = mapped_column(nullable=False)
+    raw_count: Mapped[int] = mapped_column(nullable=False)
+    point_count: Mapped[int] = mapped_column(nullable=False)
+    points: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+
+    def __repr__(self) -> str:
+        return f"<VanTrail session_id={self.session_id} tolerance_m={self.tolerance_m} raw_count={self.raw_count} point_count={self.point_count}>"
@@ -0,0 +1,147 @@
+"""
+Defines the arrivals engine, which estimates when the next van will reach each stop.
+
+Every route keeps the distance of each of its stops along the route, measured once
+whenever the route network is loaded. A route's arrival times are then computed for
+all of its stops at once, in a single pass over its stops and vans, and reused until
+a van on the route changes or the tick runs out. Looking up an arrival is then just
+an index into that table.
+"""
+
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set
+
+import numpy as np
+from src.vantracking.geo import distances_between
+from src.vantracking.state import FleetState, RouteState, VanChange, VanState
+
+AVERAGE_VAN_SPEED_MPS = 8.9408  # 20 mph
+
+# Vans can also expire without any change to the fleet, so tables are recomputed at
+# least this often.
+ARRIVALS_TICK = timedelta(seconds=1)
+
+
+class RouteArrivals:
+    """
+    The arrival times of a route. Offsets hold the distance along the route from its
+    first stop to every stop, and length the distance of a whole loop.
+    """
+
+    __slots__ = ("route", "offsets", "length", "positions", "seconds", "computed_at")
+
+    def __init__(self, route: RouteState):
+        self.route = route
+        # The first segment closes the loop from the last stop back to the first one.
+        segments = route.points.segment_lengths()
+        self.offsets = np.zeros(len(segments))
+        np.cumsum(segments[1:], out=self.offsets[1:])
+        self.length = float(self.offsets[-1] + segments[0]) if len(segments) else 0.0
+        # A stop that appears more than once on a route is looked up by its first
+        # position.
+        self.positions: Dict[int, int] = {}
+        for i, stop in enumerate(route.stops):
+            self.positions.setdefault(stop.id, i)
+        self.seconds: List[Optional[float]] = [None] * len(segments)
+        self.computed_at: Optional[datetime] = None
+
+    def compute(self, vans: List[VanState], now: datetime) -> None:
+        count = len(self.offsets)
+        self.seconds = [None] * count
+        self.computed_at = now
+        if not count:
+            return
+
+        # Index the vans by the stop they are arriving at. If several vans are arriving
+        # at the same stop, the first one wins.
+        arriving: Dict[int, VanState] = {}
+        for van in vans:
+            if 0 <= van.stop_index < count:
+                arriving.setdefault((van.stop_index + 1) % count, van)
+        if not arriving:
+            return
+
+        # Distance from each arriving van to the stop it is arriving at.
+        positions = np.fromiter(arriving, int, len(arriving))
+        van_distances = np.zeros(count)
+        van_distances[positions] = distances_between(
+            np.fromiter((van.lat for van in arriving.values()), float, len(arriving)),
+            np.fromiter((van.lon for van in arriving.values()), float, len(arriving)),
+            self.route.points.lats[positions],
+            self.route.points.lons[positions],
+        )
+
+        # For every stop, find the closest stop at or before it that a van is arriving
+        # at. Stops before the first one wrap around to the last one.
+        last = np.full(count, -1)
+        last[positions] = positions
+        last = np.maximum.accumulate(last)
+        last[last < 0] = positions.max()
+
+        stops = np.arange(count)
+        along = self.offsets - self.offsets[last]
+        along[stops < last] += self.length
+        distances = along + van_distances[last]
+        self.seconds = [
+            distance_m / AVERAGE_VAN_SPEED_MPS if distance_m else None
+            for distance_m in distances.tolist()
+        ]
+
+
+class ArrivalEngine:
+    """
+    Holds the arrival times of every route. It is registered as a fleet state
+    listener so that a route is recomputed as soon as one of its vans changes.
+    """
+
+    def __init__(self, fleet: FleetState, tick: timedelta = ARRIVALS_TICK):
+        self._fleet = fleet
+        self._tick = tick
+        self._routes: Dict[int, RouteArrivals] = {}
+        self._dirty: Set[int] = set()
+
+    def notify(self, change: VanChange) -> None:
+        self._dirty.update(change.route_ids)
+
+    def route(self, route_id: int, now: datetime) -> Optional[RouteArrivals]:
+        """
+        Returns the arrival times of a route, recomputing them if they are out of date.
+        """
+        route = self._fleet.route(route_id)
+        if route is None:
+            return None
+        arrivals = self._routes.get(route_id)
+        if arrivals is None or arrivals.route is not route:
+            # The route network was reloaded, so the route has to be measured again.
+            arrivals = RouteArrivals(route)
+            self._routes[route_id] = arrivals
+        if (
+            route_id in self._dirty
+            or arrivals.computed_at is None
+            or now - arrivals.computed_at >= self._tick
+        ):
+            self._dirty.discard(route_id)
+            arrivals.compute(
+                [
+                    van
+                    for van in self._fleet.vans()
+                    if van.route_id == route_id
+                    and van.is_alive(now)
+                    and van.located_at is not None
+                ],
+                now,
+            )
+        return arrivals
+
+    def seconds_to(self, route_id: int, stop_id: int, now: datetime) -> Optional[float]:
+        """
+        Returns the estimated seconds until the next van on a route reaches a stop, or
+        None if there is no van to arrive.
+        """
+        arrivals = self.route(route_id, now)
+        if arrivals is None:
+            return None
+        position = arrivals.positions.get(stop_id)
+        if position is None:
+            return None
+        return arrivals.seconds[position]
@@ -0,0 +1,110 @@
+"""
+Defines a broadcaster that produces one frame per tick and sends that same frame to
+every connected websocket, rather than having each connection compute it separately.
+
+Clients pick a wire format when they connect. Each tick's payload is encoded once per
+format that has any clients, never once per client. Frames are put on every client's
+outbox, so a tick never waits on the slowest client.
+"""
+
+import asyncio
+import json
+import logging
+from typing import Any, Callable, Dict, Mapping, Optional
+
+from src.vantracking.outbox import Frame, Outbox
+
+FORMAT_JSON = "json"
+FORMAT_BINARY = "binary"
+
+logger = logging.getLogger(__name__)
+
+
+def encode_json(data: Any) -> str:
+    """
+    Serializes a payload the same way as WebSocket.send_json, so that clients cannot
+    tell a pre-serialized frame apart from one sent directly.
+    """
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+
+class Broadcaster:
+    """
+    Periodically calls a producer and puts the serialized result on the outbox of
+    every connected websocket. The background task only runs while at least one
+    websocket is connected. Encoders map every supported format to the function that
+    serializes a payload in it.
+    """
+
+    def __init__(
+        self,
+        produce: Callable[[], Any],
+        interval: float,
+        encoders: Optional[Mapping[str, Callable[[Any], Frame]]] = None,
+    ):
+        self._produce = produce
+        self._interval = interval
+        self._encoders = encoders or {FORMAT_JSON: encode_json}
+        self._outboxes: Dict[Outbox, str] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._payload: Any = None
+        self._frames: Dict[str, Optional[Frame]] = {}
+
+    def __len__(self) -> int:
+        return len(self._outboxes)
+
+    def supports(self, wire_format: str) -> bool:
+        return wire_format in self._encoders
+
+    def add(self, outbox: Outbox, wire_format: str = FORMAT_JSON) -> None:
+        """
+        Adds a websocket to the broadcast. If a frame was produced recently, it is sent
+        right away so that a new client does not wait for the next tick.
+        """
+        if not self.supports(wire_format):
+            raise ValueError(f"Unsupported wire format {wire_format}")
+        self._outboxes[outbox] = wire_format
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        elif self._payload is not None:
+            frame = self._frame(wire_format)
+            if frame is not None:
+                outbox.put(frame, snapshot=True)
+
+    def discard(self, outbox: Outbox) -> None:
+        self._outboxes.pop(outbox, None)
+
+    def _frame(self, wire_format: str) -> Optional[Frame]:
+        """
+        Returns the current payload in a format, or None if it cannot be encoded in
+        it, in which case clients of that format skip this tick while the others do
+        not.
+        """
+        if wire_format not in self._frames:
+            try:
+                self._frames[wire_format] = self._encoders[wire_format](self._payload)
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception("Failed to encode a %s frame", wire_format)
+                self._frames[wire_format] = None
+        return self._frames[wire_format]
+
+    async def _run(self) -> None:
+        while self._outboxes:
+            self._payload = self._produce()
+            self._frames = {}
+            self._send()
+            await asyncio.sleep(self._interval)
+        self._payload = None
+        self._frames = {}
+
+    def _send(self) -> None:
+        for outbox, wire_format in list(self._outboxes.items()):
+            frame = self._frame(wire_format)
+            if frame is None:
+                continue
+            # Every frame holds every van, so it replaces any the client has not
+            # received yet.
+            outbox.put(frame, snapshot=True)
+            if outbox.closed:
+                # The client went away, the handler will clean up after it.
+                self._outboxes.pop(outbox, None)
@@ -0,0 +1,323 @@
+"""
+Keeps the fleet state of several worker processes in step, so that the backend can run
+with more than one worker.
+
+Every worker keeps its own fleet state, and its own websocket clients subscribed to it.
+Whenever the fleet state of a worker changes, the van's new record is published as a
+compact event, and every other worker applies it to its own fleet state as if the
+change had happened there, so its listeners, and through them its subscribers, learn
+of it too. Events only carry state, never the operation that led to it, so a van's
+latest event is all another worker needs, and events pending for the same van are
+coalesced before they are published. Events of different workers can cross on the
+way, so one older than the record a worker already has, by session and then by the
+times of its last update and fix, is ignored.
+
+Events travel over Postgres LISTEN/NOTIFY, or through memory in tests. Sequence numbers
+stay local to every worker, which is why every worker has an epoch of its own.
+
+Dwell tracking stays local to the worker that ingests a van's fixes, and is not
+replicated. Over HTTP, a van's fixes are spread across workers, so every worker only
+detects stops from the fixes it received, and an arrival can be detected late or
+missed. Trackers holding a connection open stay on one worker.
+"""
+
+import asyncio
+import json
+import logging
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional, Protocol
+
+from src.db import connect_unpooled
+from src.vantracking.state import FleetState, VanChange, VanState
+
+# Postgres refuses notifications with a payload of 8000 bytes or more.
+MAX_PAYLOAD_BYTES = 7900
+CHANNEL = "fleet"
+
+EVENT_VAN = "v"
+EVENT_ROUTES = "r"
+
+logger = logging.getLogger(__name__)
+
+
+class Transport(Protocol):
+    """
+    Carries payloads between workers. Every payload published is received by every
+    worker, including the one that published it.
+    """
+
+    async def start(self, receive: Callable[[str], None]) -> None: ...
+
+    async def publish(self, payloads: List[str]) -> None: ...
+
+    async def close(self) -> None: ...
+
+
+# Timestamps are sent as whole microseconds, so that they come out of an event exactly
+# as they went in and records can be ordered by them.
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def to_micros(timestamp: datetime) -> int:
+    return (timestamp - EPOCH) // MICROSECOND
+
+
+def from_micros(micros: int) -> datetime:
+    return EPOCH + micros * MICROSECOND
+
+
+def encode_van(worker: str, van: VanState) -> List[Any]:
+    return [
+        EVENT_VAN,
+        worker,
+        van.guid,
+        van.session_id,
+        van.route_id,
+        van.stop_index,
+        int(van.dead),
+        to_micros(van.created_at),
+        to_micros(van.updated_at),
+        None if van.located_at is None else to_micros(van.located_at),
+        van.lat,
+        van.lon,
+    ]
+
+
+def decode_van(event: List[Any]) -> VanState:
+    (
+        _,
+        _,
+        guid,
+        session_id,
+        route_id,
+        stop_index,
+        dead,
+        created_at,
+        updated_at,
+        located_at,
+        lat,
+        lon,
+    ) = event
+    van = VanState(
+        guid=guid,
+        session_id=session_id,
+        route_id=route_id,
+        stop_index=stop_index,
+        dead=bool(dead),
+        created_at=from_micros(created_at),
+        updated_at=from_micros(updated_at),
+    )
+    if located_at is not None:
+        van.located_at = from_micros(located_at)
+    van.lat = lat
+    van.lon = lon
+    return van
+
+
+def pack(events: List[List[Any]]) -> List[str]:
+    """
+    Packs events into as few payloads as fit under the Postgres limit, one event per
+    line.
+    """
+    payloads: List[str] = []
+    lines: List[str] = []
+    size = 0
+    for event in events:
+        line = json.dumps(event, separators=(",", ":"))
+        if lines and size + len(line) + 1 > MAX_PAYLOAD_BYTES:
+            payloads.append("\n".join(lines))
+            lines, size = [], 0
+        lines.append(line)
+        size += len(line) + 1
+    if lines:
+        payloads.append("\n".join(lines))
+    return payloads
+
+
+class FleetBus:
+    """
+    Publishes the changes made to this worker's fleet state and applies those of every
+    other worker. It is registered as a fleet state listener, and must be started
+    before any change is made and closed on shutdown so that pending events go out.
+    """
+
+    def __init__(self, fleet: FleetState, transport: Transport, db=None):
+        self._fleet = fleet
+        self._transport = transport
+        self._db = db
+        self.worker = uuid.uuid4().hex[:12]
+        self._pending: Dict[str, VanState] = {}
+        self._routes_changed = False
+        self._ready = asyncio.Event()
+        self._applying = False
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        await self._transport.start(self.receive)
+        self._task = asyncio.create_task(self._run())
+
+    def notify(self, change: VanChange) -> None:
+        if self._applying:
+            # The change came from another worker, which already published it.
+            return
+        self._pending[change.van.guid] = change.van
+        self._ready.set()
+
+    def publish_routes(self) -> None:
+        """
+        Tells every other worker to reload the route network, after it changed in the
+        database.
+        """
+        self._routes_changed = True
+        self._ready.set()
+
+    def _take(self) -> List[List[Any]]:
+        events: List[List[Any]] = []
+        # Routes go first, so that the vans on a new route find it.
+        if self._routes_changed:
+            events.append([EVENT_ROUTES, self.worker])
+            self._routes_changed = False
+        events.extend(encode_van(self.worker, van) for van in self._pending.values())
+        self._pending = {}
+        return events
+
+    async def _run(self) -> None:
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            events = self._take()
+            try:
+                await self._transport.publish(pack(events))
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception("Failed to publish %d fleet events", len(events))
+
+    def receive(self, payload: str) -> None:
+        for line in payload.split("\n"):
+            try:
+                event = json.loads(line)
+                if event[1] != self.worker:
+                    self._apply(event)
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception("Dropping malformed fleet event %r", line)
+
+    def _apply(self, event: List[Any]) -> None:
+        self._applying = True
+        try:
+            if event[0] == EVENT_ROUTES:
+                with self._db.session() as session:
+                    self._fleet.refresh_routes(session)
+            elif event[0] == EVENT_VAN:
+                self._fleet.apply_van(decode_van(event))
+        finally:
+            self._applying = False
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        events = self._take()
+        if events:
+            await self._transport.publish(pack(events))
+        await self._transport.close()
+
+
+def refresh_routes(state: Any, session) -> None:
+    """
+    Reloads the route network of this worker after it changed in the database, and
+    has every other worker do the same.
+    """
+    state.fleet.refresh_routes(session)
+    if state.fleet_bus is not None:
+        state.fleet_bus.publish_routes()
+
+
+class MemoryBroker:
+    """
+    Stands in for Postgres in tests, handing every payload published to every
+    transport connected to it on a later turn of the event loop.
+    """
+
+    def __init__(self) -> None:
+        self.receivers: List[Callable[[str], None]] = []
+        self.published = 0
+
+    def transport(self) -> "MemoryTransport":
+        return MemoryTransport(self)
+
+
+class MemoryTransport:
+    """
+    Connects one worker's bus to a memory broker.
+    """
+
+    def __init__(self, broker: MemoryBroker):
+        self._broker = broker
+        self._receive: Optional[Callable[[str], None]] = None
+
+    async def start(self, receive: Callable[[str], None]) -> None:
+        self._receive = receive
+        self._broker.receivers.append(receive)
+
+    async def publish(self, payloads: List[str]) -> None:
+        loop = asyncio.get_running_loop()
+        for payload in payloads:
+            self._broker.published += 1
+            for receive in self._broker.receivers:
+                loop.call_soon(receive, payload)
+
+    async def close(self) -> None:
+        if self._receive is not None:
+            self._broker.receivers.remove(self._receive)
+            self._receive = None
+
+
+class PostgresTransport:
+    """
+    Carries payloads over Postgres LISTEN/NOTIFY. It keeps two connections of its own
+    outside the pool, one listening from the event loop and one publishing from a
+    thread, so that neither pins a pooled connection.
+    """
+
+    def __init__(self, engine, channel: str = CHANNEL):
+        self._engine = engine
+        self._channel = channel
+        self._listener: Any = None
+        self._publisher: Any = None
+        self._receive: Optional[Callable[[str], None]] = None
+
+    async def start(self, receive: Callable[[str], None]) -> None:
+        self._receive = receive
+        self._listener = connect_unpooled(self._engine)
+        self._publisher = connect_unpooled(self._engine)
+        with self._listener.cursor() as cursor:
+            cursor.execute(f"LISTEN {self._channel}")
+        asyncio.get_running_loop().add_reader(self._listener.fileno(), self._read)
+
+    def _read(self) -> None:
+        assert self._receive is not None
+        self._listener.poll()
+        while self._listener.notifies:
+            self._receive(self._listener.notifies.pop(0).payload)
+
+    def _notify(self, payloads: List[str]) -> None:
+        with self._publisher.cursor() as cursor:
+            for payload in payloads:
+                cursor.execute("SELECT pg_notify(%s, %s)", (self._channel, payload))
+
+    async def publish(self, payloads: List[str]) -> None:
+        await asyncio.to_thread(self._notify, payloads)
+
+    async def close(self) -> None:
+        if self._listener is not None:
+            asyncio.get_running_loop().remove_reader(self._listener.fileno())
+            self._listener.close()
+            self._listener = None
+        if self._publisher is not None:
+            self._publisher.close()
+            self._publisher = None
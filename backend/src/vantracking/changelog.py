@@ -0,0 +1,63 @@
+"""
+Keeps a short log of recent fleet changes, so that a client reconnecting with the last
+sequence number it saw only has to be sent what changed since, rather than everything.
+"""
+
+from collections import deque
+from typing import Deque, FrozenSet, List, NamedTuple, Optional, Set, Tuple
+
+from src.vantracking.state import VanChange
+
+CHANGE_LOG_SIZE = 10000
+
+
+class ChangeSet(NamedTuple):
+    """
+    The vans that changed after some sequence number, and the routes they were on
+    before and after changing, along with the changes themselves from oldest to newest.
+    """
+
+    guids: FrozenSet[str]
+    route_ids: FrozenSet[int]
+    changes: Tuple[VanChange, ...] = ()
+
+
+class ChangeLog:
+    """
+    Remembers the most recent fleet changes. It is registered as a fleet state
+    listener.
+    """
+
+    def __init__(self, size: int = CHANGE_LOG_SIZE) -> None:
+        self._changes: Deque[VanChange] = deque(maxlen=size)
+        self.sequence = 0
+
+    def __len__(self) -> int:
+        return len(self._changes)
+
+    def notify(self, change: VanChange) -> None:
+        self._changes.append(change)
+        self.sequence = change.sequence
+
+    def since(self, sequence: int) -> Optional[ChangeSet]:
+        """
+        Returns what changed after a sequence number, or None if the log no longer
+        goes back that far or never got there, in which case the client needs a
+        snapshot.
+        """
+        if sequence > self.sequence:
+            return None
+        oldest = self._changes[0].sequence if self._changes else self.sequence + 1
+        if sequence < oldest - 1:
+            return None
+        guids: Set[str] = set()
+        route_ids: Set[int] = set()
+        changes: List[VanChange] = []
+        for change in reversed(self._changes):
+            if change.sequence <= sequence:
+                break
+            guids.add(change.van.guid)
+            route_ids.update(change.route_ids)
+            changes.append(change)
+        changes.reverse()
+        return ChangeSet(frozenset(guids), frozenset(route_ids), tuple(changes))
@@ -0,0 +1,296 @@
+"""
+Defines the compaction of finished tracker sessions into simplified trails.
+
+Once a session is dead or has outlived its lifetime, its locations are only ever read
+back as a whole to draw where the van went. They are simplified with Douglas-Peucker,
+which keeps every point of the original path within a tolerance of the simplified one,
+packed into a single van_trail row and deleted from van_location.
+
+A trail is packed as a header with the timestamp in milliseconds and the coordinates
+of its first point, followed by every later point as the change in milliseconds and in
+millionths of a degree from the point before it. A millionth of a degree is about a
+tenth of a meter, well under the tolerance.
+"""
+
+import asyncio
+import logging
+import struct
+from datetime import datetime, timedelta, timezone
+from math import cos, radians
+from typing import List, Optional
+
+import numpy as np
+from sqlalchemy import delete, or_
+from sqlalchemy.orm import Session
+from src.model.van_location import VanLocation
+from src.model.van_tracker_session import VanTrackerSession
+from src.model.van_trail import VanTrail
+from src.vantracking.geo import KM_LAT_RATIO, KM_LON_RATIO, MICRODEGREES
+from src.vantracking.jobs import LOCK_COMPACTION, job_lock
+from src.vantracking.state import SESSION_LIFETIME, LocationFix
+
+TRAIL_TOLERANCE_M = 5.0
+COMPACTION_BATCH = 50
+COMPACTION_INTERVAL = timedelta(minutes=10)
+# Keeps the number of parameters of a statement under the limit of SQLite.
+DELETE_BATCH = 500
+
+TRAIL_HEADER_FORMAT = "<qdd"
+
+logger = logging.getLogger(__name__)
+
+
+def simplify(lats: np.ndarray, lons: np.ndarray, tolerance_m: float) -> np.ndarray:
+    """
+    Returns the positions of the points kept by Douglas-Peucker, so that every point
+    is within the tolerance of the segment between the kept points around it. The
+    first and last points are always kept.
+    """
+    count = len(lats)
+    if count <= 2:
+        return np.arange(count)
+
+    # Project onto a plane centered on the first point, where distances are euclidean
+    # and in meters.
+    ys = (lats - lats[0]) * KM_LAT_RATIO * 1000
+    xs = (lons - lons[0]) * KM_LON_RATIO * cos(radians(lats[0])) * 1000
+
+    keep = np.zeros(count, dtype=bool)
+    keep[0] = keep[-1] = True
+    # Ranges are split without recursion, since a trail can have many thousands of
+    # points.
+    ranges = [(0, count - 1)]
+    while ranges:
+        start, end = ranges.pop()
+        if end - start < 2:
+            continue
+        px, py = xs[start + 1 : end], ys[start + 1 : end]
+        dx, dy = xs[end] - xs[start], ys[end] - ys[start]
+        length = dx * dx + dy * dy
+        # Measure to the segment rather than the whole line, so that a van doubling
+        # back on itself is not flattened away.
+        if length:
+            fraction = ((px - xs[start]) * dx + (py - ys[start]) * dy) / length
+            np.clip(fraction, 0.0, 1.0, out=fraction)
+        else:
+            fraction = np.zeros(len(px))
+        distances = np.hypot(
+            px - (xs[start] + fraction * dx), py - (ys[start] + fraction * dy)
+        )
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance_m:
+            split = start + 1 + farthest
+            keep[split] = True
+            ranges.append((start, split))
+            ranges.append((split, end))
+    return np.flatnonzero(keep)
+
+
+def pack_trail(fixes: List[LocationFix]) -> bytes:
+    """
+    Packs fixes, ordered from oldest to newest, into the trail format.
+    """
+    if not fixes:
+        return b""
+    first = fixes[0]
+    base_ms = round(first.timestamp.timestamp() * 1000)
+    times = np.fromiter(
+        (round(fix.timestamp.timestamp() * 1000) for fix in fixes), np.int64, len(fixes)
+    )
+    # Round every point against the first one rather than the point before it, so
+    # that rounding errors do not add up along the trail.
+    lats = np.rint(
+        (np.fromiter((fix.lat for fix in fixes), float, len(fixes)) - first.lat)
+        * MICRODEGREES
+    ).astype(np.int64)
+    lons = np.rint(
+        (np.fromiter((fix.lon for fix in fixes), float, len(fixes)) - first.lon)
+        * MICRODEGREES
+    ).astype(np.int64)
+    deltas = np.column_stack((np.diff(times), np.diff(lats), np.diff(lons)))
+    return struct.pack(TRAIL_HEADER_FORMAT, base_ms, first.lat, first.lon) + (
+        deltas.astype("<i4").tobytes()
+    )
+
+
+def unpack_trail(data: bytes) -> List[LocationFix]:
+    """
+    Unpacks a trail into fixes, ordered from oldest to newest.
+    """
+    if not data:
+        return []
+    header_size = struct.calcsize(TRAIL_HEADER_FORMAT)
+    base_ms, base_lat, base_lon = struct.unpack_from(TRAIL_HEADER_FORMAT, data)
+    deltas = np.frombuffer(data, "<i4", offset=header_size).reshape(-1, 3)
+    offsets = np.zeros((len(deltas) + 1, 3), np.int64)
+    np.cumsum(deltas, axis=0, out=offsets[1:])
+    times = (base_ms + offsets[:, 0]).tolist()
+    lats = (base_lat + offsets[:, 1] / MICRODEGREES).tolist()
+    lons = (base_lon + offsets[:, 2] / MICRODEGREES).tolist()
+    lats[0], lons[0] = base_lat, base_lon
+    return [
+        LocationFix(datetime.fromtimestamp(ms / 1000.0, timezone.utc), lat, lon)
+        for ms, lat, lon in zip(times, lats, lons)
+    ]
+
+
+class TrailCompactor:
+    """
+    Compacts the locations of finished sessions into trails.
+    """
+
+    def __init__(
+        self, tolerance_m: float = TRAIL_TOLERANCE_M, batch: int = COMPACTION_BATCH
+    ) -> None:
+        self.tolerance_m = tolerance_m
+        self.batch = batch
+
+    def finished_sessions(self, session: Session, now: datetime) -> List[int]:
+        """
+        Returns up to a batch of finished sessions that still have raw locations.
+        """
+        rows = (
+            session.query(VanTrackerSession.id)
+            .filter(
+                or_(
+                    VanTrackerSession.dead == True,
+                    VanTrackerSession.created_at <= now - SESSION_LIFETIME,
+                ),
+                session.query(VanLocation.id)
+                .filter(VanLocation.session_id == VanTrackerSession.id)
+                .exists(),
+            )
+            .order_by(VanTrackerSession.id)
+            .limit(self.batch)
+        )
+        return [session_id for session_id, in rows]
+
+    def compact(self, session: Session, now: datetime) -> List[int]:
+        """
+        Compacts a batch of finished sessions, committing after each one, and returns
+        the sessions that were compacted.
+        """
+        session_ids = self.finished_sessions(session, now)
+        for session_id in session_ids:
+            self.compact_session(session, session_id)
+            session.commit()
+        return session_ids
+
+    def compact_session(self, session: Session, session_id: int) -> None:
+        rows = (
+            session.query(
+                VanLocation.id, VanLocation.created_at, VanLocation.lat, VanLocation.lon
+            )
+            .filter(VanLocation.session_id == session_id)
+            .order_by(VanLocation.created_at, VanLocation.id)
+            .all()
+        )
+        if not rows:
+            return
+        fixes = [LocationFix(created_at, lat, lon) for _, created_at, lat, lon in rows]
+
+        trail = session.get(VanTrail, session_id)
+        raw_count = len(rows)
+        if trail is None:
+            trail = VanTrail(session_id=session_id)
+            session.add(trail)
+            points = self._simplified(fixes)
+        else:
+            # Locations that arrived after a session was compacted are merged into its
+            # trail. Simplifying the trail again would add up the error of both
+            # passes, so those that came after the trail are simplified on their own,
+            # starting from its last point. Any that fall between points of the trail
+            # are kept as they are, which can move the points around them out of the
+            # tolerance.
+            points = unpack_trail(trail.points)
+            raw_count += trail.raw_count
+            end = points[-1].timestamp if points else None
+            later = [fix for fix in fixes if end is None or fix.timestamp > end]
+            between = [fix for fix in fixes if end is not None and fix.timestamp <= end]
+            if later:
+                points = points[:-1] + self._simplified(points[-1:] + later)
+            if between:
+                points = sorted(points + between, key=lambda fix: fix.timestamp)
+
+        trail.tolerance_m = self.tolerance_m
+        trail.raw_count = raw_count
+        trail.point_count = len(points)
+        trail.points = pack_trail(points)
+
+        # Only delete what was read, in case a late location just came in. It can
+        # have a lower id than the ones read if it was committed after they were.
+        ids = [row[0] for row in rows]
+        for start in range(0, len(ids), DELETE_BATCH):
+            session.execute(
+                delete(VanLocation).where(
+                    VanLocation.id.in_(ids[start : start + DELETE_BATCH])
+                )
+            )
+
+    def _simplified(self, fixes: List[LocationFix]) -> List[LocationFix]:
+        """
+        Returns the fixes kept by Douglas-Peucker, ordered from oldest to newest.
+        """
+        kept = simplify(
+            np.fromiter((fix.lat for fix in fixes), float, len(fixes)),
+            np.fromiter((fix.lon for fix in fixes), float, len(fixes)),
+            self.tolerance_m,
+        )
+        return [fixes[i] for i in kept.tolist()]
+
+    @staticmethod
+    def trail(session: Session, session_id: int) -> Optional[List[LocationFix]]:
+        """
+        Returns the trail of a session, ordered from oldest to newest, or None if the
+        session does not exist. Sessions that are not compacted yet are read from
+        their raw locations.
+        """
+        if session.get(VanTrackerSession, session_id) is None:
+            return None
+        fixes: List[LocationFix] = []
+        trail = session.get(VanTrail, session_id)
+        if trail is not None:
+            fixes = unpack_trail(trail.points)
+        rows = (
+            session.query(VanLocation.created_at, VanLocation.lat, VanLocation.lon)
+            .filter(VanLocation.session_id == session_id)
+            .order_by(VanLocation.created_at, VanLocation.id)
+            .all()
+        )
+        if rows:
+            fixes = sorted(
+                fixes + [LocationFix(*row) for row in rows],
+                key=lambda fix: fix.timestamp,
+            )
+        return fixes
+
+
+async def run_compaction(
+    db, compactor: TrailCompactor, interval: timedelta = COMPACTION_INTERVAL
+) -> None:
+    """
+    Compacts finished sessions periodically until cancelled. Every run works through
+    batches until no finished session is left.
+    """
+    while True:
+        try:
+            compacted = 0
+            while True:
+                session_ids = await asyncio.to_thread(_compact, db, compactor)
+                compacted += len(session_ids)
+                if len(session_ids) < compactor.batch:
+                    break
+            if compacted:
+                logger.info("Compacted %d tracker sessions", compacted)
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception("Failed to compact tracker sessions")
+        await asyncio.sleep(interval.total_seconds())
+
+
+def _compact(db, compactor: TrailCompactor) -> List[int]:
+    with job_lock(db, LOCK_COMPACTION) as acquired:
+        if not acquired:
+            # Another worker is compacting a batch, and picks up the rest.
+            return []
+        with db.session() as session:
+            return compactor.compact(session, datetime.now(timezone.utc))
@@ -0,0 +1,210 @@
+"""
+Defines incremental stop detection for a single tracker session.
+
+A van is considered to be at a stop once the longest streak of consecutive fixes
+within a stop's radius, among the fixes of the last few minutes, lasts long enough.
+Rather than rescanning those fixes for every stop on every upload, each session keeps
+its recent fixes in a ring buffer and every stop keeps the streaks that could still be
+the longest one, so that a new fix only costs constant work per stop. The distances
+from a fix to every stop are computed at once, and only the stops the van is near are
+then visited.
+"""
+
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Deque, Iterable, List, Optional, Sequence, Set
+
+import numpy as np
+from src.vantracking.geo import StopArray
+from src.vantracking.state import LocationFix, StopPoint
+
+THRESHOLD_RADIUS_M = 30.48  # 100 ft
+THRESHOLD_TIME = timedelta(seconds=10)
+DWELL_WINDOW = timedelta(seconds=300)
+
+# Enough for a fix every half second over the whole window. Older fixes are dropped
+# early if a tracker reports faster than that.
+MAX_WINDOW_FIXES = 600
+
+
+class _Streak:
+    """
+    A run of consecutive fixes within a stop's radius, as inclusive sequence numbers.
+    """
+
+    __slots__ = ("start", "end")
+
+    def __init__(self, start: int, end: int):
+        self.start = start
+        self.end = end
+
+    def __len__(self) -> int:
+        return self.end - self.start + 1
+
+
+class _StopStreaks:
+    """
+    The streaks of a single stop that could still be the longest one in the window.
+
+    Streaks are kept from oldest to newest with non-increasing lengths, so the first one
+    is always the longest, and the oldest of the longest if there is a tie. A streak
+    followed by a longer one can never be the longest again, since the older streak
+    leaves the window first.
+    """
+
+    __slots__ = ("streaks", "open")
+
+    def __init__(self) -> None:
+        self.streaks: Deque[_Streak] = deque()
+        self.open = False
+
+    def push(self, seq: int) -> None:
+        """
+        Adds a fix within the stop's radius.
+        """
+        if self.open:
+            last = self.streaks[-1]
+            last.end = seq
+        else:
+            last = _Streak(seq, seq)
+            self.streaks.append(last)
+            self.open = True
+        while len(self.streaks) > 1 and len(self.streaks[-2]) < len(last):
+            del self.streaks[-2]
+
+    def evict(self, seq: int) -> None:
+        if not self.streaks or self.streaks[0].start != seq:
+            return
+        first = self.streaks[0]
+        first.start += 1
+        if first.start > first.end:
+            self.streaks.popleft()
+            if not self.streaks:
+                self.open = False
+        elif len(self.streaks) > 1 and len(first) < len(self.streaks[1]):
+            self.streaks.popleft()
+
+    def longest(self) -> Optional[_Streak]:
+        return self.streaks[0] if self.streaks else None
+
+
+class DwellTracker:
+    """
+    Tracks how long a session's van has dwelled at each stop of its route. Fixes must be
+    added from oldest to newest. An older fix is still accepted, but makes the tracker
+    replay its whole buffer.
+    """
+
+    def __init__(
+        self,
+        stops: Sequence[StopPoint],
+        fixes: Iterable[LocationFix] = (),
+        capacity: int = MAX_WINDOW_FIXES,
+    ):
+        self.stops = stops
+        self._points = StopArray(stops)
+        self._capacity = capacity
+        self._buffer: List[Optional[LocationFix]] = []
+        self._head = 0  # Sequence number of the oldest buffered fix
+        self._tail = 0  # Sequence number of the next fix to be added
+        self._streaks: List[_StopStreaks] = []
+        # Stops whose last streak is still open, and stops with any streak at all.
+        # Only these need to be visited when a fix is added or evicted.
+        self._open: Set[int] = set()
+        self._active: Set[int] = set()
+        self._reset(fixes)
+
+    def _reset(self, fixes: Iterable[LocationFix]) -> None:
+        self._buffer = [None] * self._capacity
+        self._head = 0
+        self._tail = 0
+        self._streaks = [_StopStreaks() for _ in self.stops]
+        self._open = set()
+        self._active = set()
+        for fix in sorted(fixes, key=lambda fix: fix.timestamp):
+            self._push(fix)
+
+    def __len__(self) -> int:
+        return self._tail - self._head
+
+    def fixes(self) -> List[LocationFix]:
+        """
+        Returns the buffered fixes, ordered from oldest to newest.
+        """
+        return [self._fix(seq) for seq in range(self._head, self._tail)]
+
+    def _fix(self, seq: int) -> LocationFix:
+        fix = self._buffer[seq % self._capacity]
+        assert fix is not None
+        return fix
+
+    def add(self, fix: LocationFix) -> None:
+        if len(self) and fix.timestamp < self._fix(self._tail - 1).timestamp:
+            self._reset([*self.fixes(), fix])
+            return
+        self._push(fix)
+
+    def _push(self, fix: LocationFix) -> None:
+        if len(self) == self._capacity:
+            self._evict()
+        seq = self._tail
+        self._buffer[seq % self._capacity] = fix
+        self._tail += 1
+        inside = np.flatnonzero(
+            self._points.distances_from(fix.lat, fix.lon) < THRESHOLD_RADIUS_M
+        ).tolist()
+        for index in self._open.difference(inside):
+            self._streaks[index].open = False
+        for index in inside:
+            self._streaks[index].push(seq)
+        self._open = set(inside)
+        self._active.update(inside)
+
+    def _evict(self) -> None:
+        seq = self._head
+        for index in list(self._active):
+            streaks = self._streaks[index]
+            streaks.evict(seq)
+            if not streaks.streaks:
+                self._active.discard(index)
+        self._buffer[seq % self._capacity] = None
+        self._head += 1
+
+    def expire(self, now: datetime) -> None:
+        """
+        Drops every fix that is no longer within the dwell window.
+        """
+        cutoff = now - DWELL_WINDOW
+        while len(self) and self._fix(self._head).timestamp <= cutoff:
+            self._evict()
+
+    def dwell(self, stop_index: int) -> timedelta:
+        """
+        Returns the duration of the longest streak at a stop.
+        """
+        streak = self._streaks[stop_index].longest()
+        if streak is None:
+            return timedelta(seconds=0)
+        return self._fix(streak.end).timestamp - self._fix(streak.start).timestamp
+
+    def stop_index(self, stop_index: int) -> int:
+        """
+        Returns the stop the van is at, given the stop it was last known to be at.
+        """
+
+        # We want to consider all of the stops that are coming up for this van, as that allows to handle cases where a
+        # stop is erroneously skipped. Also make sure we include subsequent stops that wrap around. The wrap around slice
+        # needs to be bounded to 0 to prevent a negative index causing weird slicing behavior.
+        indices = range(len(self.stops))
+        subsequent = list(indices[stop_index + 1 :]) + list(
+            indices[: max(stop_index - 1, 0)]
+        )
+        for i, index in enumerate(subsequent):
+            if self.dwell(index) >= THRESHOLD_TIME:
+                # We were at this stop for long enough, move to it. Since the stops iterated through are relative to the
+                # current stop, we have to add the current stop index to the current index in the loop to get the actual
+                # stop index.
+                # Note: It's possible that the van was at another stop's radius for even longer, but this is not
+                # considered until real-world testing shows this edge case to be important.
+                return (stop_index + i + 1) % len(self.stops)
+        return stop_index
@@ -0,0 +1,114 @@
+"""
+Geographic helpers used by van tracking.
+
+The distance used throughout van tracking scales longitude by the cosine of the
+latitude of the point the distance is measured from. Besides the scalar version, the
+distance is also available over NumPy arrays, either from one point to many or
+between many points, so that loops over stops can run as a handful of array
+operations. Stops are measured from often enough that their cosines are precomputed
+with StopArray.
+"""
+
+from math import cos, radians, sqrt
+from typing import TYPE_CHECKING, Sequence, Union
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from src.vantracking.state import StopPoint
+
+KM_LAT_RATIO = 111.32  # km/degree latitude
+EARTH_CIRCUFERENCE_KM = 40075  # km
+DEGREES_IN_CIRCLE = 360  # degrees
+KM_LON_RATIO = EARTH_CIRCUFERENCE_KM / DEGREES_IN_CIRCLE  # km/degree longitude at 0°
+MICRODEGREES = 1_000_000  # microdegrees/degree, about a tenth of a meter each
+
+Floats = Union[float, np.ndarray]
+
+
+def distance_meters(alat: float, alon: float, blat: float, blon: float) -> float:
+    dlat = blat - alat
+    dlon = blon - alon
+
+    # Simplified distance calculation that assumes the earth is a sphere. This is good enough for our purposes.
+    # https://stackoverflow.com/a/39540339
+    dlatkm = dlat * KM_LAT_RATIO
+    dlonkm = dlon * EARTH_CIRCUFERENCE_KM * cos(radians(alat)) / DEGREES_IN_CIRCLE
+
+    return sqrt(dlatkm**2 + dlonkm**2) * 1000
+
+
+def _distance_meters(
+    alat: Floats, alon: Floats, acos: Floats, blat: Floats, blon: Floats
+) -> np.ndarray:
+    dlatkm = (blat - alat) * KM_LAT_RATIO
+    dlonkm = (blon - alon) * KM_LON_RATIO * acos
+    return np.hypot(dlatkm, dlonkm) * 1000
+
+
+class StopArray:
+    """
+    The coordinates of a sequence of stops as arrays, along with the cosine of each
+    stop's latitude.
+    """
+
+    __slots__ = ("lats", "lons", "cos_lats")
+
+    def __init__(self, stops: Sequence["StopPoint"]):
+        self.lats = np.fromiter((stop.lat for stop in stops), float, len(stops))
+        self.lons = np.fromiter((stop.lon for stop in stops), float, len(stops))
+        self.cos_lats = np.cos(np.radians(self.lats))
+
+    def __len__(self) -> int:
+        return len(self.lats)
+
+    def distances_from(self, lat: float, lon: float) -> np.ndarray:
+        """
+        Returns the distance from a point to every stop.
+        """
+        return distances_meters(lat, lon, self.lats, self.lons)
+
+    def distances_to(self, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+        """
+        Returns the distance from every stop to the point at the same index.
+        """
+        return _distance_meters(self.lats, self.lons, self.cos_lats, lats, lons)
+
+    def segment_lengths(self) -> np.ndarray:
+        """
+        Returns the distance from every stop to the one before it. The first element
+        is the distance from the first stop to the last one, closing the loop.
+        """
+        return self.distances_to(np.roll(self.lats, 1), np.roll(self.lons, 1))
+
+
+def distances_meters(
+    lat: float, lon: float, lats: np.ndarray, lons: np.ndarray
+) -> np.ndarray:
+    """
+    Returns the distance from one point to many.
+    """
+    return _distance_meters(lat, lon, cos(radians(lat)), lats, lons)
+
+
+def distances_between(
+    alats: np.ndarray, alons: np.ndarray, blats: np.ndarray, blons: np.ndarray
+) -> np.ndarray:
+    """
+    Returns the distance from every point in a to the point at the same index in b.
+    """
+    return _distance_meters(alats, alons, np.cos(np.radians(alats)), blats, blons)
+
+
+def distance_matrix_meters(
+    alats: np.ndarray, alons: np.ndarray, blats: np.ndarray, blons: np.ndarray
+) -> np.ndarray:
+    """
+    Returns the distance from every point in a to every point in b, with a row for
+    each point in a.
+    """
+    alats = np.asarray(alats, float)[:, np.newaxis]
+    alons = np.asarray(alons, float)[:, np.newaxis]
+    return _distance_meters(
+        alats, alons, np.cos(np.radians(alats)), np.asarray(blats), np.asarray(blons)
+    )
@@ -0,0 +1,257 @@
+"""
+Defines the ingest pipeline for van locations.
+
+Location routes only validate fixes and update the fleet state before answering the
+tracker. The fixes are then written behind by a single worker that drains a bounded
+queue in batches, inserts every location in the batch with one statement and applies
+the resulting stop changes in the same transaction. Stop detection is incremental,
+with a dwell tracker kept per live session.
+
+The trackers were already told their fixes were accepted, so they never send them
+again. A batch that fails to be written is therefore retried with backoff, and only
+dropped once every attempt failed.
+"""
+
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import insert, update
+from src.model.van_location import VanLocation
+from src.model.van_tracker_session import VanTrackerSession
+from src.vantracking.dwell import DWELL_WINDOW, DwellTracker
+from src.vantracking.spatial import RouteIndex
+from src.vantracking.state import FleetState, LocationFix, StopPoint
+
+MAX_QUEUED_ITEMS = 10000
+MAX_BATCH_ITEMS = 1000
+MAX_WRITE_ATTEMPTS = 5
+# Seconds to wait before retrying a failed batch, doubled after every attempt.
+RETRY_DELAY = 0.5
+
+logger = logging.getLogger(__name__)
+
+
+class IngestItem(NamedTuple):
+    """
+    Fixes accepted from a van's tracker, ordered from oldest to newest.
+    """
+
+    session_id: int
+    van_guid: str
+    fixes: List[LocationFix]
+
+
+def initial_stop_index(index: RouteIndex, lat: float, lon: float, default: int) -> int:
+    """
+    Guesses the stop a van is at from the first fix of its session, which is the stop
+    closest to it.
+    """
+    if len(index.stops) < 2:
+        return default
+    nearest = index.nearest_stop(lat, lon)
+    return default if nearest is None else nearest
+
+
+class IngestPipeline:
+    """
+    Queues accepted fixes and writes them behind in batches. The worker is started
+    on the first submission and must be closed on shutdown so that every queued fix
+    is flushed to the database.
+    """
+
+    def __init__(
+        self,
+        db,
+        fleet: FleetState,
+        max_queued: int = MAX_QUEUED_ITEMS,
+        max_batch: int = MAX_BATCH_ITEMS,
+        max_attempts: int = MAX_WRITE_ATTEMPTS,
+        retry_delay: float = RETRY_DELAY,
+    ):
+        self._db = db
+        self._fleet = fleet
+        self._queue: asyncio.Queue[IngestItem] = asyncio.Queue(maxsize=max_queued)
+        self._max_batch = max_batch
+        self._max_attempts = max_attempts
+        self._retry_delay = retry_delay
+        # How many fixes were lost because their batch could not be written.
+        self.dropped_fixes = 0
+        self._worker: Optional[asyncio.Task] = None
+        # Only touched by the worker, one batch at a time.
+        self._trackers: Dict[int, DwellTracker] = {}
+
+    def __len__(self) -> int:
+        return self._queue.qsize()
+
+    async def submit(self, item: IngestItem) -> None:
+        """
+        Queues fixes to be written. This only waits when the queue is full, which
+        pushes back on trackers if the database cannot keep up.
+        """
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        await self._queue.put(item)
+
+    async def flush(self) -> None:
+        """
+        Waits until everything submitted so far has been written.
+        """
+        await self._queue.join()
+
+    async def close(self) -> None:
+        await self.flush()
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self._max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            try:
+                await self._process_with_retries(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _process_with_retries(self, batch: List[IngestItem]) -> None:
+        # The queue keeps filling while a batch is retried, and pushes back on the
+        # trackers once it is full.
+        delay = self._retry_delay
+        for attempt in range(1, self._max_attempts + 1):
+            try:
+                await self._process(batch)
+                return
+            except Exception:  # pylint: disable=broad-exception-caught
+                if attempt == self._max_attempts:
+                    self.dropped_fixes += sum(len(item.fixes) for item in batch)
+                    logger.exception(
+                        "Dropping %d location batches after %d failed attempts, "
+                        "%d fixes dropped so far",
+                        len(batch),
+                        attempt,
+                        self.dropped_fixes,
+                    )
+                    return
+                logger.warning(
+                    "Failed to write %d location batches, retrying in %.1fs",
+                    len(batch),
+                    delay,
+                    exc_info=True,
+                )
+            await asyncio.sleep(delay)
+            delay *= 2
+
+    async def _process(self, batch: List[IngestItem]) -> None:
+        now = datetime.now(timezone.utc)
+
+        # Snapshot the stop state of each van here, as the fleet state must only be
+        # touched from the event loop.
+        live = {van.session_id for van in self._fleet.vans() if van.is_alive(now)}
+        for session_id in [key for key in self._trackers if key not in live]:
+            del self._trackers[session_id]
+
+        targets: Dict[int, Tuple[int, List[StopPoint]]] = {}
+        for item in batch:
+            van = self._fleet.van(item.van_guid)
+            if van is None or van.session_id != item.session_id:
+                continue
+            route = self._fleet.route(van.route_id)
+            targets[item.session_id] = (
+                van.stop_index,
+                route.stops if route is not None else [],
+            )
+
+        try:
+            stop_indices = await asyncio.to_thread(self._write, batch, targets, now)
+        except Exception:
+            # The trackers may have seen fixes that were never committed, so have them
+            # rebuilt from the database on the next batch.
+            for item in batch:
+                self._trackers.pop(item.session_id, None)
+            raise
+
+        for item in batch:
+            van = self._fleet.van(item.van_guid)
+            if van is not None and van.session_id in stop_indices:
+                self._fleet.update_stop_index(van, stop_indices[van.session_id])
+
+    def _write(
+        self,
+        batch: List[IngestItem],
+        targets: Dict[int, Tuple[int, List[StopPoint]]],
+        now: datetime,
+    ) -> Dict[int, int]:
+        updated_at: Dict[int, datetime] = {}
+        rows = []
+        for item in batch:
+            for fix in item.fixes:
+                rows.append(
+                    {
+                        "session_id": item.session_id,
+                        "created_at": fix.timestamp,
+                        "lat": fix.lat,
+                        "lon": fix.lon,
+                    }
+                )
+            updated_at[item.session_id] = max(
+                item.fixes[-1].timestamp,
+                updated_at.get(item.session_id, item.fixes[-1].timestamp),
+            )
+
+        with self._db.session() as session:
+            for session_id, (_, stops) in targets.items():
+                tracker = self._trackers.get(session_id)
+                if tracker is None:
+                    # Pick up where the last process left off, before this batch is
+                    # inserted so that its fixes are not counted twice.
+                    locations = (
+                        session.query(
+                            VanLocation.created_at, VanLocation.lat, VanLocation.lon
+                        )
+                        .filter(
+                            VanLocation.session_id == session_id,
+                            VanLocation.created_at > now - DWELL_WINDOW,
+                        )
+                        .all()
+                    )
+                    self._trackers[session_id] = DwellTracker(
+                        stops, [LocationFix(*location) for location in locations]
+                    )
+                elif tracker.stops is not stops:
+                    # The route network was reloaded, so start over on the new stops.
+                    self._trackers[session_id] = DwellTracker(stops, tracker.fixes())
+
+            session.execute(insert(VanLocation), rows)
+
+            for item in batch:
+                tracker = self._trackers.get(item.session_id)
+                if tracker is not None:
+                    for fix in item.fixes:
+                        tracker.add(fix)
+
+            stop_indices: Dict[int, int] = {}
+            for session_id, (stop_index, _) in targets.items():
+                tracker = self._trackers[session_id]
+                tracker.expire(now)
+                stop_indices[session_id] = tracker.stop_index(stop_index)
+
+            updates: List[Dict[str, object]] = []
+            for session_id, timestamp in updated_at.items():
+                values: Dict[str, object] = {"id": session_id, "updated_at": timestamp}
+                if session_id in stop_indices:
+                    values["stop_index"] = stop_indices[session_id]
+                updates.append(values)
+            session.execute(update(VanTrackerSession), updates)
+            session.commit()
+        return stop_indices
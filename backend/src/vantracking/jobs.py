@@ -0,0 +1,90 @@
+"""
+Makes sure that the jobs meant to run once for the whole backend do, however many
+workers it runs with.
+
+On Postgres, every worker holds a shared advisory lock for as long as it runs, and
+only a worker that can take it exclusively, because no other worker is running, cleans
+up after the previous run of the backend. Other workers wait for it to finish before
+they join. Periodic jobs take an advisory lock of their own for every run, and a
+worker that cannot take it skips that run, since another worker is doing it. Every
+other database only ever has one worker, so every lock is granted right away.
+"""
+
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+from sqlalchemy import text
+from src.db import connect_unpooled
+
+# Advisory lock keys, which only have to be unique within this backend.
+LOCK_WORKERS = 0x0C47_0001
+LOCK_RETENTION = 0x0C47_0002
+LOCK_COMPACTION = 0x0C47_0003
+
+
+def is_postgres(db) -> bool:
+    return db.engine.dialect.name == "postgresql"
+
+
+@contextmanager
+def job_lock(db, key: int) -> Iterator[bool]:
+    """
+    Tries to take the lock of a job for the duration, and yields whether it did. The
+    lock is held by a connection outside of any session, so the job can commit as
+    often as it likes.
+    """
+    if not is_postgres(db):
+        yield True
+        return
+    with db.engine.connect() as connection:
+        acquired = connection.execute(
+            text("SELECT pg_try_advisory_lock(:key)"), {"key": key}
+        ).scalar()
+        try:
+            yield bool(acquired)
+        finally:
+            if acquired:
+                connection.execute(
+                    text("SELECT pg_advisory_unlock(:key)"), {"key": key}
+                )
+
+
+class WorkerRegistration:
+    """
+    Registers this worker as running until it is closed, on a connection of its own.
+    """
+
+    def __init__(self, db) -> None:
+        self._db = db
+        self._connection: Any = None
+
+    def join(self, clean_up: Callable[[], None]) -> bool:
+        """
+        Joins the running workers. If there are none, clean_up is called first,
+        before any other worker can join. Returns whether it was.
+        """
+        if not is_postgres(self._db):
+            clean_up()
+            return True
+        self._connection = connect_unpooled(self._db.engine)
+        with self._connection.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", (LOCK_WORKERS,))
+            (first,) = cursor.fetchone()
+            if first:
+                try:
+                    clean_up()
+                finally:
+                    # Held by this connection already, so this never waits.
+                    cursor.execute(
+                        "SELECT pg_advisory_lock_shared(%s)", (LOCK_WORKERS,)
+                    )
+                    cursor.execute("SELECT pg_advisory_unlock(%s)", (LOCK_WORKERS,))
+            else:
+                # Waits for a first worker still cleaning up.
+                cursor.execute("SELECT pg_advisory_lock_shared(%s)", (LOCK_WORKERS,))
+        return bool(first)
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
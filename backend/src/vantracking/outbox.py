@@ -0,0 +1,175 @@
+"""
+Defines the bounded outgoing queue that sits in front of every websocket.
+
+Frames are put on the queue without waiting and sent by a task of the connection's
+own, so whoever produces them, a broadcast in particular, never waits on a slow
+client. A frame that carries the client's whole state replaces everything still
+queued, so a client that falls behind skips straight to the latest state. Clients
+that stay behind past a deadline, from the moment their queue fills up until it is
+drained again, are disconnected.
+
+Anything that can be sent text and bytes and closed can sit behind an outbox, not just
+websockets, so server-sent event streams and long polls are fed the same frames.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Deque, Optional, Protocol, Tuple, Union
+
+MAX_QUEUED_FRAMES = 32
+MAX_QUEUED_BYTES = 256 * 1024
+SEND_DEADLINE = 10.0  # seconds
+
+logger = logging.getLogger(__name__)
+
+Frame = Union[str, bytes]
+
+
+class Connection(Protocol):
+    """
+    The part of a websocket that an outbox sends through.
+    """
+
+    async def send_text(self, data: str) -> None: ...
+
+    async def send_bytes(self, data: bytes) -> None: ...
+
+    async def close(self) -> None: ...
+
+
+async def send_frame(websocket: Connection, frame: Frame) -> None:
+    """
+    Sends an encoded frame, as a binary message if it was encoded to bytes.
+    """
+    if isinstance(frame, bytes):
+        await websocket.send_bytes(frame)
+    else:
+        await websocket.send_text(frame)
+
+
+def frame_size(frame: Frame) -> int:
+    """
+    Returns how many bytes a frame takes up once sent.
+    """
+    if isinstance(frame, str) and not frame.isascii():
+        return len(frame.encode())
+    return len(frame)
+
+
+class Outbox:
+    """
+    The outgoing queue of one websocket. At most a fixed number of frames and bytes
+    are ever queued, and the connection is closed once a send has been stuck, or the
+    queue has not drained since it filled up, for longer than the deadline.
+    """
+
+    def __init__(
+        self,
+        websocket: Connection,
+        max_frames: int = MAX_QUEUED_FRAMES,
+        max_bytes: int = MAX_QUEUED_BYTES,
+        deadline: float = SEND_DEADLINE,
+    ):
+        self.websocket = websocket
+        self._max_frames = max_frames
+        self._max_bytes = max_bytes
+        self._deadline = deadline
+        self._frames: Deque[Tuple[Frame, int]] = deque()
+        self._bytes = 0
+        # When the queue last filled up, if it has not been drained since.
+        self._full_since: Optional[float] = None
+        self._ready = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._disconnected = False
+        self.closed = False
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def put(self, frame: Frame, snapshot: bool = False) -> bool:
+        """
+        Queues a frame to be sent, without waiting. A snapshot replaces every frame
+        still queued. Returns False if the frame was dropped because the queue is
+        full or closed, in which case the caller should follow up with a snapshot.
+        """
+        if self.closed:
+            return False
+        size = frame_size(frame)
+        if snapshot:
+            self._frames.clear()
+            self._bytes = 0
+        elif (
+            len(self._frames) >= self._max_frames
+            or self._bytes + size > self._max_bytes
+        ):
+            now = time.monotonic()
+            if self._full_since is None:
+                self._full_since = now
+            elif now - self._full_since > self._deadline:
+                # The sender closes the connection once its current send is done.
+                self.closed = True
+                self._ready.set()
+            return False
+        self._frames.append((frame, size))
+        self._bytes += size
+        self._ready.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return True
+
+    def _send_timeout(self) -> float:
+        """
+        Returns how long the next send may take, which is less than the deadline if
+        the queue filled up and has not drained since.
+        """
+        if self._full_since is None:
+            return self._deadline
+        return self._full_since + self._deadline - time.monotonic()
+
+    async def _run(self) -> None:
+        try:
+            while not self.closed:
+                await self._ready.wait()
+                self._ready.clear()
+                while self._frames and not self.closed:
+                    frame, size = self._frames.popleft()
+                    self._bytes -= size
+                    await asyncio.wait_for(
+                        send_frame(self.websocket, frame), self._send_timeout()
+                    )
+                # The client caught up.
+                self._full_since = None
+        except asyncio.TimeoutError:
+            pass
+        except Exception:  # pylint: disable=broad-exception-caught
+            # The client went away mid-send, the handler will clean up after it.
+            self.closed = True
+            return
+        self.closed = True
+        self._frames.clear()
+        self._bytes = 0
+        logger.info("Disconnecting a websocket that stopped receiving")
+        self._disconnected = True
+        try:
+            await self.websocket.close()
+        except Exception:  # pylint: disable=broad-exception-caught
+            pass
+
+    async def close(self, disconnect: bool = False) -> None:
+        """
+        Stops sending. Anything still queued is dropped. With disconnect, the
+        connection is closed too, unless the outbox already closed it, since a
+        connection cannot be closed twice.
+        """
+        self.closed = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if disconnect and not self._disconnected:
+            self._disconnected = True
+            await self.websocket.close()
@@ -0,0 +1,229 @@
+"""
+Defines the partitioning and retention of van locations.
+
+On PostgreSQL, van_location is partitioned by day. Partitions are created a couple of
+days ahead of time, and once a partition is older than the retention period its
+locations are averaged per session and minute into van_location_history and the
+partition is dropped. Every other database stores van_location as a plain table, where
+the same days are emulated by ranges of created_at and rolled up by deleting rows.
+
+The live paths only ever ask for locations of running sessions, always bounded from
+below by a timestamp, so on PostgreSQL they are pruned to the latest partitions.
+"""
+
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import delete, func, insert, text
+from sqlalchemy.orm import Session
+from src.model.van_location import VanLocation
+from src.model.van_location_history import VanLocationHistory
+from src.vantracking.jobs import LOCK_RETENTION, job_lock
+
+PARTITION_SPAN = timedelta(days=1)
+PARTITION_PREFIX = "van_location_p"
+RETENTION = timedelta(days=14)
+PARTITIONS_AHEAD = 2
+RETENTION_INTERVAL = timedelta(hours=1)
+
+logger = logging.getLogger(__name__)
+
+
+class Partition(NamedTuple):
+    """
+    A day of van locations, from start inclusive to end exclusive, in UTC.
+    """
+
+    name: str
+    start: datetime
+    end: datetime
+
+
+def day_start(moment: datetime) -> datetime:
+    return moment.astimezone(timezone.utc).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
+
+
+def partition_for(moment: datetime) -> Partition:
+    start = day_start(moment)
+    return Partition(f"{PARTITION_PREFIX}{start:%Y%m%d}", start, start + PARTITION_SPAN)
+
+
+def _timestamp_literal(moment: datetime) -> str:
+    # van_location stores naive UTC timestamps.
+    return f"'{moment.astimezone(timezone.utc).replace(tzinfo=None).isoformat()}'"
+
+
+class LocationPartitions:
+    """
+    Manages the daily partitions of van_location.
+    """
+
+    def __init__(
+        self, retention: timedelta = RETENTION, ahead: int = PARTITIONS_AHEAD
+    ) -> None:
+        self.retention = retention
+        self.ahead = ahead
+
+    @staticmethod
+    def _native(session: Session) -> bool:
+        return session.get_bind().dialect.name == "postgresql"
+
+    def partitions(self, session: Session) -> List[Partition]:
+        """
+        Returns the partitions of van_location, oldest first.
+        """
+        if self._native(session):
+            names = session.execute(
+                text(
+                    "SELECT child.relname FROM pg_inherits "
+                    "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+                    "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+                    "WHERE parent.relname = 'van_location'"
+                )
+            ).scalars()
+            partitions = []
+            for name in names:
+                if not name.startswith(PARTITION_PREFIX):
+                    continue  # The default partition
+                start = datetime.strptime(
+                    name[len(PARTITION_PREFIX) :], "%Y%m%d"
+                ).replace(tzinfo=timezone.utc)
+                partitions.append(Partition(name, start, start + PARTITION_SPAN))
+            return sorted(partitions, key=lambda partition: partition.start)
+
+        # Emulated partitions are the days that hold any locations.
+        partitions = []
+        oldest: Optional[datetime] = session.query(
+            func.min(VanLocation.created_at)  # pylint: disable=not-callable
+        ).scalar()
+        while oldest is not None:
+            partition = partition_for(oldest)
+            partitions.append(partition)
+            oldest = (
+                session.query(
+                    func.min(VanLocation.created_at)  # pylint: disable=not-callable
+                )
+                .filter(VanLocation.created_at >= partition.end)
+                .scalar()
+            )
+        return partitions
+
+    def ensure(self, session: Session, now: datetime) -> None:
+        """
+        Creates the partitions from today up to a few days ahead.
+        """
+        if not self._native(session):
+            return
+        for day in range(self.ahead + 1):
+            partition = partition_for(now + day * PARTITION_SPAN)
+            session.execute(
+                text(
+                    f"CREATE TABLE IF NOT EXISTS {partition.name} PARTITION OF "
+                    f"van_location FOR VALUES FROM ({_timestamp_literal(partition.start)}) "
+                    f"TO ({_timestamp_literal(partition.end)})"
+                )
+            )
+
+    def roll_up(self, session: Session, now: datetime) -> List[Partition]:
+        """
+        Moves every partition that is entirely older than the retention period into
+        the history table, and returns the partitions that were rolled up.
+        """
+        cutoff = now - self.retention
+        expired = [
+            partition
+            for partition in self.partitions(session)
+            if partition.end <= cutoff
+        ]
+        for partition in expired:
+            if self._native(session):
+                session.execute(
+                    text(
+                        "INSERT INTO van_location_history "
+                        "(session_id, bucket, lat, lon, samples) "
+                        "SELECT session_id, date_trunc('minute', created_at), "
+                        f"avg(lat), avg(lon), count(*) FROM {partition.name} "
+                        "GROUP BY 1, 2"
+                    )
+                )
+                session.execute(text(f"DROP TABLE {partition.name}"))
+            else:
+                self._emulate_roll_up(session, partition)
+        return expired
+
+    @staticmethod
+    def _emulate_roll_up(session: Session, partition: Partition) -> None:
+        buckets: Dict[Tuple[int, datetime], List[Tuple[float, float]]] = defaultdict(
+            list
+        )
+        locations = session.query(
+            VanLocation.session_id,
+            VanLocation.created_at,
+            VanLocation.lat,
+            VanLocation.lon,
+        ).filter(
+            VanLocation.created_at >= partition.start,
+            VanLocation.created_at < partition.end,
+        )
+        for session_id, created_at, lat, lon in locations:
+            bucket = created_at.replace(second=0, microsecond=0)
+            buckets[(session_id, bucket)].append((lat, lon))
+        if buckets:
+            session.execute(
+                insert(VanLocationHistory),
+                [
+                    {
+                        "session_id": session_id,
+                        "bucket": bucket,
+                        "lat": sum(lat for lat, _ in points) / len(points),
+                        "lon": sum(lon for _, lon in points) / len(points),
+                        "samples": len(points),
+                    }
+                    for (session_id, bucket), points in buckets.items()
+                ],
+            )
+        session.execute(
+            delete(VanLocation).where(
+                VanLocation.created_at >= partition.start,
+                VanLocation.created_at < partition.end,
+            )
+        )
+
+    def maintain(self, session: Session, now: datetime) -> List[Partition]:
+        """
+        Creates upcoming partitions and rolls up expired ones in one transaction.
+        """
+        self.ensure(session, now)
+        expired = self.roll_up(session, now)
+        session.commit()
+        return expired
+
+
+async def run_retention(
+    db, partitions: LocationPartitions, interval: timedelta = RETENTION_INTERVAL
+) -> None:
+    """
+    Maintains the partitions periodically until cancelled.
+    """
+    while True:
+        try:
+            expired = await asyncio.to_thread(_maintain, db, partitions)
+            if expired:
+                logger.info("Rolled up %d location partitions", len(expired))
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception("Failed to maintain location partitions")
+        await asyncio.sleep(interval.total_seconds())
+
+
+def _maintain(db, partitions: LocationPartitions) -> List[Partition]:
+    with job_lock(db, LOCK_RETENTION) as acquired:
+        if not acquired:
+            # Another worker is maintaining the partitions.
+            return []
+        with db.session() as session:
+            return partitions.maintain(session, datetime.now(timezone.utc))
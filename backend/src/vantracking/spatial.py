@@ -0,0 +1,307 @@
+"""
+Defines a spatial index over a route's stops and the segments between them, and a
+grid over points that move, like the vans themselves.
+
+Items are kept in a tree of bounding boxes, split at the median along the wider side
+of each box, and queried best first. Since the distance used by van tracking only scales each
+axis by a factor that depends on the query point, the distance to a box is a lower
+bound for the distance to anything inside it, and the nearest item is found without
+visiting most of the tree.
+
+The tree is built once, which suits stops but not vans, which move every few seconds.
+Vans are kept in a uniform grid instead, where moving one only means moving it
+between two cells, and the ones within a box are found by looking at the cells the
+box covers.
+"""
+
+import heapq
+from math import cos, floor, hypot, inf, radians
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+from src.vantracking.geo import KM_LAT_RATIO, KM_LON_RATIO, distance_meters
+
+if TYPE_CHECKING:
+    from src.vantracking.state import StopPoint
+
+LEAF_SIZE = 4
+GRID_CELL_DEGREES = 0.002  # About 200 meters
+
+Cell = Tuple[int, int]
+
+
+class SegmentMatch(NamedTuple):
+    """
+    The point of a route closest to a query. The segment runs from the stop at the
+    same position to the next stop, and fraction is how far along it the point is.
+    """
+
+    segment: int
+    fraction: float
+    distance: float
+
+
+class _Node:
+    __slots__ = ("min_lat", "min_lon", "max_lat", "max_lon", "children", "items")
+
+    def __init__(
+        self, boxes: List[Tuple[float, float, float, float]], items: List[int]
+    ):
+        self.min_lat = min(boxes[item][0] for item in items)
+        self.min_lon = min(boxes[item][1] for item in items)
+        self.max_lat = max(boxes[item][2] for item in items)
+        self.max_lon = max(boxes[item][3] for item in items)
+        self.children: Tuple["_Node", ...] = ()
+        self.items: List[int] = []
+        if len(items) <= LEAF_SIZE:
+            self.items = items
+            return
+        # Split the wider side at the median of the box centers.
+        if self.max_lat - self.min_lat >= self.max_lon - self.min_lon:
+            items = sorted(items, key=lambda item: boxes[item][0] + boxes[item][2])
+        else:
+            items = sorted(items, key=lambda item: boxes[item][1] + boxes[item][3])
+        middle = len(items) // 2
+        self.children = (_Node(boxes, items[:middle]), _Node(boxes, items[middle:]))
+
+    def distance(self, lat: float, lon: float, lat_scale: float, lon_scale: float):
+        dlat = max(self.min_lat - lat, 0.0, lat - self.max_lat) * lat_scale
+        dlon = max(self.min_lon - lon, 0.0, lon - self.max_lon) * lon_scale
+        return hypot(dlat, dlon)
+
+
+class _BoxTree:
+    """
+    A static tree over items given by their bounding boxes, as (min lat, min lon, max
+    lat, max lon).
+    """
+
+    def __init__(self, boxes: List[Tuple[float, float, float, float]]):
+        self._root = _Node(boxes, list(range(len(boxes)))) if boxes else None
+
+    def nearest(
+        self, lat: float, lon: float, distance: Callable[[int], float]
+    ) -> Tuple[Optional[int], float]:
+        """
+        Returns the item closest to a point, preferring the lowest item on a tie, and
+        its distance.
+        """
+        if self._root is None:
+            return None, inf
+        lat_scale = KM_LAT_RATIO * 1000
+        lon_scale = KM_LON_RATIO * cos(radians(lat)) * 1000
+        best, best_distance = None, inf
+        heap = [(0.0, 0, self._root)]
+        pushed = 1
+        while heap:
+            node_distance, _, node = heapq.heappop(heap)
+            if node_distance > best_distance:
+                break
+            for item in node.items:
+                item_distance = distance(item)
+                if item_distance < best_distance or (
+                    item_distance == best_distance and best is not None and item < best
+                ):
+                    best, best_distance = item, item_distance
+            for child in node.children:
+                heapq.heappush(
+                    heap,
+                    (child.distance(lat, lon, lat_scale, lon_scale), pushed, child),
+                )
+                pushed += 1
+        return best, best_distance
+
+
+def segment_distance(
+    lat: float, lon: float, start: "StopPoint", end: "StopPoint"
+) -> Tuple[float, float]:
+    """
+    Returns the distance from a point to a segment, along with how far along the
+    segment the closest point is.
+    """
+    lat_scale = KM_LAT_RATIO * 1000
+    lon_scale = KM_LON_RATIO * cos(radians(lat)) * 1000
+    # Project onto a plane centered on the point, where the distance is euclidean.
+    ax, ay = (start.lon - lon) * lon_scale, (start.lat - lat) * lat_scale
+    bx, by = (end.lon - lon) * lon_scale, (end.lat - lat) * lat_scale
+    dx, dy = bx - ax, by - ay
+    length = dx * dx + dy * dy
+    fraction = 0.0
+    if length:
+        fraction = min(max(-(ax * dx + ay * dy) / length, 0.0), 1.0)
+    return hypot(ax + fraction * dx, ay + fraction * dy), fraction
+
+
+class RouteIndex:
+    """
+    Answers nearest stop and nearest segment queries for a route. Routes are loops, so
+    the last segment runs from the last stop back to the first one.
+    """
+
+    def __init__(self, stops: Sequence["StopPoint"]):
+        self.stops = stops
+        self._stops = _BoxTree(
+            [(stop.lat, stop.lon, stop.lat, stop.lon) for stop in stops]
+        )
+        self._segments = _BoxTree(
+            [
+                (
+                    min(stop.lat, after.lat),
+                    min(stop.lon, after.lon),
+                    max(stop.lat, after.lat),
+                    max(stop.lon, after.lon),
+                )
+                for stop, after in self._segment_stops()
+            ]
+        )
+
+    def _segment_stops(self) -> List[Tuple["StopPoint", "StopPoint"]]:
+        if len(self.stops) < 2:
+            return []
+        return list(zip(self.stops, [*self.stops[1:], self.stops[0]]))
+
+    def nearest_stop(self, lat: float, lon: float) -> Optional[int]:
+        """
+        Returns the position of the stop closest to a point, or None if the route has
+        no stops.
+        """
+        stops = self.stops
+        nearest, _ = self._stops.nearest(
+            lat,
+            lon,
+            lambda i: distance_meters(lat, lon, stops[i].lat, stops[i].lon),
+        )
+        return nearest
+
+    def nearest_segment(self, lat: float, lon: float) -> Optional[SegmentMatch]:
+        """
+        Returns the point on the route closest to a point, or None if the route has
+        fewer than two stops.
+        """
+        stops = self.stops
+        count = len(stops)
+        nearest, distance = self._segments.nearest(
+            lat,
+            lon,
+            lambda i: segment_distance(lat, lon, stops[i], stops[(i + 1) % count])[0],
+        )
+        if nearest is None:
+            return None
+        _, fraction = segment_distance(
+            lat, lon, stops[nearest], stops[(nearest + 1) % count]
+        )
+        return SegmentMatch(nearest, fraction, distance)
+
+
+class BoundingBox(NamedTuple):
+    """
+    An area between two latitudes and two longitudes, edges included.
+    """
+
+    min_lat: float
+    min_lon: float
+    max_lat: float
+    max_lon: float
+
+    def contains(self, lat: float, lon: float) -> bool:
+        return (
+            self.min_lat <= lat <= self.max_lat and self.min_lon <= lon <= self.max_lon
+        )
+
+
+def grid_cell(lat: float, lon: float) -> Cell:
+    return floor(lat / GRID_CELL_DEGREES), floor(lon / GRID_CELL_DEGREES)
+
+
+def grid_cells(box: BoundingBox) -> Iterator[Cell]:
+    """
+    Returns every grid cell that overlaps a box.
+    """
+    min_row, min_column = grid_cell(box.min_lat, box.min_lon)
+    max_row, max_column = grid_cell(box.max_lat, box.max_lon)
+    for row in range(min_row, max_row + 1):
+        for column in range(min_column, max_column + 1):
+            yield row, column
+
+
+def grid_cell_count(box: BoundingBox) -> int:
+    min_row, min_column = grid_cell(box.min_lat, box.min_lon)
+    max_row, max_column = grid_cell(box.max_lat, box.max_lon)
+    return (max_row - min_row + 1) * (max_column - min_column + 1)
+
+
+class PointGrid:
+    """
+    Keeps moving points, keyed by a string like a van's GUID, in square grid cells, so
+    that the points within a box can be found without looking at every point.
+    """
+
+    def __init__(self) -> None:
+        self._points: Dict[str, Tuple[float, float, Cell]] = {}
+        self._cells: Dict[Cell, Set[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._points)
+
+    def move(self, key: str, lat: float, lon: float) -> Optional[Cell]:
+        """
+        Adds a point or moves it to a new position, and returns the cell it was in
+        before, if any.
+        """
+        cell = grid_cell(lat, lon)
+        previous = self._points.get(key)
+        self._points[key] = (lat, lon, cell)
+        if previous is None:
+            self._cells.setdefault(cell, set()).add(key)
+            return None
+        if previous[2] != cell:
+            self._discard(key, previous[2])
+            self._cells.setdefault(cell, set()).add(key)
+        return previous[2]
+
+    def remove(self, key: str) -> Optional[Cell]:
+        """
+        Removes a point, and returns the cell it was in, if any.
+        """
+        previous = self._points.pop(key, None)
+        if previous is None:
+            return None
+        self._discard(key, previous[2])
+        return previous[2]
+
+    def _discard(self, key: str, cell: Cell) -> None:
+        keys = self._cells[cell]
+        keys.discard(key)
+        if not keys:
+            del self._cells[cell]
+
+    def within(self, box: BoundingBox) -> List[str]:
+        """
+        Returns the points within a box.
+        """
+        candidates: Iterable[str]
+        # A box covering more cells than there are points is quicker to check point
+        # by point.
+        if grid_cell_count(box) > len(self._points):
+            candidates = self._points
+        else:
+            candidates = [
+                key for cell in grid_cells(box) for key in self._cells.get(cell, ())
+            ]
+        keys: List[str] = []
+        for key in candidates:
+            lat, lon, _ = self._points[key]
+            if box.contains(lat, lon):
+                keys.append(key)
+        return keys
@@ -0,0 +1,361 @@
+"""
+Defines the in-memory fleet state shared by all of the van read and write paths.
+
+The database remains the source of record, but every van read is served from this
+state so that a fleet snapshot does not need to touch the database at all. Ingest
+updates the state as soon as a fix is accepted, before its write is committed.
+"""
+
+import secrets
+from datetime import datetime, timedelta
+from typing import Callable, Dict, FrozenSet, Iterator, List, NamedTuple, Optional
+
+from sqlalchemy import func
+from src.model.route import Route
+from src.model.route_stop import RouteStop
+from src.model.stop import Stop
+from src.model.van_location import VanLocation
+from src.model.van_tracker_session import VanTrackerSession
+from src.vantracking.geo import StopArray
+from src.vantracking.spatial import BoundingBox, Cell, PointGrid, RouteIndex, grid_cell
+
+SESSION_LIFETIME = timedelta(hours=12)
+
+
+class LocationFix(NamedTuple):
+    """
+    A single location reported by a van's tracker.
+    """
+
+    timestamp: datetime
+    lat: float
+    lon: float
+
+
+class StopPoint(NamedTuple):
+    """
+    A stop on a route, reduced to what the van tracking code needs.
+    """
+
+    id: int
+    lat: float
+    lon: float
+
+
+class RouteState:
+    """
+    A route's color and its stops in route order.
+    """
+
+    __slots__ = ("id", "color", "stops", "_points", "_index")
+
+    def __init__(self, route_id: int, color: str, stops: List[StopPoint]):
+        self.id = route_id
+        self.color = color
+        self.stops = stops
+        self._points: Optional[StopArray] = None
+        self._index: Optional[RouteIndex] = None
+
+    @property
+    def points(self) -> StopArray:
+        """
+        The stops as arrays, built the first time they are needed.
+        """
+        if self._points is None:
+            self._points = StopArray(self.stops)
+        return self._points
+
+    @property
+    def index(self) -> RouteIndex:
+        """
+        A spatial index over the stops, built the first time it is needed. Routes are
+        rebuilt whenever the network changes, so the index never goes stale.
+        """
+        if self._index is None:
+            self._index = RouteIndex(self.stops)
+        return self._index
+
+
+class VanState:
+    """
+    A compact record of a van's most recent tracker session and its latest fix.
+    """
+
+    __slots__ = (
+        "guid",
+        "session_id",
+        "route_id",
+        "stop_index",
+        "dead",
+        "created_at",
+        "updated_at",
+        "located_at",
+        "lat",
+        "lon",
+    )
+
+    def __init__(
+        self,
+        guid: str,
+        session_id: int,
+        route_id: int,
+        stop_index: int,
+        dead: bool,
+        created_at: datetime,
+        updated_at: datetime,
+    ):
+        self.guid = guid
+        self.session_id = session_id
+        self.route_id = route_id
+        self.stop_index = stop_index
+        self.dead = dead
+        self.created_at = created_at
+        self.updated_at = updated_at
+        self.located_at: Optional[datetime] = None
+        self.lat = 0.0
+        self.lon = 0.0
+
+    @classmethod
+    def from_session(cls, tracker_session: VanTrackerSession) -> "VanState":
+        return cls(
+            guid=str(tracker_session.van_guid),
+            session_id=tracker_session.id,
+            route_id=tracker_session.route_id,
+            stop_index=tracker_session.stop_index,
+            dead=tracker_session.dead,
+            created_at=tracker_session.created_at,
+            updated_at=tracker_session.updated_at,
+        )
+
+    def is_alive(self, now: datetime) -> bool:
+        return not self.dead and now - self.created_at < SESSION_LIFETIME
+
+    def __repr__(self) -> str:
+        return f"<VanState guid={self.guid} session_id={self.session_id} route_id={self.route_id} stop_index={self.stop_index} dead={self.dead} lat={self.lat} lon={self.lon}>"
+
+
+def is_stale(van: VanState, current: VanState) -> bool:
+    """
+    Returns whether a record of a van is older than the current one. Sessions only
+    ever move forward, and within a session, so do the update and fix times, and a
+    dead session never comes back.
+    """
+    if van.session_id != current.session_id:
+        return van.session_id < current.session_id
+    if van.updated_at < current.updated_at or (current.dead and not van.dead):
+        return True
+    return current.located_at is not None and (
+        van.located_at is None or van.located_at < current.located_at
+    )
+
+
+class VanChange(NamedTuple):
+    """
+    Describes a change to a van's record. The route IDs include the route the van was
+    on before the change, and the grid cells the cell it was in, so that anything
+    watching a route or an area also learns when a van leaves it. Every change to the
+    fleet gets the next sequence number.
+    """
+
+    van: VanState
+    route_ids: FrozenSet[int]
+    sequence: int
+    cells: FrozenSet[Cell] = frozenset()
+
+
+class FleetState:
+    """
+    Process-wide state of every van's latest tracker session, keyed by van GUID, along
+    with the route network those sessions run on.
+    """
+
+    def __init__(self) -> None:
+        self._vans: Dict[str, VanState] = {}
+        self._routes: Dict[int, RouteState] = {}
+        # Where every van with a location last was.
+        self._positions = PointGrid()
+        self._listeners: List[Callable[[VanChange], None]] = []
+        self.sequence = 0
+        # Sequence numbers start over with the process and differ between workers, so
+        # a client resuming from one also presents the epoch it belongs to. Epochs are
+        # random, since workers can start at the same time.
+        self.epoch = secrets.randbits(32)
+
+    def add_listener(self, listener: Callable[[VanChange], None]) -> None:
+        """
+        Registers a callback invoked after every change to a van. Listeners are called
+        synchronously from the ingest path, so they must not block.
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[VanChange], None]) -> None:
+        self._listeners.remove(listener)
+
+    def _notify(self, van: VanState, *route_ids: int) -> None:
+        self.sequence += 1
+        if van.located_at is not None:
+            previous = self._positions.move(van.guid, van.lat, van.lon)
+            cells = {grid_cell(van.lat, van.lon)}
+        else:
+            previous = self._positions.remove(van.guid)
+            cells = set()
+        if previous is not None:
+            cells.add(previous)
+        change = VanChange(
+            van, frozenset((van.route_id, *route_ids)), self.sequence, frozenset(cells)
+        )
+        for listener in self._listeners:
+            listener(change)
+
+    def load(self, session) -> None:
+        """
+        Populates the state from the database. This is only meant to be called on
+        startup, after which the state is kept current by the ingest paths.
+        """
+        self.refresh_routes(session)
+
+        latest = (
+            session.query(
+                VanTrackerSession.van_guid,
+                func.max(  # pylint: disable=not-callable
+                    VanTrackerSession.created_at
+                ).label("created_at"),
+            )
+            .group_by(VanTrackerSession.van_guid)
+            .subquery()
+        )
+        tracker_sessions = (
+            session.query(VanTrackerSession)
+            .join(
+                latest,
+                (VanTrackerSession.van_guid == latest.c.van_guid)
+                & (VanTrackerSession.created_at == latest.c.created_at),
+            )
+            .all()
+        )
+        vans: Dict[str, VanState] = {}
+        for tracker_session in tracker_sessions:
+            van = VanState.from_session(tracker_session)
+            location = (
+                session.query(VanLocation)
+                .filter(
+                    VanLocation.session_id == tracker_session.id,
+                    # Bounding the time lets this skip older partitions.
+                    VanLocation.created_at >= tracker_session.created_at,
+                )
+                .order_by(VanLocation.created_at.desc())
+                .first()
+            )
+            if location is not None:
+                van.located_at = location.created_at
+                van.lat = location.lat
+                van.lon = location.lon
+            vans[van.guid] = van
+        self._vans = vans
+        self._positions = PointGrid()
+        for van in vans.values():
+            if van.located_at is not None:
+                self._positions.move(van.guid, van.lat, van.lon)
+
+    def refresh_routes(self, session) -> None:
+        """
+        Reloads the route network. Must be called whenever routes or stops change.
+        """
+        routes: Dict[int, RouteState] = {
+            route.id: RouteState(route.id, route.color, [])
+            for route in session.query(Route).all()
+        }
+        route_stops = (
+            session.query(RouteStop.route_id, Stop.id, Stop.lat, Stop.lon)
+            .join(Stop, RouteStop.stop_id == Stop.id)
+            .order_by(RouteStop.route_id, RouteStop.position)
+            .all()
+        )
+        for route_id, stop_id, lat, lon in route_stops:
+            if route_id in routes:
+                routes[route_id].stops.append(StopPoint(stop_id, lat, lon))
+        # Swap the whole mapping so readers never observe a partially built network.
+        self._routes = routes
+
+    def route(self, route_id: int) -> Optional[RouteState]:
+        return self._routes.get(route_id)
+
+    def van(self, guid: str) -> Optional[VanState]:
+        return self._vans.get(str(guid))
+
+    def vans(self) -> Iterator[VanState]:
+        return iter(list(self._vans.values()))
+
+    def vans_within(self, box: BoundingBox) -> List[VanState]:
+        """
+        Returns the vans last located within a box.
+        """
+        return [self._vans[guid] for guid in self._positions.within(box)]
+
+    def active_van(self, guid: str, now: datetime) -> Optional[VanState]:
+        van = self.van(guid)
+        if van is None or not van.is_alive(now):
+            return None
+        return van
+
+    def begin_session(self, tracker_session: VanTrackerSession) -> VanState:
+        """
+        Replaces the van's record with a freshly started tracker session.
+        """
+        van = VanState.from_session(tracker_session)
+        previous = self._vans.get(van.guid)
+        self._vans[van.guid] = van
+        if previous is not None:
+            self._notify(van, previous.route_id)
+        else:
+            self._notify(van)
+        return van
+
+    def apply_van(self, van: VanState) -> None:
+        """
+        Brings a van's record in line with one kept by another worker. A record of the
+        same session is updated in place, since the ingest path may hold on to it.
+        Workers publish independently, so records can arrive out of order, and one of
+        an older session, or older than the current one of the same session, is
+        ignored.
+        """
+        current = self._vans.get(van.guid)
+        if current is not None and is_stale(van, current):
+            return
+        if current is None or current.session_id != van.session_id:
+            self._vans[van.guid] = van
+            if current is not None:
+                self._notify(van, current.route_id)
+            else:
+                self._notify(van)
+            return
+        previous_route_id = current.route_id
+        for field in VanState.__slots__:
+            setattr(current, field, getattr(van, field))
+        self._notify(current, previous_route_id)
+
+    def record_fix(
+        self,
+        van: VanState,
+        timestamp: datetime,
+        lat: float,
+        lon: float,
+        stop_index: int,
+    ) -> None:
+        van.located_at = timestamp
+        van.lat = lat
+        van.lon = lon
+        van.updated_at = timestamp
+        van.stop_index = stop_index
+        self._notify(van)
+
+    def update_stop_index(self, van: VanState, stop_index: int) -> None:
+        if van.stop_index != stop_index:
+            van.stop_index = stop_index
+            self._notify(van)
+
+    def kill_all(self) -> None:
+        for van in list(self._vans.values()):
+            if not van.dead:
+                van.dead = True
+                self._notify(van)
@@ -0,0 +1,118 @@
+"""
+Lets clients that cannot keep a websocket open, like kiosks and integrations behind
+proxies, subscribe over plain HTTP instead of polling the REST endpoints.
+
+A server-sent event stream or a long poll sits behind an outbox just like a websocket,
+and joins the same subscriptions, so it is put the very frames serialized for the
+websockets sharing its query. Between changes, a client costs nothing but an open
+request.
+"""
+
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+import anyio
+from src.vantracking.outbox import Frame, Outbox
+
+# Proxies tend to close requests that have been quiet for a while, so streams send a
+# comment whenever no event went out for this long.
+KEEPALIVE_INTERVAL = 15.0  # seconds
+KEEPALIVE = ":\n\n"
+
+# How long a long poll waits for something to change before returning nothing.
+POLL_TIMEOUT = 25.0  # seconds
+
+EVENT_STREAM_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+class EventStream:
+    """
+    Stands in for a websocket behind an outbox, turning every frame sent into a
+    server-sent event. A send waits until the response has taken the previous event,
+    so a slow client backs up its own outbox the same way a slow websocket does.
+    Events are always text, since that is all an event stream can carry.
+    """
+
+    def __init__(self, keepalive: float = KEEPALIVE_INTERVAL):
+        self._keepalive = keepalive
+        self._events: asyncio.Queue[Optional[str]] = asyncio.Queue(maxsize=1)
+        self.closed = False
+
+    async def send_text(self, data: str) -> None:
+        await self._events.put(f"data: {data}\n\n")
+
+    async def send_bytes(self, data: bytes) -> None:
+        raise TypeError("Event streams can only carry text")
+
+    async def close(self) -> None:
+        self.closed = True
+        if not self._events.full():
+            self._events.put_nowait(None)
+
+    async def events(self) -> AsyncIterator[str]:
+        while not self.closed:
+            try:
+                event = await asyncio.wait_for(self._events.get(), self._keepalive)
+            except asyncio.TimeoutError:
+                yield KEEPALIVE
+                continue
+            if event is None or self.closed:
+                return
+            yield event
+
+
+async def stream_events(
+    stream: EventStream,
+    outbox: Outbox,
+    join: Callable[[], Callable[[], Awaitable[None]]],
+) -> AsyncIterator[str]:
+    """
+    Joins the subscription feeding a stream, yields the events of the stream until
+    either side closes it, and then leaves the subscription. Join puts the first
+    frame on the outbox and returns how to leave. It is only called once the
+    response starts, so a client that goes away before then leaves nothing behind.
+    """
+    leave = join()
+    try:
+        async for event in stream.events():
+            yield event
+    finally:
+        # The response is cancelled when the client goes away, and the subscription
+        # has to be left anyway.
+        with anyio.CancelScope(shield=True):
+            await outbox.close()
+            await leave()
+
+
+class PollResult:
+    """
+    Stands in for a websocket behind an outbox for a long poll, keeping the first
+    frame sent to it as the response.
+    """
+
+    def __init__(self) -> None:
+        self._frame: asyncio.Future[Optional[Frame]] = (
+            asyncio.get_running_loop().create_future()
+        )
+
+    def _set(self, frame: Optional[Frame]) -> None:
+        if not self._frame.done():
+            self._frame.set_result(frame)
+
+    async def send_text(self, data: str) -> None:
+        self._set(data)
+
+    async def send_bytes(self, data: bytes) -> None:
+        self._set(data)
+
+    async def close(self) -> None:
+        self._set(None)
+
+    async def wait(self, timeout: float = POLL_TIMEOUT) -> Optional[Frame]:
+        """
+        Returns the first frame sent, or None if nothing was sent before the timeout.
+        """
+        try:
+            return await asyncio.wait_for(asyncio.shield(self._frame), timeout)
+        except asyncio.TimeoutError:
+            return None
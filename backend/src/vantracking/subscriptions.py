@@ -0,0 +1,366 @@
+"""
+Tracks standing subscriptions so that changes to the fleet state can be pushed to
+websocket clients instead of having them poll.
+
+Most clients ask the same handful of questions, like every van or the vans on one
+route. Subscriptions are keyed by their canonical query, and clients asking the same
+one share a subscription, so that its result is computed and serialized once per
+change and the same frame is put on every client's outbox.
+
+Subscriptions are also indexed by the van and the routes they are about, so that a
+change only touches the subscriptions that could be interested in it, and a location
+report costs as much as the clients watching that van rather than every client
+connected. Subscriptions limited to a viewport on the map are indexed by the grid
+cells the viewport covers instead, and are touched whenever a van moves within, into
+or out of those cells.
+"""
+
+import asyncio
+from datetime import datetime
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+from src.vantracking.outbox import Frame, Outbox
+from src.vantracking.spatial import BoundingBox, grid_cell, grid_cell_count, grid_cells
+from src.vantracking.state import VanChange
+
+# Viewports covering more grid cells than this are not indexed by cell, and are
+# touched by every change instead.
+MAX_VIEWPORT_CELLS = 256
+
+# A stop filter in canonical form, as pairs of a stop ID and the route IDs asked about
+# at that stop, both sorted.
+StopFilter = Tuple[Tuple[int, Tuple[int, ...]], ...]
+
+
+class VanSubscription:
+    """
+    A van query registered by one or more clients. A subscription is marked as
+    changed whenever a van it could be interested in changes, which is any van if it
+    has neither a GUID nor routes, and the owner of the
+    subscription then re-evaluates the query once and pushes the result to every
+    member. Subscriptions sending deltas keep what was last sent to all of them, as of
+    the sequence number of the fleet at the time. A subscription with a viewport only
+    has one member, since the viewport moves with that client's map.
+    """
+
+    __slots__ = (
+        "key",
+        "guid",
+        "route_ids",
+        "viewport",
+        "members",
+        "sent",
+        "sequence",
+        "task",
+        "_changed",
+        "_guids",
+    )
+
+    def __init__(
+        self,
+        guid: Optional[str] = None,
+        route_ids: Optional[Set[int]] = None,
+        key: Hashable = None,
+        viewport: Optional[BoundingBox] = None,
+    ):
+        self.key = key
+        self.guid = guid
+        self.route_ids = route_ids
+        self.viewport = viewport
+        self.members: Set[Outbox] = set()
+        self.sent: Optional[Dict[str, Any]] = None
+        self.sequence = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+        self._guids: Set[str] = set()
+
+    def touched_by(self, change: VanChange) -> bool:
+        """
+        Returns whether the van of a change could have matched the query, either
+        before or after the change.
+        """
+        if self.guid is not None and change.van.guid != self.guid:
+            return False
+        if self.route_ids is not None and self.route_ids.isdisjoint(change.route_ids):
+            return False
+        if self.viewport is not None:
+            low = grid_cell(self.viewport.min_lat, self.viewport.min_lon)
+            high = grid_cell(self.viewport.max_lat, self.viewport.max_lon)
+            return any(
+                low[0] <= row <= high[0] and low[1] <= column <= high[1]
+                for row, column in change.cells
+            )
+        return True
+
+    def mark_changed(self, guid: str) -> None:
+        self._guids.add(guid)
+        self._changed.set()
+
+    async def wait(self) -> Set[str]:
+        """
+        Waits until at least one matching change has occurred since the last wait, and
+        returns the GUIDs of the vans that changed. Any number of changes that happen
+        in between are coalesced into one wakeup.
+        """
+        await self._changed.wait()
+        self._changed.clear()
+        guids, self._guids = self._guids, set()
+        return guids
+
+
+def index(
+    subscriptions: Dict[Any, Set[Any]], keys: Iterable[Any], subscription: Any
+) -> None:
+    for key in keys:
+        subscriptions.setdefault(key, set()).add(subscription)
+
+
+def unindex(
+    subscriptions: Dict[Any, Set[Any]], keys: Iterable[Any], subscription: Any
+) -> None:
+    for key in keys:
+        indexed = subscriptions.get(key)
+        if indexed is not None:
+            indexed.discard(subscription)
+            if not indexed:
+                del subscriptions[key]
+
+
+class VanSubscriptionRegistry:
+    """
+    Holds every active van subscription by its canonical query, and indexes them by
+    the van or the routes they are about. It is registered as a fleet state listener.
+    """
+
+    def __init__(self) -> None:
+        self._subscriptions: Dict[Hashable, VanSubscription] = {}
+        self._by_guid: Dict[str, Set[VanSubscription]] = {}
+        self._by_route: Dict[int, Set[VanSubscription]] = {}
+        self._unfiltered: Set[VanSubscription] = set()
+        self._by_cell: Dict[Tuple[int, int], Set[VanSubscription]] = {}
+
+    def __len__(self) -> int:
+        return len(self._subscriptions)
+
+    def clients(self) -> int:
+        return sum(
+            len(subscription.members) for subscription in self._subscriptions.values()
+        )
+
+    def group_sizes(self) -> List[int]:
+        return sorted(
+            (
+                len(subscription.members)
+                for subscription in self._subscriptions.values()
+            ),
+            reverse=True,
+        )
+
+    def join(
+        self,
+        key: Hashable,
+        outbox: Outbox,
+        guid: Optional[str] = None,
+        route_ids: Optional[Set[int]] = None,
+        viewport: Optional[BoundingBox] = None,
+    ) -> VanSubscription:
+        """
+        Adds a client to the subscription for a canonical query, creating it if no
+        other client has the same one. A new subscription has no task, and whoever
+        created it is expected to start one that pushes to its members.
+        """
+        subscription = self._subscriptions.get(key)
+        if subscription is None:
+            subscription = VanSubscription(guid, route_ids, key, viewport)
+            self._subscriptions[key] = subscription
+            if viewport is not None:
+                self._index_viewport(subscription, viewport)
+            elif guid is not None:
+                index(self._by_guid, (guid,), subscription)
+            elif route_ids is not None:
+                index(self._by_route, route_ids, subscription)
+            else:
+                self._unfiltered.add(subscription)
+        subscription.members.add(outbox)
+        return subscription
+
+    def leave(self, subscription: VanSubscription, outbox: Outbox) -> bool:
+        """
+        Removes a client from a subscription. Returns True if it was the last one, in
+        which case the subscription is dropped and its owner should stop pushing.
+        """
+        subscription.members.discard(outbox)
+        if subscription.members:
+            return False
+        if self._subscriptions.get(subscription.key) is subscription:
+            del self._subscriptions[subscription.key]
+            if subscription.viewport is not None:
+                self._unindex_viewport(subscription, subscription.viewport)
+            elif subscription.guid is not None:
+                unindex(self._by_guid, (subscription.guid,), subscription)
+            elif subscription.route_ids is not None:
+                unindex(self._by_route, subscription.route_ids, subscription)
+            else:
+                self._unfiltered.discard(subscription)
+        return True
+
+    def move_viewport(
+        self, subscription: VanSubscription, viewport: BoundingBox
+    ) -> None:
+        assert subscription.viewport is not None
+        self._unindex_viewport(subscription, subscription.viewport)
+        subscription.viewport = viewport
+        self._index_viewport(subscription, viewport)
+
+    def _index_viewport(
+        self, subscription: VanSubscription, viewport: BoundingBox
+    ) -> None:
+        if grid_cell_count(viewport) > MAX_VIEWPORT_CELLS:
+            self._unfiltered.add(subscription)
+        else:
+            index(self._by_cell, grid_cells(viewport), subscription)
+
+    def _unindex_viewport(
+        self, subscription: VanSubscription, viewport: BoundingBox
+    ) -> None:
+        if grid_cell_count(viewport) > MAX_VIEWPORT_CELLS:
+            self._unfiltered.discard(subscription)
+        else:
+            unindex(self._by_cell, grid_cells(viewport), subscription)
+
+    def notify(self, change: VanChange) -> None:
+        # A subscription on several of the routes or cells can be marked more than
+        # once, which does no harm.
+        guid = change.van.guid
+        for subscription in self._unfiltered:
+            subscription.mark_changed(guid)
+        for cell in change.cells:
+            for subscription in self._by_cell.get(cell, ()):
+                subscription.mark_changed(guid)
+        for subscription in self._by_guid.get(guid, ()):
+            subscription.mark_changed(guid)
+        for route_id in change.route_ids:
+            for subscription in self._by_route.get(route_id, ()):
+                subscription.mark_changed(guid)
+
+
+class ArrivalSubscription:
+    """
+    A stop filter sent by one or more clients, along with the frame last computed for
+    it and the time it was computed at. The frame is dropped whenever a van on one of
+    the routes in the filter changes.
+
+    A standing subscription also keeps the arrivals last sent to its clients as of the
+    fleet's sequence number at the time, and is marked with the routes that changed
+    so that its owner can push only the arrivals on them.
+    """
+
+    __slots__ = (
+        "key",
+        "stops",
+        "route_ids",
+        "members",
+        "frame",
+        "computed_at",
+        "sent",
+        "sequence",
+        "task",
+        "_changed",
+        "_route_ids",
+    )
+
+    def __init__(self, key: Hashable, stops: StopFilter):
+        self.key = key
+        self.stops = stops
+        self.route_ids = frozenset(
+            route_id for _, route_ids in stops for route_id in route_ids
+        )
+        self.members: Set[Outbox] = set()
+        self.frame: Optional[Frame] = None
+        self.computed_at: Optional[datetime] = None
+        self.sent: Optional[Dict[int, Dict[int, float]]] = None
+        self.sequence = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+        self._route_ids: Set[int] = set()
+
+    def mark_changed(self, route_id: int) -> None:
+        self.frame = None
+        self._route_ids.add(route_id)
+        self._changed.set()
+
+    async def wait(self, timeout: float) -> Set[int]:
+        """
+        Waits until a van on one of the routes changes, and returns the routes that
+        changed since the last wait. If nothing changes before the timeout, every
+        route is returned, since vans also expire without any change.
+        """
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return set(self.route_ids)
+        self._changed.clear()
+        route_ids, self._route_ids = self._route_ids, set()
+        return route_ids
+
+
+class ArrivalSubscriptionRegistry:
+    """
+    Holds the current stop filter of every arrivals client by its canonical form, and
+    indexes them by the routes they ask about. It is registered as a fleet state
+    listener.
+    """
+
+    def __init__(self) -> None:
+        self._subscriptions: Dict[Hashable, ArrivalSubscription] = {}
+        self._by_route: Dict[int, Set[ArrivalSubscription]] = {}
+
+    def __len__(self) -> int:
+        return len(self._subscriptions)
+
+    def clients(self) -> int:
+        return sum(
+            len(subscription.members) for subscription in self._subscriptions.values()
+        )
+
+    def group_sizes(self) -> List[int]:
+        return sorted(
+            (
+                len(subscription.members)
+                for subscription in self._subscriptions.values()
+            ),
+            reverse=True,
+        )
+
+    def join(
+        self, key: Hashable, outbox: Outbox, stops: StopFilter
+    ) -> ArrivalSubscription:
+        """
+        Adds a client to the subscription for a canonical stop filter, creating it if
+        no other client has the same one.
+        """
+        subscription = self._subscriptions.get(key)
+        if subscription is None:
+            subscription = ArrivalSubscription(key, stops)
+            self._subscriptions[key] = subscription
+            index(self._by_route, subscription.route_ids, subscription)
+        subscription.members.add(outbox)
+        return subscription
+
+    def leave(self, subscription: ArrivalSubscription, outbox: Outbox) -> bool:
+        """
+        Removes a client from a subscription. Returns True if it was the last one, in
+        which case the subscription is dropped and its owner should stop pushing.
+        """
+        subscription.members.discard(outbox)
+        if subscription.members:
+            return False
+        if self._subscriptions.get(subscription.key) is subscription:
+            del self._subscriptions[subscription.key]
+            unindex(self._by_route, subscription.route_ids, subscription)
+        return True
+
+    def notify(self, change: VanChange) -> None:
+        for route_id in change.route_ids:
+            for subscription in self._by_route.get(route_id, ()):
+                subscription.mark_changed(route_id)
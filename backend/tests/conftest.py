@@ -1,11 +1,15 @@
+import asyncio
+import json
 from datetime import datetime, timezone
 from typing import Any
 from unittest.mock import MagicMock
 
 import pytest
+from fastapi import WebSocketDisconnect
 from pydantic import BaseModel
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
 from src.db import Base
 
 
@@ -19,9 +23,58 @@ class MockRouteArgs:
         self.session = session
 
 
+class MockWebSocket:
+    """
+    Stands in for a connected websocket. Messages put on incoming are received by the
+    handler, with None simulating a disconnect, and everything sent is recorded.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+        self.incoming: asyncio.Queue = asyncio.Queue()
+        self.sent: list = []
+        self.closed = False
+
+    async def accept(self):
+        pass
+
+    async def close(self):
+        # Like Starlette, a websocket cannot be closed twice.
+        if self.closed:
+            raise RuntimeError('Cannot call "send" once a close message has been sent.')
+        self.closed = True
+
+    async def receive_json(self):
+        msg = await self.incoming.get()
+        if msg is None:
+            raise WebSocketDisconnect()
+        return msg
+
+    async def receive_text(self):
+        return await self.receive_json()
+
+    async def receive_bytes(self):
+        return await self.receive_json()
+
+    async def send_json(self, data):
+        self.sent.append(data)
+
+    async def send_text(self, data):
+        self.sent.append(json.loads(data))
+
+    async def send_bytes(self, data):
+        self.sent.append(data)
+
+
 @pytest.fixture
 def mock_session():
-    engine = create_engine("sqlite:///:memory:")
+    # Use a single shared connection so that work handed off to other threads sees
+    # the same in-memory database.
+    engine = create_engine(
+        "sqlite:///:memory:",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
     Base.metadata.create_all(engine)
     Session = sessionmaker(bind=engine)
     return Session()
@@ -37,3 +90,8 @@ def mock_route_args(mock_session) -> MockRouteArgs:
 @pytest.fixture
 def mock_datetime():
     return datetime.fromtimestamp(1691623800, timezone.utc)
+
+
+@pytest.fixture
+def mock_websocket() -> MockWebSocket:
+    return MockWebSocket(app=MagicMock())
@@ -0,0 +1,120 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from src.model.route import Route
+from src.model.route_stop import RouteStop
+from src.model.stop import Stop
+from src.model.van_tracker_session import VanTrackerSession
+from src.vantracking.arrivals import AVERAGE_VAN_SPEED_MPS, ArrivalEngine, RouteArrivals
+from src.vantracking.geo import distance_meters
+from src.vantracking.state import FleetState, RouteState, StopPoint, VanState
+
+
+def backtrack_distance(stops, stop_index, vans):
+    """
+    The original arrival estimate, which walks backwards from the stop until it finds
+    a van arriving at one of the stops before it.
+    """
+    arriving_vans = {}
+    for van in vans:
+        arriving_vans.setdefault(van.stop_index, van)
+    current_distance = 0.0
+    current_stop = stops[stop_index]
+    start = stop_index
+    while True:
+        arriving_van = arriving_vans.get((stop_index - 1) % len(stops))
+        if arriving_van is not None:
+            return current_distance + distance_meters(
+                arriving_van.lat, arriving_van.lon, current_stop.lat, current_stop.lon
+            )
+        stop_index = (stop_index - 1) % len(stops)
+        if stop_index == start:
+            return None
+        last_stop = current_stop
+        current_stop = stops[stop_index]
+        current_distance += distance_meters(
+            last_stop.lat, last_stop.lon, current_stop.lat, current_stop.lon
+        )
+
+
+def mock_van(guid: str, stop_index: int, lat: float, lon: float) -> VanState:
+    now = datetime.now(timezone.utc)
+    van = VanState(guid, int(guid), 1, stop_index, False, now, now)
+    van.located_at = now
+    van.lat = lat
+    van.lon = lon
+    return van
+
+
+def test_route_arrivals_match_backtracking():
+    rng = random.Random(42)
+    now = datetime.now(timezone.utc)
+    for _ in range(100):
+        stops = [
+            StopPoint(
+                i + 1, 39.75 + rng.uniform(0, 0.01), -105.22 + rng.uniform(0, 0.01)
+            )
+            for i in range(rng.randint(1, 8))
+        ]
+        vans = [
+            mock_van(
+                str(i),
+                rng.randint(-1, len(stops) - 1),
+                39.75 + rng.uniform(0, 0.01),
+                -105.22 + rng.uniform(0, 0.01),
+            )
+            for i in range(rng.randint(0, 4))
+        ]
+        arrivals = RouteArrivals(RouteState(1, "#FF0000", stops))
+
+        arrivals.compute(vans, now)
+
+        for i in range(len(stops)):
+            expected = backtrack_distance(stops, i, vans)
+            if not expected:
+                assert arrivals.seconds[i] is None
+            else:
+                assert arrivals.seconds[i] == pytest.approx(
+                    expected / AVERAGE_VAN_SPEED_MPS
+                )
+
+
+def test_arrival_engine_recomputes_on_change(mock_session):
+    # Arrange
+    now = datetime.now(timezone.utc)
+    mock_session.add_all(
+        [
+            Stop(id=1, name="Stop 1", lat=39.7510, lon=-105.2220, active=True),
+            Stop(id=2, name="Stop 2", lat=39.7560, lon=-105.2220, active=True),
+            Route(id=1, name="Route 1", color="#FF0000"),
+            RouteStop(id=1, route_id=1, stop_id=1, position=0),
+            RouteStop(id=2, route_id=1, stop_id=2, position=1),
+        ]
+    )
+    mock_session.commit()
+    fleet = FleetState()
+    fleet.load(mock_session)
+    engine = ArrivalEngine(fleet, tick=timedelta(hours=1))
+    fleet.add_listener(engine.notify)
+    van = fleet.begin_session(
+        VanTrackerSession(
+            id=1,
+            created_at=now,
+            updated_at=now,
+            van_guid="1",
+            route_id=1,
+            stop_index=0,
+            dead=False,
+        )
+    )
+    fleet.record_fix(van, now, 39.7520, -105.2220, 0)
+    before = engine.seconds_to(1, 2, now)
+
+    # Act
+    fleet.record_fix(van, now, 39.7550, -105.2220, 0)
+
+    # Assert
+    assert engine.seconds_to(1, 2, now) < before
+    assert engine.seconds_to(1, 404, now) is None
+    assert engine.seconds_to(404, 2, now) is None
@@ -0,0 +1,106 @@
+import asyncio
+from unittest.mock import MagicMock
+
+import pytest
+from src.vantracking.broadcast import Broadcaster, encode_json
+from src.vantracking.outbox import Outbox
+
+
+@pytest.mark.asyncio
+async def test_broadcast_produces_once_per_tick(mock_websocket):
+    # Arrange
+    produce = MagicMock(return_value={"1": {"latitude": 1.0}})
+    broadcaster = Broadcaster(produce, interval=60)
+    outbox = Outbox(mock_websocket)
+    other_websocket = type(mock_websocket)(app=mock_websocket.app)
+    other_outbox = Outbox(other_websocket)
+
+    # Act
+    broadcaster.add(outbox)
+    await asyncio.sleep(0.01)
+    broadcaster.add(other_outbox)
+    await asyncio.sleep(0.01)
+
+    # Assert
+    produce.assert_called_once()
+    assert mock_websocket.sent == [{"1": {"latitude": 1.0}}]
+    assert other_websocket.sent == mock_websocket.sent
+
+    broadcaster.discard(outbox)
+    broadcaster.discard(other_outbox)
+    assert len(broadcaster) == 0
+
+
+@pytest.mark.asyncio
+async def test_broadcast_stops_without_websockets(mock_websocket):
+    # Arrange
+    produce = MagicMock(return_value={})
+    broadcaster = Broadcaster(produce, interval=0)
+    outbox = Outbox(mock_websocket)
+
+    # Act
+    broadcaster.add(outbox)
+    await asyncio.sleep(0.01)
+    broadcaster.discard(outbox)
+    await asyncio.sleep(0.01)
+
+    # Assert
+    calls = produce.call_count
+    await asyncio.sleep(0.01)
+    assert produce.call_count == calls
+
+
+@pytest.mark.asyncio
+async def test_broadcast_encodes_once_per_format(mock_websocket):
+    # Arrange
+    produce = MagicMock(return_value={"1": {"latitude": 1.0}})
+    encode_binary = MagicMock(return_value=b"frame")
+    broadcaster = Broadcaster(
+        produce, interval=60, encoders={"json": encode_json, "binary": encode_binary}
+    )
+    binary_websockets = [type(mock_websocket)(app=mock_websocket.app) for _ in range(3)]
+
+    # Act
+    outbox = Outbox(mock_websocket)
+    binary_outboxes = [Outbox(websocket) for websocket in binary_websockets]
+    broadcaster.add(outbox)
+    for binary_outbox in binary_outboxes:
+        broadcaster.add(binary_outbox, "binary")
+    await asyncio.sleep(0.01)
+
+    # Assert
+    encode_binary.assert_called_once_with({"1": {"latitude": 1.0}})
+    assert mock_websocket.sent[0] == {"1": {"latitude": 1.0}}
+    assert all(websocket.sent == [b"frame"] for websocket in binary_websockets)
+    assert not broadcaster.supports("xml")
+
+    broadcaster.discard(outbox)
+    for binary_outbox in binary_outboxes:
+        broadcaster.discard(binary_outbox)
+
+
+@pytest.mark.asyncio
+async def test_broadcast_survives_encoder_errors(mock_websocket):
+    # Arrange
+    produce = MagicMock(return_value={"1": {"latitude": 1.0}})
+    encode_binary = MagicMock(side_effect=ValueError("Van id out of range"))
+    broadcaster = Broadcaster(
+        produce, interval=0.01, encoders={"json": encode_json, "binary": encode_binary}
+    )
+    binary_websocket = type(mock_websocket)(app=mock_websocket.app)
+    outbox = Outbox(mock_websocket)
+    binary_outbox = Outbox(binary_websocket)
+
+    # Act
+    broadcaster.add(outbox)
+    broadcaster.add(binary_outbox, "binary")
+    await asyncio.sleep(0.05)
+
+    # Assert
+    assert produce.call_count > 1
+    assert encode_binary.call_count > 1
+    assert mock_websocket.sent[0] == {"1": {"latitude": 1.0}}
+    assert binary_websocket.sent == []
+
+    broadcaster.discard(outbox)
+    broadcaster.discard(binary_outbox)
@@ -0,0 +1,205 @@
+import asyncio
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from src.model.route import Route
+from src.model.van_tracker_session import VanTrackerSession
+from src.vantracking.bus import (
+    MAX_PAYLOAD_BYTES,
+    FleetBus,
+    MemoryBroker,
+    encode_van,
+    pack,
+    refresh_routes,
+)
+from src.vantracking.spatial import BoundingBox
+from src.vantracking.state import FleetState, VanChange, VanState
+
+
+def tracker_session(session_id: int, guid: str, route_id: int) -> VanTrackerSession:
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    return VanTrackerSession(
+        id=session_id,
+        created_at=now,
+        updated_at=now,
+        van_guid=guid,
+        route_id=route_id,
+        stop_index=-1,
+        dead=False,
+    )
+
+
+async def start_worker(broker: MemoryBroker, db=None):
+    fleet = FleetState()
+    bus = FleetBus(fleet, broker.transport(), db)
+    fleet.add_listener(bus.notify)
+    await bus.start()
+    return fleet, bus
+
+
+@pytest.mark.asyncio
+async def test_fleet_bus_applies_changes_of_other_workers():
+    # Arrange
+    broker = MemoryBroker()
+    fleet_a, bus_a = await start_worker(broker)
+    fleet_b, bus_b = await start_worker(broker)
+    changes: list[VanChange] = []
+    fleet_b.add_listener(changes.append)
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+
+    # Act
+    van = fleet_a.begin_session(tracker_session(1, "1", 3))
+    await asyncio.sleep(0.01)
+    fleet_a.record_fix(van, now, 39.7510, -105.2220, 0)
+    fleet_a.record_fix(van, now + timedelta(seconds=1), 39.7520, -105.2220, 1)
+    await asyncio.sleep(0.01)
+
+    # Assert
+    replica = fleet_b.van("1")
+    assert replica is not None
+    assert (replica.session_id, replica.route_id, replica.stop_index) == (1, 3, 1)
+    assert replica.created_at == van.created_at
+    assert replica.located_at == now + timedelta(seconds=1)
+    assert fleet_b.vans_within(BoundingBox(39.75, -105.23, 39.76, -105.22)) == [replica]
+    # Both fixes went out as one event, applied in place, and nothing applied on B
+    # was published again.
+    assert len(changes) == 2
+    assert changes[1].van is changes[0].van
+    assert broker.published == 2
+
+    await bus_a.close()
+    await bus_b.close()
+
+
+@pytest.mark.asyncio
+async def test_fleet_bus_replaces_van_on_new_session():
+    # Arrange
+    broker = MemoryBroker()
+    fleet_a, bus_a = await start_worker(broker)
+    fleet_b, bus_b = await start_worker(broker)
+    fleet_a.begin_session(tracker_session(1, "1", 3))
+    await asyncio.sleep(0.01)
+    changes: list[VanChange] = []
+    fleet_b.add_listener(changes.append)
+
+    # Act
+    fleet_a.begin_session(tracker_session(2, "1", 7))
+    await asyncio.sleep(0.01)
+
+    # Assert
+    replica = fleet_b.van("1")
+    assert replica is not None
+    assert (replica.session_id, replica.route_id) == (2, 7)
+    assert changes[0].route_ids == frozenset({3, 7})
+
+    await bus_a.close()
+    await bus_b.close()
+
+
+@pytest.mark.asyncio
+async def test_fleet_bus_converges_on_concurrent_sessions():
+    # Arrange
+    broker = MemoryBroker()
+    fleet_a, bus_a = await start_worker(broker)
+    fleet_b, bus_b = await start_worker(broker)
+    fleet_a.begin_session(tracker_session(9, "1", 3))
+    await asyncio.sleep(0.01)
+    now = datetime.now(timezone.utc)
+
+    # Act
+    fleet_a.begin_session(tracker_session(10, "1", 3))
+    fleet_b.record_fix(fleet_b.van("1"), now, 39.7510, -105.2220, 0)
+    await asyncio.sleep(0.01)
+
+    # Assert
+    assert fleet_a.van("1").session_id == 10
+    assert fleet_b.van("1").session_id == 10
+
+    await bus_a.close()
+    await bus_b.close()
+
+
+@pytest.mark.asyncio
+async def test_fleet_bus_ignores_stale_events():
+    # Arrange
+    broker = MemoryBroker()
+    fleet, bus = await start_worker(broker)
+    other = broker.transport()
+    changes: list[VanChange] = []
+    fleet.add_listener(changes.append)
+    now = datetime.now(timezone.utc)
+
+    def van(session_id, updated_at, located_at, stop_index, dead=False):
+        van = VanState("1", session_id, 3, stop_index, dead, now, updated_at)
+        van.located_at = located_at
+        return van
+
+    later = now + timedelta(seconds=5)
+    events = [
+        van(10, later, later, 2),
+        # An older session, and records of the same session that are older.
+        van(9, later + timedelta(seconds=5), later, 5),
+        van(10, now, now, 1),
+        van(10, later, now, 1),
+        van(10, later, None, 1),
+        # Newer ones still go through.
+        van(10, later, later, 3, dead=True),
+        van(10, later, later, 2),
+    ]
+
+    # Act
+    await other.publish(pack([encode_van("other", event) for event in events]))
+    await asyncio.sleep(0.01)
+
+    # Assert
+    current = fleet.van("1")
+    assert (current.session_id, current.stop_index, current.dead) == (10, 3, True)
+    assert current.located_at == later
+    assert len(changes) == 2
+
+    await bus.close()
+
+
+@pytest.mark.asyncio
+async def test_fleet_bus_reloads_routes(mock_route_args):
+    # Arrange
+    broker = MemoryBroker()
+    db = mock_route_args.req.app.state.db
+    fleet_a, bus_a = await start_worker(broker, db)
+    fleet_b, bus_b = await start_worker(broker, db)
+    mock_route_args.session.add(Route(id=1, name="Route 1", color="#FF0000"))
+    mock_route_args.session.commit()
+    state = mock_route_args.req.app.state
+    state.fleet, state.fleet_bus = fleet_a, bus_a
+
+    # Act
+    refresh_routes(state, mock_route_args.session)
+    await asyncio.sleep(0.01)
+
+    # Assert
+    assert fleet_a.route(1) is not None
+    route = fleet_b.route(1)
+    assert route is not None
+    assert route.color == "#FF0000"
+
+    await bus_a.close()
+    await bus_b.close()
+
+
+def test_pack_splits_payloads_under_limit():
+    # Arrange
+    now = datetime.now(timezone.utc)
+    events = [
+        encode_van("worker", VanState(str(i), i, 1, 0, False, now, now))
+        for i in range(500)
+    ]
+
+    # Act
+    payloads = pack(events)
+
+    # Assert
+    assert len(payloads) > 1
+    assert all(len(payload) <= MAX_PAYLOAD_BYTES for payload in payloads)
+    lines = [line for payload in payloads for line in payload.split("\n")]
+    assert [json.loads(line) for line in lines] == events
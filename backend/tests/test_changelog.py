@@ -0,0 +1,52 @@
+from datetime import datetime, timezone
+
+from src.model.van_tracker_session import VanTrackerSession
+from src.vantracking.changelog import ChangeLog
+from src.vantracking.state import FleetState, VanState
+
+
+def begin_session(fleet: FleetState, guid: str, route_id: int) -> VanState:
+    now = datetime.now(timezone.utc)
+    return fleet.begin_session(
+        VanTrackerSession(
+            id=int(guid),
+            created_at=now,
+            updated_at=now,
+            van_guid=guid,
+            route_id=route_id,
+            stop_index=-1,
+            dead=False,
+        )
+    )
+
+
+def test_since():
+    # Arrange
+    fleet = FleetState()
+    change_log = ChangeLog(size=3)
+    fleet.add_listener(change_log.notify)
+    first = begin_session(fleet, "1", 1)
+    second = begin_session(fleet, "2", 2)
+
+    # Act
+    fleet.update_stop_index(first, 0)
+    fleet.update_stop_index(second, 0)
+    fleet.update_stop_index(second, 1)
+
+    # Assert
+    assert change_log.since(5)[:2] == (frozenset(), frozenset())
+    assert change_log.since(3)[:2] == (frozenset({"2"}), frozenset({2}))
+    changes = change_log.since(2)
+    assert changes[:2] == (frozenset({"1", "2"}), frozenset({1, 2}))
+    assert [change.sequence for change in changes.changes] == [3, 4, 5]
+    assert change_log.since(1) is None
+    assert change_log.since(6) is None
+
+
+def test_since_empty():
+    # Arrange
+    change_log = ChangeLog()
+
+    # Act / Assert
+    assert change_log.since(0) == (frozenset(), frozenset(), ())
+    assert change_log.since(1) is None
@@ -0,0 +1,287 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pytest
+from fastapi import HTTPException
+from src.handlers.vans import get_session_trail
+from src.model.van_location import VanLocation
+from src.model.van_tracker_session import VanTrackerSession
+from src.model.van_trail import VanTrail
+from src.vantracking.compaction import (
+    TrailCompactor,
+    pack_trail,
+    simplify,
+    unpack_trail,
+)
+from src.vantracking.geo import distance_meters
+from src.vantracking.spatial import segment_distance
+from src.vantracking.state import LocationFix, StopPoint
+
+NOW = datetime(2024, 3, 5, 20, tzinfo=timezone.utc)
+STARTED = datetime(2024, 3, 5, 12, tzinfo=timezone.utc)
+
+
+def add_session(session, session_id, dead, created_at=STARTED):
+    session.add(
+        VanTrackerSession(
+            id=session_id,
+            created_at=created_at,
+            updated_at=created_at,
+            van_guid=str(session_id),
+            route_id=1,
+            stop_index=-1,
+            dead=dead,
+        )
+    )
+
+
+def walk(count, rng):
+    """
+    Returns a wandering path of fixes two seconds apart.
+    """
+    lat, lon = 39.75, -105.22
+    fixes = []
+    for i in range(count):
+        lat += rng.uniform(-0.0001, 0.0002)
+        lon += rng.uniform(-0.0001, 0.0002)
+        fixes.append(LocationFix(STARTED + timedelta(seconds=2 * i), lat, lon))
+    return fixes
+
+
+def test_simplify_straight_line():
+    # Arrange
+    lats = np.linspace(39.75, 39.76, 50)
+    lons = np.full(50, -105.22)
+
+    # Act
+    kept = simplify(lats, lons, 5.0)
+
+    # Assert
+    assert kept.tolist() == [0, 49]
+
+
+def test_simplify_keeps_corners_and_reversals():
+    # Arrange
+    lats = np.array([39.750, 39.751, 39.752, 39.752, 39.752, 39.751])
+    lons = np.array([-105.220, -105.220, -105.220, -105.219, -105.218, -105.218])
+
+    # Act
+    kept = simplify(lats, lons, 5.0)
+
+    # Assert
+    assert kept.tolist() == [0, 2, 4, 5]
+
+
+def test_simplify_within_tolerance():
+    # Arrange
+    fixes = walk(2000, random.Random(1))
+    lats = np.array([fix.lat for fix in fixes])
+    lons = np.array([fix.lon for fix in fixes])
+
+    # Act
+    kept = simplify(lats, lons, 5.0).tolist()
+
+    # Assert
+    assert len(kept) < len(fixes)
+    for start, end in zip(kept, kept[1:]):
+        for i in range(start + 1, end):
+            distance, _ = segment_distance(
+                lats[i],
+                lons[i],
+                StopPoint(0, lats[start], lons[start]),
+                StopPoint(0, lats[end], lons[end]),
+            )
+            # The plane is centered on the first point rather than each one.
+            assert distance <= 5.0 + 0.01
+
+
+def test_pack_round_trip():
+    # Arrange
+    fixes = walk(500, random.Random(2))
+
+    # Act
+    data = pack_trail(fixes)
+    unpacked = unpack_trail(data)
+
+    # Assert
+    assert len(data) == 24 + 12 * (len(fixes) - 1)
+    assert [fix.timestamp for fix in unpacked] == [fix.timestamp for fix in fixes]
+    for fix, original in zip(unpacked, fixes):
+        assert distance_meters(fix.lat, fix.lon, original.lat, original.lon) < 0.1
+    assert unpack_trail(pack_trail([])) == []
+
+
+def test_compact_finished_sessions(mock_session):
+    # Arrange
+    fixes = walk(300, random.Random(3))
+    add_session(mock_session, 1, dead=True)
+    add_session(mock_session, 2, dead=False, created_at=NOW - timedelta(hours=1))
+    add_session(mock_session, 3, dead=False, created_at=NOW - timedelta(hours=13))
+    for session_id in (1, 2, 3):
+        mock_session.add_all(
+            [
+                VanLocation(
+                    session_id=session_id,
+                    created_at=fix.timestamp,
+                    lat=fix.lat,
+                    lon=fix.lon,
+                )
+                for fix in fixes
+            ]
+        )
+    mock_session.commit()
+    compactor = TrailCompactor(tolerance_m=5.0)
+
+    # Act
+    compacted = compactor.compact(mock_session, NOW)
+
+    # Assert
+    assert compacted == [1, 3]
+    assert mock_session.query(VanLocation).filter_by(session_id=1).count() == 0
+    assert mock_session.query(VanLocation).filter_by(session_id=2).count() == 300
+    trail = mock_session.get(VanTrail, 1)
+    assert trail.raw_count == 300
+    assert 2 <= trail.point_count < 300
+    points = TrailCompactor.trail(mock_session, 1)
+    assert len(points) == trail.point_count
+    assert points[0].timestamp == fixes[0].timestamp
+    assert points[-1].timestamp == fixes[-1].timestamp
+    assert compactor.compact(mock_session, NOW) == []
+
+
+def test_compact_merges_late_locations(mock_session):
+    # Arrange
+    fixes = walk(100, random.Random(4))
+    add_session(mock_session, 1, dead=True)
+    mock_session.add_all(
+        [
+            VanLocation(
+                session_id=1, created_at=fix.timestamp, lat=fix.lat, lon=fix.lon
+            )
+            for fix in fixes[:-1]
+        ]
+    )
+    mock_session.commit()
+    compactor = TrailCompactor()
+    compactor.compact(mock_session, NOW)
+    compacted_trail = TrailCompactor.trail(mock_session, 1)
+    late = fixes[-1]
+    mock_session.add(
+        VanLocation(session_id=1, created_at=late.timestamp, lat=late.lat, lon=late.lon)
+    )
+    mock_session.commit()
+
+    # Act
+    compacted = compactor.compact(mock_session, NOW)
+
+    # Assert
+    assert compacted == [1]
+    assert mock_session.query(VanLocation).count() == 0
+    assert mock_session.get(VanTrail, 1).raw_count == 100
+    trail = TrailCompactor.trail(mock_session, 1)
+    # The trail is not simplified a second time.
+    assert trail[:-1] == compacted_trail
+    assert trail[-1].timestamp == late.timestamp
+
+
+def test_compact_keeps_locations_between_trail_points(mock_session):
+    # Arrange
+    fixes = walk(100, random.Random(5))
+    add_session(mock_session, 1, dead=True)
+    mock_session.add_all(
+        [
+            VanLocation(
+                session_id=1, created_at=fix.timestamp, lat=fix.lat, lon=fix.lon
+            )
+            for fix in fixes[::2]
+        ]
+    )
+    mock_session.commit()
+    compactor = TrailCompactor()
+    compactor.compact(mock_session, NOW)
+    point_count = mock_session.get(VanTrail, 1).point_count
+    late = fixes[51]
+    mock_session.add(
+        VanLocation(session_id=1, created_at=late.timestamp, lat=late.lat, lon=late.lon)
+    )
+    mock_session.commit()
+
+    # Act
+    compactor.compact(mock_session, NOW)
+
+    # Assert
+    trail = TrailCompactor.trail(mock_session, 1)
+    assert len(trail) == point_count + 1
+    assert late.timestamp in [fix.timestamp for fix in trail]
+
+
+def test_compact_only_deletes_what_was_read(mock_session):
+    # Arrange
+    fixes = walk(10, random.Random(6))
+    add_session(mock_session, 1, dead=True)
+    mock_session.add_all(
+        [
+            VanLocation(
+                id=10 + i,
+                session_id=1,
+                created_at=fix.timestamp,
+                lat=fix.lat,
+                lon=fix.lon,
+            )
+            for i, fix in enumerate(fixes)
+        ]
+    )
+    mock_session.commit()
+    late = fixes[-1]
+
+    class LateInsertCompactor(TrailCompactor):
+        def _simplified(self, fixes):
+            # A location with a lower id is committed after the others were read.
+            mock_session.add(
+                VanLocation(
+                    id=1,
+                    session_id=1,
+                    created_at=late.timestamp + timedelta(seconds=1),
+                    lat=late.lat,
+                    lon=late.lon,
+                )
+            )
+            return super()._simplified(fixes)
+
+    # Act
+    LateInsertCompactor().compact(mock_session, NOW)
+
+    # Assert
+    assert [row.id for row in mock_session.query(VanLocation)] == [1]
+    assert mock_session.get(VanTrail, 1).raw_count == 10
+
+
+@pytest.mark.asyncio
+async def test_get_session_trail(mock_route_args):
+    # Arrange
+    add_session(mock_route_args.session, 1, dead=False)
+    mock_route_args.session.add(
+        VanLocation(session_id=1, created_at=STARTED, lat=39.75, lon=-105.22)
+    )
+    mock_route_args.session.commit()
+
+    # Act
+    response = await get_session_trail(mock_route_args.req, 1)
+
+    # Assert
+    assert response == [
+        {
+            "timestamp": int(STARTED.timestamp()),
+            "latitude": 39.75,
+            "longitude": -105.22,
+        }
+    ]
+
+
+@pytest.mark.asyncio
+async def test_get_session_trail_not_found(mock_route_args):
+    # Act / Assert
+    with pytest.raises(HTTPException) as e:
+        await get_session_trail(mock_route_args.req, 404)
+    assert e.value.status_code == 404
@@ -0,0 +1,123 @@
+import random
+from datetime import datetime, timedelta, timezone
+from typing import List
+
+from src.vantracking.dwell import (
+    DWELL_WINDOW,
+    THRESHOLD_RADIUS_M,
+    THRESHOLD_TIME,
+    DwellTracker,
+)
+from src.vantracking.geo import distance_meters
+from src.vantracking.state import LocationFix, StopPoint
+
+STOPS = [
+    StopPoint(1, 39.7510, -105.2220),
+    StopPoint(2, 39.7560, -105.2220),
+    StopPoint(3, 39.7560, -105.2160),
+    StopPoint(4, 39.7510, -105.2160),
+]
+
+
+def rescan_stop_index(stops, stop_index, locations, now):
+    """
+    The original stop detection, which rescans every fix in the window for every stop.
+    """
+    locations = sorted(
+        (location for location in locations if location.timestamp > now - DWELL_WINDOW),
+        key=lambda location: location.timestamp,
+    )
+    subsequent_stops = stops[stop_index + 1 :] + stops[: max(stop_index - 1, 0)]
+    for i, stop in enumerate(subsequent_stops):
+        longest_subset: List[datetime] = []
+        current_subset: List[datetime] = []
+        for location in locations:
+            if (
+                distance_meters(location.lat, location.lon, stop.lat, stop.lon)
+                < THRESHOLD_RADIUS_M
+            ):
+                current_subset.append(location.timestamp)
+            else:
+                if len(current_subset) > len(longest_subset):
+                    longest_subset = current_subset
+                current_subset = []
+        if len(current_subset) > len(longest_subset):
+            longest_subset = current_subset
+        if longest_subset:
+            duration = longest_subset[-1] - longest_subset[0]
+        else:
+            duration = timedelta(seconds=0)
+        if duration >= THRESHOLD_TIME:
+            return (stop_index + i + 1) % len(stops)
+    return stop_index
+
+
+def random_fix(rng: random.Random, timestamp: datetime) -> LocationFix:
+    stop = rng.choice(STOPS)
+    if rng.random() < 0.6:
+        # Within a couple of meters of the stop
+        return LocationFix(
+            timestamp,
+            stop.lat + rng.uniform(-0.00002, 0.00002),
+            stop.lon + rng.uniform(-0.00002, 0.00002),
+        )
+    return LocationFix(
+        timestamp,
+        stop.lat + rng.uniform(-0.002, 0.002),
+        stop.lon + rng.uniform(-0.002, 0.002),
+    )
+
+
+def test_dwell_tracker_matches_rescan():
+    rng = random.Random(1234)
+    for _ in range(20):
+        now = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        tracker = DwellTracker(STOPS, capacity=1000)
+        fixes: List[LocationFix] = []
+        stop_index = rng.choice([-1, 0, 1, 2, 3])
+        for _ in range(300):
+            now += timedelta(seconds=rng.choice([1, 2, 3, 5, 20]))
+            # Occasionally deliver a fix late and out of order
+            delay = timedelta(seconds=rng.choice([0, 0, 0, 0, 4]))
+            fix = random_fix(rng, now - delay)
+            fixes.append(fix)
+            tracker.add(fix)
+            tracker.expire(now)
+
+            expected = rescan_stop_index(STOPS, stop_index, fixes, now)
+            assert tracker.stop_index(stop_index) == expected
+            stop_index = expected
+
+
+def test_dwell_tracker_moves_after_threshold():
+    # Arrange
+    now = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    tracker = DwellTracker(STOPS)
+
+    # Act
+    for seconds in range(0, 10, 2):
+        tracker.add(LocationFix(now + timedelta(seconds=seconds), 39.7560, -105.2219))
+    before = tracker.stop_index(0)
+    tracker.add(LocationFix(now + timedelta(seconds=10), 39.7560, -105.2219))
+
+    # Assert
+    assert before == 0
+    assert tracker.stop_index(0) == 1
+
+
+def test_dwell_tracker_is_bounded():
+    # Arrange
+    now = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    tracker = DwellTracker(STOPS, capacity=4)
+
+    # Act
+    for seconds in range(10):
+        tracker.add(LocationFix(now + timedelta(seconds=seconds), 39.7560, -105.2219))
+
+    # Assert
+    assert len(tracker) == 4
+    assert tracker.dwell(1) == timedelta(seconds=3)
+
+    tracker.expire(now + timedelta(seconds=8) + DWELL_WINDOW)
+    assert len(tracker) == 1
+    assert tracker.dwell(1) == timedelta(seconds=0)
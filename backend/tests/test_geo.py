@@ -0,0 +1,64 @@
+import random
+
+import pytest
+from src.vantracking.geo import (
+    StopArray,
+    distance_matrix_meters,
+    distance_meters,
+    distances_between,
+)
+from src.vantracking.state import StopPoint
+
+
+@pytest.fixture
+def random_stops():
+    rng = random.Random(7)
+    return [
+        StopPoint(i, 39.75 + rng.uniform(0, 0.02), -105.22 + rng.uniform(0, 0.02))
+        for i in range(50)
+    ]
+
+
+def test_stop_array_matches_scalar(random_stops):
+    # Arrange
+    points = StopArray(random_stops)
+    lat, lon = 39.76, -105.21
+
+    # Act
+    distances = points.distances_from(lat, lon)
+    segments = points.segment_lengths()
+
+    # Assert
+    for i, stop in enumerate(random_stops):
+        assert distances[i] == pytest.approx(
+            distance_meters(lat, lon, stop.lat, stop.lon)
+        )
+        previous = random_stops[i - 1]
+        assert segments[i] == pytest.approx(
+            distance_meters(stop.lat, stop.lon, previous.lat, previous.lon)
+        )
+
+
+def test_many_to_many_matches_scalar(random_stops):
+    # Arrange
+    points = StopArray(random_stops)
+    a, b = random_stops[:5], random_stops[5:]
+
+    # Act
+    matrix = distance_matrix_meters(
+        points.lats[:5], points.lons[:5], points.lats[5:], points.lons[5:]
+    )
+    pairs = distances_between(
+        points.lats[:5], points.lons[:5], points.lats[5:10], points.lons[5:10]
+    )
+
+    # Assert
+    assert matrix.shape == (5, len(b))
+    for i, left in enumerate(a):
+        assert pairs[i] == pytest.approx(
+            distance_meters(left.lat, left.lon, b[i].lat, b[i].lon)
+        )
+        for j, right in enumerate(b):
+            assert matrix[i, j] == pytest.approx(
+                distance_meters(left.lat, left.lon, right.lat, right.lon)
+            )
@@ -0,0 +1,237 @@
+import asyncio
+import struct
+from datetime import datetime, timedelta, timezone
+
+import pytest
+import pytest_asyncio
+from src.handlers.hardware import (
+    FRAME_HANDLERS,
+    FRAME_HELLO,
+    FRAME_LOCATION,
+    FRAME_RIDERSHIP,
+    FRAME_ROUTE_SELECT,
+    OK_CODE,
+    HardwareFastPath,
+    TcpTrackerServer,
+    hardware_websocket,
+)
+from src.hardware import HardwareErrorCode, pack_error_code
+from src.model.ridership_analytics import RidershipAnalytics
+from src.model.route import Route
+from src.vantracking.ingest import IngestPipeline
+from src.vantracking.state import FleetState
+
+
+@pytest_asyncio.fixture
+async def mock_hardware_args(mock_route_args):
+    mock_route_args.session.add(Route(id=1, name="Route 1", color="#FF0000"))
+    mock_route_args.session.commit()
+    state = mock_route_args.req.app.state
+    state.fleet = FleetState()
+    state.fleet.load(mock_route_args.session)
+    state.ingest = IngestPipeline(state.db, state.fleet)
+    yield mock_route_args
+    await state.ingest.close()
+
+
+def location_frame(time: datetime, lat: float, lon: float) -> bytes:
+    return struct.pack("<BQdd", FRAME_LOCATION, int(time.timestamp() * 1000), lat, lon)
+
+
+def tcp_frame(frame: bytes) -> bytes:
+    return struct.pack("<B", len(frame)) + frame
+
+
+@pytest.mark.asyncio
+async def test_hardware_websocket(mock_hardware_args, mock_websocket):
+    # Arrange
+    websocket = mock_websocket
+    websocket.app = mock_hardware_args.req.app
+    task = asyncio.create_task(hardware_websocket(websocket, "1"))
+    now = datetime.now(timezone.utc) - timedelta(seconds=1)
+
+    # Act
+    websocket.incoming.put_nowait(location_frame(now, 39.7510, -105.2220))
+    websocket.incoming.put_nowait(struct.pack("<Bi", FRAME_ROUTE_SELECT, 1))
+    websocket.incoming.put_nowait(location_frame(now, 39.7510, -105.2220))
+    websocket.incoming.put_nowait(
+        location_frame(now + timedelta(minutes=1), 39.7510, -105.2220)
+    )
+    websocket.incoming.put_nowait(b"\x09")
+    await task
+
+    # Assert
+    assert websocket.sent == [
+        pack_error_code(HardwareErrorCode.CREATE_NEW_SESSION),
+        OK_CODE,
+        OK_CODE,
+        pack_error_code(HardwareErrorCode.TIMESTAMP_IN_FUTURE),
+    ]
+    van = mock_hardware_args.req.app.state.fleet.van("1")
+    assert (van.lat, van.lon) == (39.7510, -105.2220)
+
+
+@pytest.mark.asyncio
+async def test_hardware_tcp(mock_hardware_args):
+    # Arrange
+    state = mock_hardware_args.req.app.state
+    server = TcpTrackerServer(state)
+    port = (await server.start("127.0.0.1", 0)).sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    now = datetime.now(timezone.utc) - timedelta(seconds=1)
+
+    # Act
+    writer.write(tcp_frame(bytes([FRAME_HELLO]) + b"7"))
+    writer.write(tcp_frame(struct.pack("<Bi", FRAME_ROUTE_SELECT, 1)))
+    writer.write(tcp_frame(location_frame(now, 39.7510, -105.2220)))
+    await writer.drain()
+    results = await asyncio.wait_for(reader.readexactly(3), 1)
+    # The test database has a single session, which the ingest pipeline must be
+    # done with before the ridership frame uses it.
+    await state.ingest.flush()
+    writer.write(
+        tcp_frame(
+            struct.pack(
+                "<BQbbdd",
+                FRAME_RIDERSHIP,
+                int(now.timestamp() * 1000),
+                3,
+                1,
+                39.7510,
+                -105.2220,
+            )
+        )
+    )
+    await writer.drain()
+    results += await asyncio.wait_for(reader.readexactly(1), 1)
+    writer.close()
+    await server.close()
+
+    # Assert
+    assert results == OK_CODE * 4
+    van = state.fleet.van("7")
+    assert (van.route_id, van.lat) == (1, 39.7510)
+    ridership = mock_hardware_args.session.query(RidershipAnalytics).one()
+    assert (ridership.entered, ridership.exited) == (3, 1)
+
+
+@pytest.mark.asyncio
+async def test_hardware_tcp_disconnects_silent_tracker(mock_hardware_args):
+    # Arrange
+    server = TcpTrackerServer(mock_hardware_args.req.app.state, read_timeout=0.05)
+    port = (await server.start("127.0.0.1", 0)).sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+
+    # Act
+    writer.write(tcp_frame(bytes([FRAME_HELLO]) + b"7"))
+    await writer.drain()
+    results = await asyncio.wait_for(reader.read(), 1)
+    writer.close()
+    await server.close()
+
+    # Assert
+    assert results == OK_CODE
+
+
+@pytest.mark.asyncio
+async def test_hardware_tcp_answers_server_errors(mock_hardware_args, monkeypatch):
+    # Arrange
+    async def fail(state, van_guid, body):
+        raise RuntimeError("Database unavailable")
+
+    monkeypatch.setitem(FRAME_HANDLERS, FRAME_ROUTE_SELECT, fail)
+    server = TcpTrackerServer(mock_hardware_args.req.app.state)
+    port = (await server.start("127.0.0.1", 0)).sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+
+    # Act
+    writer.write(tcp_frame(bytes([FRAME_HELLO]) + b"7"))
+    writer.write(tcp_frame(struct.pack("<Bi", FRAME_ROUTE_SELECT, 1)))
+    writer.write(tcp_frame(struct.pack("<Bi", FRAME_ROUTE_SELECT, 1)))
+    await writer.drain()
+    results = await asyncio.wait_for(reader.readexactly(3), 1)
+    writer.close()
+    await server.close()
+
+    # Assert
+    server_error = pack_error_code(HardwareErrorCode.SERVER_ERROR)
+    assert results == OK_CODE + server_error * 2
+
+
+@pytest.mark.asyncio
+async def test_hardware_tcp_close_disconnects_trackers(mock_hardware_args):
+    # Arrange
+    server = TcpTrackerServer(mock_hardware_args.req.app.state)
+    port = (await server.start("127.0.0.1", 0)).sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(tcp_frame(bytes([FRAME_HELLO]) + b"7"))
+    await writer.drain()
+    await asyncio.wait_for(reader.readexactly(1), 1)
+
+    # Act
+    await asyncio.wait_for(server.close(), 1)
+
+    # Assert
+    assert await asyncio.wait_for(reader.read(), 1) == b""
+    writer.close()
+
+
+async def call_asgi(app, state_app, method: str, path: str, body: bytes = b""):
+    scope = {"type": "http", "method": method, "path": path, "app": state_app}
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent: list = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    return sent[0]["status"], sent[1]["body"]
+
+
+@pytest.mark.asyncio
+async def test_hardware_http(mock_hardware_args):
+    # Arrange
+    passed_on: list = []
+
+    async def api(scope, receive, send):
+        passed_on.append(scope["path"])
+
+    app = HardwareFastPath(api)
+    state_app = mock_hardware_args.req.app
+    now = datetime.now(timezone.utc) - timedelta(seconds=1)
+    location = location_frame(now, 39.7510, -105.2220)[1:]
+
+    # Act
+    missing_session = await call_asgi(
+        app, state_app, "POST", "/hardware/location/1", location
+    )
+    session = await call_asgi(
+        app, state_app, "POST", "/hardware/routeselect/1", struct.pack("<i", 1)
+    )
+    located = await call_asgi(app, state_app, "POST", "/hardware/location/1", location)
+    batch = await call_asgi(
+        app, state_app, "POST", "/hardware/location/1/batch", location * 2
+    )
+    # The test database has a single session, which the ingest pipeline must be done
+    # with before the routes are queried from another thread.
+    await state_app.state.ingest.flush()
+    routes = await call_asgi(app, state_app, "GET", "/hardware/routes")
+    unknown = await call_asgi(app, state_app, "GET", "/hardware/location/1")
+    await app({"type": "http", "path": "/vans/location/1"}, None, None)
+
+    # Assert
+    assert missing_session == (
+        400,
+        pack_error_code(HardwareErrorCode.CREATE_NEW_SESSION),
+    )
+    assert session == (200, b"")
+    assert located == (200, b"")
+    assert batch == (200, b"")
+    assert routes == (200, b"\x01\x00\x00\x00\x01\x07Route 1")
+    assert unknown == (404, b"")
+    assert passed_on == ["/vans/location/1"]
+    van = mock_hardware_args.req.app.state.fleet.van("1")
+    assert van.lat == 39.7510
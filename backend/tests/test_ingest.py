@@ -0,0 +1,107 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from src.model.van_location import VanLocation
+from src.model.van_tracker_session import VanTrackerSession
+from src.vantracking.ingest import IngestItem, IngestPipeline
+from src.vantracking.state import FleetState, LocationFix
+
+
+def mock_tracker_session(session, now: datetime) -> None:
+    session.add(
+        VanTrackerSession(
+            id=1,
+            created_at=now,
+            updated_at=now,
+            van_guid="1",
+            route_id=1,
+            stop_index=-1,
+            dead=False,
+        )
+    )
+    session.commit()
+
+
+@pytest.mark.asyncio
+async def test_ingest_flushes_on_close(mock_route_args):
+    # Arrange
+    now = datetime.now(timezone.utc)
+    mock_tracker_session(mock_route_args.session, now)
+    pipeline = IngestPipeline(mock_route_args.req.app.state.db, FleetState())
+
+    # Act
+    for i in range(3):
+        await pipeline.submit(
+            IngestItem(1, "1", [LocationFix(now + timedelta(seconds=i), 1.0, 2.0)])
+        )
+    await pipeline.close()
+
+    # Assert
+    assert len(pipeline) == 0
+    assert mock_route_args.session.query(VanLocation).count() == 3
+    tracker_session = mock_route_args.session.query(VanTrackerSession).one()
+    assert tracker_session.updated_at.replace(tzinfo=timezone.utc) == now + timedelta(
+        seconds=2
+    )
+
+
+@pytest.mark.asyncio
+async def test_ingest_retries_failed_batch(mock_route_args, monkeypatch):
+    # Arrange
+    now = datetime.now(timezone.utc)
+    mock_tracker_session(mock_route_args.session, now)
+    pipeline = IngestPipeline(
+        mock_route_args.req.app.state.db, FleetState(), retry_delay=0.001
+    )
+    write = pipeline._write
+    calls = 0
+
+    def fail_once(*args):
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            raise RuntimeError("database unavailable")
+        return write(*args)
+
+    monkeypatch.setattr(pipeline, "_write", fail_once)
+
+    # Act
+    await pipeline.submit(IngestItem(1, "1", [LocationFix(now, 1.0, 2.0)]))
+    await pipeline.close()
+
+    # Assert
+    assert calls == 2
+    assert pipeline.dropped_fixes == 0
+    assert mock_route_args.session.query(VanLocation).count() == 1
+
+
+@pytest.mark.asyncio
+async def test_ingest_drops_batch_after_max_attempts(mock_route_args, monkeypatch):
+    # Arrange
+    now = datetime.now(timezone.utc)
+    mock_tracker_session(mock_route_args.session, now)
+    pipeline = IngestPipeline(
+        mock_route_args.req.app.state.db,
+        FleetState(),
+        max_attempts=3,
+        retry_delay=0.001,
+    )
+    calls = 0
+
+    def fail(*args):
+        nonlocal calls
+        calls += 1
+        raise RuntimeError("database unavailable")
+
+    monkeypatch.setattr(pipeline, "_write", fail)
+
+    # Act
+    await pipeline.submit(
+        IngestItem(1, "1", [LocationFix(now, 1.0, 2.0), LocationFix(now, 1.0, 2.0)])
+    )
+    await pipeline.close()
+
+    # Assert
+    assert calls == 3
+    assert pipeline.dropped_fixes == 2
+    assert mock_route_args.session.query(VanLocation).count() == 0
@@ -0,0 +1,22 @@
+from types import SimpleNamespace
+
+from sqlalchemy import create_engine
+from src.vantracking.jobs import LOCK_RETENTION, WorkerRegistration, job_lock
+
+
+def test_jobs_always_run_without_postgres():
+    # Arrange
+    db = SimpleNamespace(engine=create_engine("sqlite://"))
+    cleaned_up = []
+    workers = WorkerRegistration(db)
+
+    # Act
+    first = workers.join(lambda: cleaned_up.append(True))
+    with job_lock(db, LOCK_RETENTION) as acquired:
+        pass
+    workers.close()
+
+    # Assert
+    assert first
+    assert cleaned_up == [True]
+    assert acquired
@@ -0,0 +1,170 @@
+import asyncio
+
+import pytest
+from src.vantracking.outbox import Outbox
+
+
+class GatedWebSocket:
+    """
+    A client that only accepts a message once the gate is opened.
+    """
+
+    def __init__(self) -> None:
+        self.gate = asyncio.Event()
+        self.sent: list = []
+        self.closed = False
+
+    async def send_text(self, data):
+        await self.gate.wait()
+        self.sent.append(data)
+
+    async def send_bytes(self, data):
+        await self.gate.wait()
+        self.sent.append(data)
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.mark.asyncio
+async def test_outbox_sends_in_order():
+    # Arrange
+    websocket = GatedWebSocket()
+    websocket.gate.set()
+    outbox = Outbox(websocket)
+
+    # Act
+    outbox.put("a")
+    outbox.put(b"b")
+    await asyncio.sleep(0.01)
+
+    # Assert
+    assert websocket.sent == ["a", b"b"]
+    assert len(outbox) == 0
+    await outbox.close()
+
+
+@pytest.mark.asyncio
+async def test_outbox_snapshot_replaces_queued_frames():
+    # Arrange
+    websocket = GatedWebSocket()
+    outbox = Outbox(websocket)
+    outbox.put("first")
+    await asyncio.sleep(0.01)
+    outbox.put("delta 1")
+    outbox.put("delta 2")
+
+    # Act
+    outbox.put("snapshot", snapshot=True)
+    websocket.gate.set()
+    await asyncio.sleep(0.01)
+
+    # Assert
+    assert websocket.sent == ["first", "snapshot"]
+    await outbox.close()
+
+
+@pytest.mark.asyncio
+async def test_outbox_bounded():
+    # Arrange
+    websocket = GatedWebSocket()
+    outbox = Outbox(websocket, max_frames=2, max_bytes=10)
+    outbox.put("sending")
+    await asyncio.sleep(0.01)
+
+    # Act
+    queued = [outbox.put("a"), outbox.put("b"), outbox.put("c")]
+    too_big = outbox.put("x" * 11, snapshot=False)
+
+    # Assert
+    assert queued == [True, True, False]
+    assert not too_big
+    assert len(outbox) == 2
+    assert not outbox.closed
+    await outbox.close()
+
+
+@pytest.mark.asyncio
+async def test_outbox_disconnects_stuck_client():
+    # Arrange
+    websocket = GatedWebSocket()
+    outbox = Outbox(websocket, deadline=0.01)
+
+    # Act
+    outbox.put("never received")
+    await asyncio.sleep(0.05)
+
+    # Assert
+    assert outbox.closed
+    assert websocket.closed
+    assert not outbox.put("later")
+    await outbox.close()
+
+
+class SlowWebSocket(GatedWebSocket):
+    """
+    A client that takes a while to accept every message, but never long enough for a
+    single send to miss the deadline.
+    """
+
+    def __init__(self, delay: float) -> None:
+        super().__init__()
+        self.delay = delay
+
+    async def send_text(self, data):
+        await asyncio.sleep(self.delay)
+        self.sent.append(data)
+
+
+@pytest.mark.asyncio
+async def test_outbox_bounded_by_encoded_size():
+    # Arrange
+    websocket = GatedWebSocket()
+    outbox = Outbox(websocket, max_bytes=4)
+    outbox.put("sending")
+    await asyncio.sleep(0.01)
+
+    # Act
+    too_big = outbox.put("ééé")
+    queued = outbox.put("éé")
+
+    # Assert
+    assert not too_big
+    assert queued
+    await outbox.close()
+
+
+@pytest.mark.asyncio
+async def test_outbox_disconnects_client_behind_without_further_puts():
+    # Arrange
+    websocket = SlowWebSocket(delay=0.03)
+    outbox = Outbox(websocket, max_frames=3, deadline=0.05)
+    for i in range(5):
+        outbox.put(str(i))
+
+    # Act
+    await asyncio.sleep(0.2)
+
+    # Assert
+    assert outbox.closed
+    assert websocket.closed
+    assert len(websocket.sent) < 4
+    await outbox.close()
+
+
+@pytest.mark.asyncio
+async def test_outbox_snapshots_do_not_hold_off_deadline():
+    # Arrange
+    websocket = SlowWebSocket(delay=0.02)
+    outbox = Outbox(websocket, max_frames=1, deadline=0.05)
+
+    # Act
+    for i in range(40):
+        if not outbox.put(f"delta {i}"):
+            outbox.put(f"snapshot {i}", snapshot=True)
+        await asyncio.sleep(0.005)
+
+    # Assert
+    assert outbox.closed
+    assert websocket.closed
+    await outbox.close()
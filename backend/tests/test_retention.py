@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta, timezone
+
+from src.model.van_location import VanLocation
+from src.model.van_location_history import VanLocationHistory
+from src.model.van_tracker_session import VanTrackerSession
+from src.vantracking.retention import LocationPartitions, partition_for
+
+
+def test_partition_for():
+    # Act
+    partition = partition_for(datetime(2024, 3, 5, 13, 30, tzinfo=timezone.utc))
+
+    # Assert
+    assert partition.name == "van_location_p20240305"
+    assert partition.start == datetime(2024, 3, 5, tzinfo=timezone.utc)
+    assert partition.end == datetime(2024, 3, 6, tzinfo=timezone.utc)
+
+
+def test_roll_up_expired_partitions(mock_session):
+    # Arrange
+    now = datetime(2024, 3, 20, 12, tzinfo=timezone.utc)
+    old = datetime(2024, 3, 1, 8, 15, tzinfo=timezone.utc)
+    mock_session.add(
+        VanTrackerSession(
+            id=1,
+            created_at=old,
+            updated_at=now,
+            van_guid="1",
+            route_id=1,
+            stop_index=-1,
+            dead=True,
+        )
+    )
+    mock_session.add_all(
+        [
+            VanLocation(session_id=1, created_at=old, lat=1.0, lon=2.0),
+            VanLocation(
+                session_id=1, created_at=old + timedelta(seconds=30), lat=3.0, lon=4.0
+            ),
+            VanLocation(
+                session_id=1, created_at=old + timedelta(minutes=1), lat=5.0, lon=6.0
+            ),
+            VanLocation(session_id=1, created_at=now, lat=7.0, lon=8.0),
+        ]
+    )
+    mock_session.commit()
+    partitions = LocationPartitions(retention=timedelta(days=14))
+
+    # Act
+    expired = partitions.maintain(mock_session, now)
+
+    # Assert
+    assert [partition.name for partition in expired] == ["van_location_p20240301"]
+    assert mock_session.query(VanLocation).count() == 1
+    history = mock_session.query(VanLocationHistory).order_by("bucket").all()
+    assert [(row.lat, row.lon, row.samples) for row in history] == [
+        (2.0, 3.0, 2),
+        (5.0, 6.0, 1),
+    ]
+    assert history[0].bucket == old.replace(second=0)
+    assert partitions.maintain(mock_session, now) == []
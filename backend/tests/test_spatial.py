@@ -0,0 +1,101 @@
+import random
+
+import pytest
+from src.vantracking.geo import distance_meters
+from src.vantracking.ingest import initial_stop_index
+from src.vantracking.spatial import BoundingBox, PointGrid, RouteIndex, segment_distance
+from src.vantracking.state import StopPoint
+
+
+def random_stops(rng: random.Random, count: int):
+    return [
+        StopPoint(i, 39.75 + rng.uniform(0, 0.02), -105.22 + rng.uniform(0, 0.02))
+        for i in range(count)
+    ]
+
+
+def test_nearest_matches_linear_scan():
+    rng = random.Random(3)
+    for count in [1, 2, 5, 40, 300]:
+        stops = random_stops(rng, count)
+        index = RouteIndex(stops)
+        segments = [(stop, stops[(i + 1) % count]) for i, stop in enumerate(stops)]
+        for _ in range(50):
+            lat = 39.75 + rng.uniform(-0.005, 0.025)
+            lon = -105.22 + rng.uniform(-0.005, 0.025)
+
+            expected_stop = min(
+                range(count),
+                key=lambda i: distance_meters(lat, lon, stops[i].lat, stops[i].lon),
+            )
+            assert index.nearest_stop(lat, lon) == expected_stop
+
+            match = index.nearest_segment(lat, lon)
+            if count < 2:
+                assert match is None
+                continue
+            expected_distance = min(
+                segment_distance(lat, lon, start, end)[0] for start, end in segments
+            )
+            assert match.distance == pytest.approx(expected_distance)
+
+
+def test_nearest_segment_fraction():
+    # Arrange
+    index = RouteIndex(
+        [
+            StopPoint(1, 39.7510, -105.2220),
+            StopPoint(2, 39.7560, -105.2220),
+            StopPoint(3, 39.7560, -105.2160),
+        ]
+    )
+
+    # Act
+    match = index.nearest_segment(39.7535, -105.2221)
+
+    # Assert
+    assert match.segment == 0
+    assert match.fraction == pytest.approx(0.5)
+    assert index.nearest_segment(39.7535, -105.2160) is not None
+
+
+def test_initial_stop_index():
+    # Arrange
+    index = RouteIndex(
+        [
+            StopPoint(1, 39.7510, -105.2220),
+            StopPoint(2, 39.7560, -105.2220),
+            StopPoint(3, 39.7560, -105.2160),
+        ]
+    )
+
+    # Act / Assert
+    assert initial_stop_index(index, 39.7515, -105.2220, -1) == 0
+    assert initial_stop_index(index, 39.7559, -105.2200, -1) == 1
+    assert initial_stop_index(index, 39.7560, -105.2165, -1) == 2
+    assert initial_stop_index(RouteIndex([]), 39.7560, -105.2165, -1) == -1
+
+
+def test_point_grid_within_matches_linear_scan():
+    rng = random.Random(5)
+    grid = PointGrid()
+    points = {}
+    for i in range(300):
+        key = str(i % 100)
+        points[key] = (39.75 + rng.uniform(0, 0.05), -105.22 + rng.uniform(0, 0.05))
+        grid.move(key, *points[key])
+    for key in ["3", "40"]:
+        grid.remove(key)
+        del points[key]
+
+    for size in [0.001, 0.01, 0.1]:
+        for _ in range(30):
+            lat = 39.75 + rng.uniform(-0.01, 0.05)
+            lon = -105.22 + rng.uniform(-0.01, 0.05)
+            box = BoundingBox(lat, lon, lat + size, lon + size)
+
+            expected = sorted(
+                key for key, (lat, lon) in points.items() if box.contains(lat, lon)
+            )
+            assert sorted(grid.within(box)) == expected
+    assert len(grid) == 98
@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+from src.vantracking.outbox import Outbox
+from src.vantracking.streams import KEEPALIVE, EventStream, PollResult, stream_events
+
+
+@pytest.mark.asyncio
+async def test_event_stream_sends_events_and_keepalives():
+    # Arrange
+    stream = EventStream(keepalive=0.01)
+    outbox = Outbox(stream)
+    left = []
+
+    async def leave():
+        left.append(True)
+
+    def join():
+        outbox.put('{"type":"snapshot"}')
+        return leave
+
+    events = stream_events(stream, outbox, join)
+
+    # Act
+    first = await anext(events)
+    second = await anext(events)
+    await events.aclose()
+
+    # Assert
+    assert first == 'data: {"type":"snapshot"}\n\n'
+    assert second == KEEPALIVE
+    assert outbox.closed
+    assert left == [True]
+
+
+@pytest.mark.asyncio
+async def test_event_stream_joins_once_started():
+    # Arrange
+    stream = EventStream()
+    outbox = Outbox(stream)
+    joined = []
+
+    def join():
+        joined.append(True)
+        return outbox.close
+
+    # Act
+    events = stream_events(stream, outbox, join)
+    before = list(joined)
+    await events.aclose()
+
+    # Assert
+    assert before == []
+    assert joined == []
+
+
+@pytest.mark.asyncio
+async def test_poll_result_keeps_first_frame():
+    # Arrange
+    result = PollResult()
+    outbox = Outbox(result)
+
+    # Act
+    outbox.put("first")
+    outbox.put("second")
+    frame = await result.wait(0.1)
+
+    # Assert
+    assert frame == "first"
+    assert await PollResult().wait(0.01) is None
+    await outbox.close()
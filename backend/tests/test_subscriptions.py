@@ -0,0 +1,115 @@
+from datetime import datetime, timezone
+
+from src.model.van_tracker_session import VanTrackerSession
+from src.vantracking.spatial import BoundingBox
+from src.vantracking.state import FleetState, VanState
+from src.vantracking.subscriptions import (
+    ArrivalSubscriptionRegistry,
+    VanSubscriptionRegistry,
+)
+
+
+def begin_session(fleet: FleetState, guid: str, route_id: int) -> VanState:
+    now = datetime.now(timezone.utc)
+    return fleet.begin_session(
+        VanTrackerSession(
+            id=int(guid),
+            created_at=now,
+            updated_at=now,
+            van_guid=guid,
+            route_id=route_id,
+            stop_index=-1,
+            dead=False,
+        )
+    )
+
+
+def is_changed(subscription) -> bool:
+    return subscription._changed.is_set()  # pylint: disable=protected-access
+
+
+def test_van_registry_only_marks_interested_subscriptions():
+    # Arrange
+    fleet = FleetState()
+    registry = VanSubscriptionRegistry()
+    fleet.add_listener(registry.notify)
+    everything = registry.join("all", object())
+    route_3 = registry.join("route 3", object(), route_ids={3})
+    route_7 = registry.join("route 7", object(), route_ids={7})
+    van_1 = registry.join("van 1", object(), guid="1")
+    van_2 = registry.join("van 2", object(), guid="2")
+
+    # Act
+    begin_session(fleet, "1", 3)
+
+    # Assert
+    assert [
+        is_changed(subscription)
+        for subscription in (everything, route_3, route_7, van_1, van_2)
+    ] == [True, True, False, True, False]
+
+
+def test_van_registry_shares_and_drops_subscriptions():
+    # Arrange
+    fleet = FleetState()
+    registry = VanSubscriptionRegistry()
+    fleet.add_listener(registry.notify)
+    first, second = object(), object()
+    subscription = registry.join("route 3", first, route_ids={3})
+
+    # Act
+    shared = registry.join("route 3", second, route_ids={3})
+    last = [registry.leave(subscription, first), registry.leave(subscription, second)]
+    begin_session(fleet, "1", 3)
+
+    # Assert
+    assert shared is subscription
+    assert last == [False, True]
+    assert len(registry) == 0
+    assert not is_changed(subscription)
+
+
+def test_van_registry_marks_viewports_a_van_moves_through():
+    # Arrange
+    fleet = FleetState()
+    registry = VanSubscriptionRegistry()
+    fleet.add_listener(registry.notify)
+    van = begin_session(fleet, "1", 3)
+    now = datetime.now(timezone.utc)
+    fleet.record_fix(van, now, 39.7500, -105.2200, -1)
+    south = registry.join(
+        "south", object(), viewport=BoundingBox(39.749, -105.221, 39.751, -105.219)
+    )
+    north = registry.join(
+        "north", object(), viewport=BoundingBox(39.759, -105.221, 39.761, -105.219)
+    )
+    east = registry.join(
+        "east", object(), viewport=BoundingBox(39.749, -105.201, 39.761, -105.199)
+    )
+
+    # Act
+    fleet.record_fix(van, now, 39.7600, -105.2200, -1)
+
+    # Assert
+    assert [is_changed(subscription) for subscription in (south, north, east)] == [
+        True,
+        True,
+        False,
+    ]
+
+
+def test_arrival_registry_drops_frames_of_changed_routes():
+    # Arrange
+    fleet = FleetState()
+    registry = ArrivalSubscriptionRegistry()
+    fleet.add_listener(registry.notify)
+    route_3 = registry.join("route 3", object(), ((1, (3,)),))
+    route_7 = registry.join("route 7", object(), ((1, (7,)),))
+    route_3.frame = route_7.frame = "frame"
+
+    # Act
+    begin_session(fleet, "1", 3)
+
+    # Assert
+    assert route_3.frame is None
+    assert route_7.frame == "frame"
@@ -0,0 +1,1237 @@
+import asyncio
+import json
+import struct
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from unittest.mock import MagicMock
+
+import pytest
+import pytest_asyncio
+from src.handlers.routes import delete_route
+from src.handlers.vans import (
+    DELTA_HEADER,
+    FRAME_DELTA,
+    FRAME_HEADER,
+    FRAME_LOCATIONS_V1,
+    FRAME_SNAPSHOT,
+    FRAME_VANS,
+    LOCATION_RECORD_V1,
+    REMOVED_RECORD,
+    VAN_FLAG_ALIVE,
+    VAN_FLAG_COLOR,
+    VAN_FLAG_LOCATION,
+    VAN_RECORD,
+    begin_session,
+    encode_locations_v1,
+    encode_van_subscription,
+    get_subscription_stats,
+    get_van_v2,
+    get_vans_v2,
+    poll_arrivals,
+    poll_vans,
+    post_location,
+    post_location_batch,
+    query_arrivals,
+    query_locations_v1,
+    stream_arrivals,
+    stream_vans,
+    subscribe_arrivals,
+    subscribe_vans,
+)
+from src.hardware import HardwareErrorCode, HardwareHTTPException, HardwareOKResponse
+from src.model.route import Route
+from src.model.route_stop import RouteStop
+from src.model.stop import Stop
+from src.model.van_location import VanLocation
+from src.model.van_tracker_session import VanTrackerSession
+from src.vantracking.arrivals import ArrivalEngine
+from src.vantracking.changelog import ChangeLog
+from src.vantracking.ingest import IngestPipeline
+from src.vantracking.outbox import Outbox
+from src.vantracking.state import FleetState
+from src.vantracking.subscriptions import (
+    ArrivalSubscriptionRegistry,
+    VanSubscriptionRegistry,
+)
+
+
+@pytest.fixture
+def mock_stops():
+    return [
+        Stop(id=1, name="Stop 1", lat=39.7510, lon=-105.2220, active=True),
+        Stop(id=2, name="Stop 2", lat=39.7560, lon=-105.2220, active=True),
+        Stop(id=3, name="Stop 3", lat=39.7560, lon=-105.2160, active=True),
+    ]
+
+
+@pytest_asyncio.fixture
+async def mock_fleet_args(mock_route_args, mock_stops):
+    mock_route_args.session.add_all(mock_stops)
+    mock_route_args.session.add(Route(id=1, name="Route 1", color="#FF0000"))
+    mock_route_args.session.add_all(
+        [
+            RouteStop(id=i + 1, route_id=1, stop_id=stop.id, position=i)
+            for i, stop in enumerate(mock_stops)
+        ]
+    )
+    mock_route_args.session.commit()
+
+    fleet = FleetState()
+    fleet.load(mock_route_args.session)
+    change_log = ChangeLog()
+    fleet.add_listener(change_log.notify)
+    registry = VanSubscriptionRegistry()
+    fleet.add_listener(registry.notify)
+    arrivals = ArrivalEngine(fleet)
+    fleet.add_listener(arrivals.notify)
+    mock_route_args.req.app.state.arrivals = arrivals
+    mock_route_args.req.app.state.fleet = fleet
+    mock_route_args.req.app.state.change_log = change_log
+    mock_route_args.req.app.state.ingest = IngestPipeline(
+        mock_route_args.req.app.state.db, fleet
+    )
+    mock_route_args.req.app.state.van_subscriptions = registry
+    arrival_registry = ArrivalSubscriptionRegistry()
+    fleet.add_listener(arrival_registry.notify)
+    mock_route_args.req.app.state.arrival_subscriptions = arrival_registry
+    yield mock_route_args
+    await mock_route_args.req.app.state.ingest.close()
+
+
+def mock_body(*values, fmt: str):
+    async def inner():
+        return struct.pack(fmt, *values)
+
+    return inner
+
+
+def mock_location_body(time: datetime, lat: float, lon: float):
+    return mock_body(int(time.timestamp() * 1000), lat, lon, fmt="<Qdd")
+
+
+def mock_location_batch_body(fixes):
+    async def inner():
+        return b"".join(
+            struct.pack("<Qdd", int(time.timestamp() * 1000), lat, lon)
+            for time, lat, lon in fixes
+        )
+
+    return inner
+
+
+async def start_session(args, van_guid: str = "1", route_id: int = 1):
+    args.req.body = mock_body(route_id, fmt="<i")
+    return await begin_session(args.req, van_guid)
+
+
+async def wait_for_sent(websocket, count: int, timeout: float = 1.0):
+    """
+    Waits until a websocket was sent at least some number of messages, since a
+    handler can take several hops through the event loop to get to them.
+    """
+    async with asyncio.timeout(timeout):
+        while len(websocket.sent) < count:
+            await asyncio.sleep(0.001)
+
+
+@pytest.mark.asyncio
+async def test_begin_session(mock_fleet_args):
+    # Act
+    response = await start_session(mock_fleet_args)
+
+    # Assert
+    assert response == HardwareOKResponse()
+    van = mock_fleet_args.req.app.state.fleet.van("1")
+    assert van is not None
+    assert van.route_id == 1
+    assert not van.dead
+
+
+@pytest.mark.asyncio
+async def test_begin_session_invalid_route(mock_fleet_args):
+    # Act / Assert
+    with pytest.raises(HardwareHTTPException) as e:
+        await start_session(mock_fleet_args, route_id=42)
+    assert e.value.error_code == HardwareErrorCode.INVALID_ROUTE_ID
+
+
+@pytest.mark.asyncio
+async def test_post_location_without_session(mock_fleet_args):
+    # Arrange
+    now = datetime.now(timezone.utc)
+    mock_fleet_args.req.body = mock_location_body(now, 39.7510, -105.2220)
+
+    # Act / Assert
+    with pytest.raises(HardwareHTTPException) as e:
+        await post_location(mock_fleet_args.req, "1")
+    assert e.value.error_code == HardwareErrorCode.CREATE_NEW_SESSION
+
+
+@pytest.mark.asyncio
+async def test_post_location_updates_fleet(mock_fleet_args):
+    # Arrange
+    await start_session(mock_fleet_args)
+    now = datetime.now(timezone.utc) - timedelta(seconds=1)
+    mock_fleet_args.req.body = mock_location_body(now, 39.7555, -105.2220)
+
+    # Act
+    response = await post_location(mock_fleet_args.req, "1")
+
+    # Assert
+    assert response == HardwareOKResponse()
+    van = mock_fleet_args.req.app.state.fleet.van("1")
+    assert (van.lat, van.lon) == (39.7555, -105.2220)
+    assert van.stop_index == 1
+    await mock_fleet_args.req.app.state.ingest.flush()
+    tracker_session = mock_fleet_args.session.query(VanTrackerSession).one()
+    assert tracker_session.stop_index == 1
+    assert mock_fleet_args.session.query(VanLocation).count() == 1
+
+
+@pytest.mark.asyncio
+async def test_post_location_advances_stop_after_dwell(mock_fleet_args):
+    # Arrange
+    await start_session(mock_fleet_args)
+    now = datetime.now(timezone.utc)
+    mock_fleet_args.req.body = mock_location_body(
+        now - timedelta(seconds=40), 39.7510, -105.2220
+    )
+    await post_location(mock_fleet_args.req, "1")
+    assert mock_fleet_args.req.app.state.fleet.van("1").stop_index == 0
+
+    # Act
+    for seconds_ago in (30, 20, 8):
+        mock_fleet_args.req.body = mock_location_body(
+            now - timedelta(seconds=seconds_ago), 39.7560, -105.2219
+        )
+        await post_location(mock_fleet_args.req, "1")
+    await mock_fleet_args.req.app.state.ingest.flush()
+
+    # Assert
+    assert mock_fleet_args.req.app.state.fleet.van("1").stop_index == 1
+
+
+@pytest.mark.asyncio
+async def test_post_location_batch(mock_fleet_args):
+    # Arrange
+    await start_session(mock_fleet_args)
+    now = datetime.now(timezone.utc)
+    mock_fleet_args.req.body = mock_location_batch_body(
+        [
+            (now - timedelta(seconds=8), 39.7560, -105.2219),
+            (now - timedelta(seconds=40), 39.7510, -105.2220),
+            (now - timedelta(seconds=30), 39.7560, -105.2219),
+            (now - timedelta(seconds=20), 39.7560, -105.2219),
+        ]
+    )
+
+    # Act
+    response = await post_location_batch(mock_fleet_args.req, "1")
+    await mock_fleet_args.req.app.state.ingest.flush()
+
+    # Assert
+    assert response == HardwareOKResponse()
+    assert mock_fleet_args.session.query(VanLocation).count() == 4
+    van = mock_fleet_args.req.app.state.fleet.van("1")
+    assert (van.lat, van.lon) == (39.7560, -105.2219)
+    assert van.stop_index == 1
+
+
+@pytest.mark.asyncio
+async def test_post_location_batch_rejects_whole_batch(mock_fleet_args):
+    # Arrange
+    await start_session(mock_fleet_args)
+    now = datetime.now(timezone.utc)
+    mock_fleet_args.req.body = mock_location_batch_body(
+        [
+            (now - timedelta(seconds=10), 39.7510, -105.2220),
+            (now + timedelta(minutes=5), 39.7510, -105.2220),
+        ]
+    )
+
+    # Act / Assert
+    with pytest.raises(HardwareHTTPException) as e:
+        await post_location_batch(mock_fleet_args.req, "1")
+    assert e.value.error_code == HardwareErrorCode.TIMESTAMP_IN_FUTURE
+    assert mock_fleet_args.session.query(VanLocation).count() == 0
+
+
+@pytest.mark.asyncio
+async def test_get_vans_v2(mock_fleet_args):
+    # Arrange
+    await start_session(mock_fleet_args)
+    now = datetime.now(timezone.utc) - timedelta(seconds=1)
+    mock_fleet_args.req.body = mock_location_body(now, 39.7530, -105.2220)
+    await post_location(mock_fleet_args.req, "1")
+
+    # Act
+    response = await get_vans_v2(
+        mock_fleet_args.req, alive=True, include=["location", "color"]
+    )
+
+    # Assert
+    assert len(response) == 1
+    assert response[0]["guid"] == "1"
+    assert response[0]["alive"]
+    assert response[0]["location"] == {"latitude": 39.7530, "longitude": -105.2220}
+    assert response[0]["color"] == "#FF0000"
+    assert await get_vans_v2(mock_fleet_args.req, route_ids=[2]) == []
+
+
+@pytest.mark.asyncio
+async def test_get_van_v2_not_found(mock_fleet_args):
+    # Act / Assert
+    with pytest.raises(Exception) as e:
+        await get_van_v2(mock_fleet_args.req, "404")
+    assert e.value.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_delete_route_kills_sessions(mock_fleet_args):
+    # Arrange
+    await start_session(mock_fleet_args)
+    await mock_fleet_args.req.app.state.ingest.flush()
+
+    # Act
+    delete_route(mock_fleet_args.req)
+
+    # Assert
+    fleet = mock_fleet_args.req.app.state.fleet
+    assert fleet.route(1) is None
+    assert fleet.van("1").dead
+    assert await get_vans_v2(mock_fleet_args.req, alive=True) == []
+    tracker_session = mock_fleet_args.session.query(VanTrackerSession).one()
+    assert tracker_session.dead
+
+
+@pytest.mark.asyncio
+async def test_query_arrivals(mock_fleet_args, mock_stops):
+    # Arrange
+    await start_session(mock_fleet_args)
+    now = datetime.now(timezone.utc) - timedelta(seconds=1)
+    mock_fleet_args.req.body = mock_location_body(now, 39.7515, -105.2220)
+    await post_location(mock_fleet_args.req, "1")
+
+    # Act
+    arrivals = query_arrivals(
+        mock_fleet_args.req.app.state.arrivals, now, {"2": [1], "3": [1]}
+    )
+
+    # Assert
+    assert set(arrivals) == {2, 3}
+    assert 0 < arrivals[2][1] < arrivals[3][1]
+
+
+@pytest.mark.asyncio
+async def test_subscribe_vans_pushes_changes(mock_fleet_args, mock_websocket):
+    # Arrange
+    await start_session(mock_fleet_args)
+    websocket = mock_websocket
+    websocket.app = mock_fleet_args.req.app
+    task = asyncio.create_task(subscribe_vans(websocket))
+    websocket.incoming.put_nowait(
+        {
+            "include": ["location"],
+            "query": {"type": "vans", "routeIds": [1]},
+            "subscribe": True,
+        }
+    )
+    await asyncio.sleep(0.01)
+
+    # Act
+    now = datetime.now(timezone.utc) - timedelta(seconds=1)
+    mock_fleet_args.req.body = mock_location_body(now, 39.7530, -105.2220)
+    await post_location(mock_fleet_args.req, "1")
+    await asyncio.sleep(0.01)
+
+    # Assert
+    assert len(websocket.sent) == 2
+    assert "location" not in websocket.sent[0]["vans"][0]
+    assert websocket.sent[1]["vans"][0]["location"] == {
+        "latitude": 39.7530,
+        "longitude": -105.2220,
+    }
+
+    websocket.incoming.put_nowait(None)
+    await task
+    assert len(mock_fleet_args.req.app.state.van_subscriptions) == 0
+
+
+@pytest.mark.asyncio
+async def test_subscribe_vans_binary(mock_fleet_args, mock_websocket):
+    # Arrange
+    await start_session(mock_fleet_args)
+    now = datetime.now(timezone.utc) - timedelta(seconds=1)
+    mock_fleet_args.req.body = mock_location_body(now, 39.7530, -105.2220)
+    await post_location(mock_fleet_args.req, "1")
+    websocket = mock_websocket
+    websocket.app = mock_fleet_args.req.app
+    task = asyncio.create_task(subscribe_vans(websocket))
+
+    # Act
+    websocket.incoming.put_nowait(
+        {
+            "include": ["location", "color"],
+            "query": {"type": "vans"},
+            "format": "binary",
+        }
+    )
+    websocket.incoming.put_nowait(
+        {"include": [], "query": {"type": "vans"}, "format": "xml"}
+    )
+    await asyncio.sleep(0.01)
+
+    # Assert
+    frame = websocket.sent[0]
+    assert FRAME_HEADER.unpack_from(frame) == (FRAME_VANS, 1)
+    guid, flags, _, _, lat, lon, color = VAN_RECORD.unpack_from(
+        frame, FRAME_HEADER.size
+    )
+    assert len(frame) == FRAME_HEADER.size + VAN_RECORD.size
+    assert guid == 1
+    assert flags == VAN_FLAG_ALIVE | VAN_FLAG_LOCATION | VAN_FLAG_COLOR
+    assert (lat, lon) == (39753000, -105222000)
+    assert color == bytes.fromhex("FF0000")
+    assert websocket.sent[1] == {"type": "error", "error": "Invalid format xml"}
+
+    websocket.incoming.put_nowait(None)
+    await task
+
+
+@pytest.mark.asyncio
+async def test_subscribe_vans_deltas(mock_fleet_args, mock_websocket):
+    # Arrange
+    await start_session(mock_fleet_args, "1")
+    await start_session(mock_fleet_args, "2")
+    websocket = mock_websocket
+    websocket.app = mock_fleet_args.req.app
+    task = asyncio.create_task(subscribe_vans(websocket))
+    websocket.incoming.put_nowait(
+        {
+            "include": ["location"],
+            "query": {"type": "vans", "alive": True},
+            "subscribe": True,
+            "deltas": True,
+        }
+    )
+    await asyncio.sleep(0.01)
+
+    # Act
+    now = datetime.now(timezone.utc) - timedelta(seconds=1)
+    mock_fleet_args.req.body = mock_location_body(now, 39.7530, -105.2220)
+    await post_location(mock_fleet_args.req, "1")
+    await asyncio.sleep(0.01)
+    van = mock_fleet_args.req.app.state.fleet.van("2")
+    van.dead = True
+    mock_fleet_args.req.app.state.fleet.update_stop_index(van, 1)
+    await asyncio.sleep(0.01)
+
+    # Assert
+    snapshot, moved, removed = websocket.sent
+    assert snapshot["type"] == "snapshot"
+    assert [van["guid"] for van in snapshot["vans"]] == ["1", "2"]
+    assert moved["type"] == "delta"
+    assert moved["sequence"] > snapshot["sequence"]
+    assert [van["guid"] for van in moved["vans"]] == ["1"]
+    assert moved["vans"][0]["location"] == {"latitude": 39.7530, "longitude": -105.2220}
+    assert moved["removed"] == []
+    assert removed["sequence"] > moved["sequence"]
+    assert removed["vans"] == []
+    assert removed["removed"] == ["2"]
+
+    websocket.incoming.put_nowait(None)
+    await task
+
+
+@pytest.mark.asyncio
+async def test_subscribe_vans_viewport(mock_fleet_args, mock_websocket):
+    # Arrange
+    now = datetime.now(timezone.utc) - timedelta(seconds=1)
+    for guid, lat in [("1", 39.7500), ("2", 39.7600)]:
+        await start_session(mock_fleet_args, guid)
+        mock_fleet_args.req.body = mock_location_body(now, lat, -105.2200)
+        await post_location(mock_fleet_args.req, guid)
+    websocket = mock_websocket
+    websocket.app = mock_fleet_args.req.app
+    task = asyncio.create_task(subscribe_vans(websocket))
+    websocket.incoming.put_nowait(
+        {
+            "include": ["location"],
+            "query": {"type": "vans"},
+            "subscribe": True,
+            "deltas": True,
+            "viewport": [39.749, -105.221, 39.751, -105.219],
+        }
+    )
+    await wait_for_sent(websocket, 1)
+
+    # Act
+    mock_fleet_args.req.body = mock_location_body(now, 39.7505, -105.2200)
+    await post_location(mock_fleet_args.req, "2")
+    await wait_for_sent(websocket, 2)
+    websocket.incoming.put_nowait({"viewport": [39.759, -105.221, 39.761, -105.219]})
+    await wait_for_sent(websocket, 3)
+    mock_fleet_args.req.body = mock_location_body(now, 39.7601, -105.2200)
+    await post_location(mock_fleet_args.req, "1")
+    await wait_for_sent(websocket, 4)
+
+    # Assert
+    snapshot, entered, panned, moved = websocket.sent
+    assert [van["guid"] for van in snapshot["vans"]] == ["1"]
+    assert [van["guid"] for van in entered["vans"]] == ["2"]
+    assert panned["type"] == "delta"
+    assert panned["vans"] == []
+    assert panned["removed"] == ["1", "2"]
+    assert [van["guid"] for van in moved["vans"]] == ["1"]
+    assert moved["removed"] == []
+
+    websocket.incoming.put_nowait(None)
+    await task
+
+
+@pytest.mark.asyncio
+async def test_subscribe_vans_viewport_needs_deltas(mock_fleet_args, mock_websocket):
+    # Arrange
+    websocket = mock_websocket
+    websocket.app = mock_fleet_args.req.app
+    task = asyncio.create_task(subscribe_vans(websocket))
+
+    # Act
+    websocket.incoming.put_nowait(
+        {
+            "include": [],
+            "query": {"type": "vans"},
+            "subscribe": True,
+            "viewport": [39.749, -105.221, 39.751, -105.219],
+        }
+    )
+    websocket.incoming.put_nowait(
+        {
+            "include": [],
+            "query": {"type": "vans"},
+            "subscribe": True,
+            "deltas": True,
+            "viewport": [39.751, -105.221, 39.749, -105.219],
+        }
+    )
+    await wait_for_sent(websocket, 2)
+
+    # Assert
+    assert [msg["type"] for msg in websocket.sent] == ["error", "error"]
+
+    websocket.incoming.put_nowait(None)
+    await task
+
+
+@pytest.mark.asyncio
+async def test_subscribe_vans_viewport_first(mock_fleet_args, mock_websocket):
+    # Arrange
+    await start_session(mock_fleet_args, "1")
+    websocket = mock_websocket
+    websocket.app = mock_fleet_args.req.app
+    task = asyncio.create_task(subscribe_vans(websocket))
+
+    # Act
+    websocket.incoming.put_nowait({"viewport": [39.749, -105.221, 39.751, -105.219]})
+    websocket.incoming.put_nowait(
+        {"include": [], "query": {"type": "vans"}, "subscribe": True}
+    )
+    websocket.incoming.put_nowait({"viewport": [39.749, -105.221, 39.751, -105.219]})
+    await wait_for_sent(websocket, 3)
+
+    # Assert
+    assert [msg["type"] for msg in websocket.sent] == ["error", "vans", "error"]
+    assert not task.done()
+
+    websocket.incoming.put_nowait(None)
+    await task
+
+
+@pytest.mark.asyncio
+async def test_subscribe_vans_binary_deltas(mock_fleet_args, mock_websocket):
+    # Arrange
+    await start_session(mock_fleet_args, "1")
+    websocket = mock_websocket
+    websocket.app = mock_fleet_args.req.app
+    task = asyncio.create_task(subscribe_vans(websocket))
+    websocket.incoming.put_nowait(
+        {
+            "include": [],
+            "query": {"type": "van", "guid": "1"},
+            "subscribe": True,
+            "deltas": True,
+            "format": "binary",
+        }
+    )
+    await asyncio.sleep(0.01)
+
+    # Act
+    mock_fleet_args.req.app.state.fleet.kill_all()
+    await asyncio.sleep(0.01)
+
+    # Assert
+    snapshot, delta = websocket.sent
+    fleet = mock_fleet_args.req.app.state.fleet
+    frame_type, epoch, _, count, removed = DELTA_HEADER.unpack_from(snapshot)
+    assert (frame_type, epoch, count, removed) == (FRAME_SNAPSHOT, fleet.epoch, 1, 0)
+    frame_type, _, sequence, count, removed = DELTA_HEADER.unpack_from(delta)
+    assert (frame_type, count, removed) == (FRAME_DELTA, 1, 0)
+    assert sequence == fleet.sequence
+    _, flags, *_ = VAN_RECORD.unpack_from(delta, DELTA_HEADER.size)
+    assert flags == 0
+
+    websocket.incoming.put_nowait(None)
+    await task
+
+
+@pytest.mark.asyncio
+async def test_subscribe_vans_resumes(mock_fleet_args, mock_websocket):
+    # Arrange
+    await start_session(mock_fleet_args, "1")
+    await start_session(mock_fleet_args, "2")
+    fleet = mock_fleet_args.req.app.state.fleet
+    since = fleet.sequence
+    now = datetime.now(timezone.utc) - timedelta(seconds=1)
+    mock_fleet_args.req.body = mock_location_body(now, 39.7530, -105.2220)
+    await post_location(mock_fleet_args.req, "2")
+    websocket = mock_websocket
+    websocket.app = mock_fleet_args.req.app
+    msg = {"include": [], "query": {"type": "vans"}, "subscribe": True, "deltas": True}
+
+    # Act
+    task = asyncio.create_task(subscribe_vans(websocket, since, fleet.epoch))
+    websocket.incoming.put_nowait(msg)
+    websocket.incoming.put_nowait(msg)
+    await wait_for_sent(websocket, 2)
+
+    # Assert
+    resumed, snapshot = websocket.sent
+    assert resumed["type"] == "delta"
+    assert resumed["sequence"] == fleet.sequence
+    assert [van["guid"] for van in resumed["vans"]] == ["2"]
+    assert snapshot["type"] == "snapshot"
+    assert len(snapshot["vans"]) == 2
+
+    websocket.incoming.put_nowait(None)
+    await task
+
+
+@pytest.mark.asyncio
+async def test_subscribe_vans_resume_ignores_other_routes(
+    mock_fleet_args, mock_websocket
+):
+    # Arrange
+    mock_fleet_args.session.add(Route(id=2, name="Route 2", color="#00FF00"))
+    mock_fleet_args.session.commit()
+    fleet = mock_fleet_args.req.app.state.fleet
+    fleet.refresh_routes(mock_fleet_args.session)
+    await start_session(mock_fleet_args, "1")
+    since = fleet.sequence
+    await start_session(mock_fleet_args, "2", route_id=2)
+    await start_session(mock_fleet_args, "3")
+    websocket = mock_websocket
+    websocket.app = mock_fleet_args.req.app
+    msg = {
+        "include": [],
+        "query": {"type": "vans", "routeIds": [1]},
+        "subscribe": True,
+        "deltas": True,
+    }
+
+    # Act
+    task = asyncio.create_task(subscribe_vans(websocket, since, fleet.epoch))
+    websocket.incoming.put_nowait(msg)
+    await wait_for_sent(websocket, 1)
+
+    # Assert
+    resumed = websocket.sent[0]
+    assert resumed["type"] == "delta"
+    assert [van["guid"] for van in resumed["vans"]] == ["3"]
+    assert resumed["removed"] == []
+
+    websocket.incoming.put_nowait(None)
+    await task
+
+
+@pytest.mark.asyncio
+async def test_subscribe_vans_resume_falls_back_to_snapshot(
+    mock_fleet_args, mock_websocket
+):
+    # Arrange
+    await start_session(mock_fleet_args, "1")
+    fleet = mock_fleet_args.req.app.state.fleet
+    websocket = mock_websocket
+    websocket.app = mock_fleet_args.req.app
+
+    # Act
+    task = asyncio.create_task(subscribe_vans(websocket, 0, fleet.epoch - 1))
+    websocket.incoming.put_nowait(
+        {"include": [], "query": {"type": "vans"}, "subscribe": True, "deltas": True}
+    )
+    await asyncio.sleep(0.01)
+
+    # Assert
+    assert websocket.sent[0]["type"] == "snapshot"
+
+    websocket.incoming.put_nowait(None)
+    await task
+
+
+@pytest.mark.asyncio
+async def test_subscriptions_close_stuck_clients_once(
+    mock_fleet_args, mock_websocket, monkeypatch
+):
+    # Arrange
+    await start_session(mock_fleet_args)
+    monkeypatch.setattr("src.handlers.vans.Outbox", partial(Outbox, deadline=0.01))
+    never_sent = asyncio.Event()
+    websockets = [type(mock_websocket)(app=mock_fleet_args.req.app) for _ in range(2)]
+    for websocket in websockets:
+        # The client never takes a message, so its outbox gives up on it.
+        websocket.send_text = lambda _: never_sent.wait()
+
+    # Act
+    tasks = [
+        asyncio.create_task(subscribe_vans(websockets[0])),
+        asyncio.create_task(subscribe_arrivals(websockets[1], subscribe=True)),
+    ]
+    websockets[0].incoming.put_nowait(
+        {"include": [], "query": {"type": "vans"}, "subscribe": True}
+    )
+    websockets[1].incoming.put_nowait({"2": [1]})
+    await asyncio.sleep(0.05)
+    for websocket in websockets:
+        websocket.incoming.put_nowait(None)
+    await asyncio.gather(*tasks)
+
+    # Assert
+    assert all(websocket.closed for websocket in websockets)
+
+
+@pytest.mark.asyncio
+async def test_subscribe_arrivals_resumes(mock_fleet_args, mock_websocket):
+    # Arrange
+    await start_session(mock_fleet_args, "1")
+    fleet = mock_fleet_args.req.app.state.fleet
+    websocket = mock_websocket
+    websocket.app = mock_fleet_args.req.app
+    task = asyncio.create_task(subscribe_arrivals(websocket))
+    websocket.incoming.put_nowait({"2": [1], "3": [1, 2]})
+    await asyncio.sleep(0.01)
+    websocket.incoming.put_nowait(None)
+    await task
+    first = websocket.sent[0]
+    now = datetime.now(timezone.utc) - timedelta(seconds=1)
+    mock_fleet_args.req.body = mock_location_body(now, 39.7530, -105.2220)
+    await post_location(mock_fleet_args.req, "1")
+    websocket = type(mock_websocket)(app=mock_fleet_args.req.app)
+
+    # Act
+    task = asyncio.create_task(
+        subscribe_arrivals(websocket, first["sequence"], first["epoch"])
+    )
+    websocket.incoming.put_nowait({"2": [1], "3": [1, 2]})
+    await asyncio.sleep(0.01)
+    websocket.incoming.put_nowait(None)
+    await task
+
+    # Assert
+    assert first == {
+        "type": "arrivals",
+        "epoch": fleet.epoch,
+        "sequence": 1,
+        "arrivals": {},
+    }
+    (resumed,) = websocket.sent
+    assert resumed["type"] == "delta"
+    assert resumed["sequence"] == 2
+    # Keys are strings once the response is serialized to JSON.
+    assert set(resumed["arrivals"]) == {"2", "3"}
+    assert set(resumed["arrivals"]["3"]) == {"1"}
+    assert resumed["arrivals"]["2"]["1"] > 0
+
+
+@pytest.mark.asyncio
+async def test_subscriptions_never_use_database(mock_fleet_args, mock_websocket):
+    # Arrange
+    await start_session(mock_fleet_args)
+    mock_fleet_args.req.app.state.db.session.side_effect = AssertionError(
+        "Subscriptions must be served from the fleet state"
+    )
+    websocket = mock_websocket
+    websocket.app = mock_fleet_args.req.app
+    arrivals_websocket = type(mock_websocket)(app=mock_fleet_args.req.app)
+    tasks = [
+        asyncio.create_task(subscribe_vans(websocket)),
+        asyncio.create_task(subscribe_arrivals(arrivals_websocket)),
+    ]
+
+    # Act
+    websocket.incoming.put_nowait(
+        {"include": ["location"], "query": {"type": "vans"}, "subscribe": True}
+    )
+    arrivals_websocket.incoming.put_nowait({"2": [1]})
+    await asyncio.sleep(0.01)
+    mock_fleet_args.req.app.state.fleet.kill_all()
+    await asyncio.sleep(0.01)
+    websocket.incoming.put_nowait(None)
+    arrivals_websocket.incoming.put_nowait(None)
+    await asyncio.gather(*tasks)
+
+    # Assert
+    assert len(websocket.sent) == 2
+    assert len(arrivals_websocket.sent) == 1
+
+
+@pytest.mark.asyncio
+async def test_encode_locations_v1(mock_fleet_args):
+    # Arrange
+    await start_session(mock_fleet_args)
+    now = datetime.now(timezone.utc) - timedelta(seconds=1)
+    mock_fleet_args.req.body = mock_location_body(now, 39.7530, -105.2220)
+    await post_location(mock_fleet_args.req, "1")
+    locations = query_locations_v1(
+        mock_fleet_args.req.app.state.fleet, datetime.now(timezone.utc)
+    )
+
+    # Act
+    frame = encode_locations_v1(locations)
+
+    # Assert
+    assert FRAME_HEADER.unpack_from(frame) == (FRAME_LOCATIONS_V1, 1)
+    guid, timestamp, lat, lon, stop_id, seconds = LOCATION_RECORD_V1.unpack_from(
+        frame, FRAME_HEADER.size
+    )
+    assert (guid, timestamp, stop_id) == (1, int(now.timestamp()), 2)
+    assert (lat, lon) == (39753000, -105222000)
+    assert seconds == round(locations["1"]["secondsToNextStop"])
+    assert len(frame) < len(json.dumps(locations)) / 4
+
+
+def test_encode_locations_v1_wide_guid():
+    # Arrange
+    locations = {
+        "70000": {
+            "timestamp": 1700000000,
+            "latitude": 39.7530,
+            "longitude": -105.2220,
+            "nextStopId": 2,
+            "secondsToNextStop": 30.0,
+        }
+    }
+
+    # Act
+    frame = encode_locations_v1(locations)
+
+    # Assert
+    guid, *_ = LOCATION_RECORD_V1.unpack_from(frame, FRAME_HEADER.size)
+    assert guid == 70000
+
+
+def test_encode_locations_v1_skips_vans_that_do_not_fit():
+    # Arrange
+    location = {
+        "timestamp": 1700000000,
+        "latitude": 39.7530,
+        "longitude": -105.2220,
+        "nextStopId": 2,
+        "secondsToNextStop": 30.0,
+    }
+    locations = {
+        str(2**32): location,
+        "2": {**location, "nextStopId": 70000},
+        "3": location,
+    }
+
+    # Act
+    frame = encode_locations_v1(locations)
+
+    # Assert
+    assert FRAME_HEADER.unpack_from(frame) == (FRAME_LOCATIONS_V1, 1)
+    assert len(frame) == FRAME_HEADER.size + LOCATION_RECORD_V1.size
+    guid, *_ = LOCATION_RECORD_V1.unpack_from(frame, FRAME_HEADER.size)
+    assert guid == 3
+
+
+def test_encode_van_subscription_skips_vans_that_do_not_fit():
+    # Arrange
+    van = {"guid": "1", "alive": True, "started": 1700000000, "updated": 1700000000}
+    resp = {
+        "type": "delta",
+        "epoch": 1,
+        "sequence": 2,
+        "vans": [
+            {**van, "guid": str(2**32)},
+            {**van, "color": "#FF00000"},
+            {**van, "guid": "2", "color": None},
+        ],
+        "removed": ["3", "-1"],
+    }
+
+    # Act
+    frame = encode_van_subscription(resp)
+
+    # Assert
+    assert DELTA_HEADER.unpack_from(frame) == (FRAME_DELTA, 1, 2, 2, 1)
+    offset = DELTA_HEADER.size
+    records = [
+        VAN_RECORD.unpack_from(frame, offset + i * VAN_RECORD.size) for i in range(2)
+    ]
+    assert [(guid, flags) for guid, flags, *_ in records] == [
+        (1, VAN_FLAG_ALIVE),
+        (2, VAN_FLAG_ALIVE),
+    ]
+    assert REMOVED_RECORD.unpack_from(frame, offset + 2 * VAN_RECORD.size) == (3,)
+    assert len(frame) == offset + 2 * VAN_RECORD.size + REMOVED_RECORD.size
+
+
+@pytest.mark.asyncio
+async def test_subscribe_vans_ignores_other_routes(mock_fleet_args, mock_websocket):
+    # Arrange
+    await start_session(mock_fleet_args)
+    websocket = mock_websocket
+    websocket.app = mock_fleet_args.req.app
+    task = asyncio.create_task(subscribe_vans(websocket))
+    websocket.incoming.put_nowait(
+        {
+            "include": ["location"],
+            "query": {"type": "vans", "routeIds": [2]},
+            "subscribe": True,
+        }
+    )
+    await asyncio.sleep(0.01)
+
+    # Act
+    now = datetime.now(timezone.utc) - timedelta(seconds=1)
+    mock_fleet_args.req.body = mock_location_body(now, 39.7530, -105.2220)
+    await post_location(mock_fleet_args.req, "1")
+    await asyncio.sleep(0.01)
+
+    # Assert
+    assert websocket.sent == [{"type": "vans", "vans": []}]
+
+    websocket.incoming.put_nowait(None)
+    await task
+
+
+@pytest.mark.asyncio
+async def test_subscribe_vans_shares_identical_queries(mock_fleet_args, mock_websocket):
+    # Arrange
+    await start_session(mock_fleet_args)
+    app = mock_fleet_args.req.app
+    websockets = [type(mock_websocket)(app=app) for _ in range(3)]
+    tasks = [asyncio.create_task(subscribe_vans(websocket)) for websocket in websockets]
+    queries = [
+        {"type": "vans", "routeIds": [1]},
+        {"type": "vans", "routeIds": [1, 1]},
+        {"type": "vans"},
+    ]
+    for websocket, query in zip(websockets, queries):
+        websocket.incoming.put_nowait(
+            {"include": ["location"], "query": query, "subscribe": True}
+        )
+    await asyncio.sleep(0.01)
+
+    # Act
+    stats = await get_subscription_stats(mock_fleet_args.req)
+    now = datetime.now(timezone.utc) - timedelta(seconds=1)
+    mock_fleet_args.req.body = mock_location_body(now, 39.7530, -105.2220)
+    await post_location(mock_fleet_args.req, "1")
+    await asyncio.sleep(0.01)
+
+    # Assert
+    assert stats["vans"] == {"subscriptions": 2, "clients": 3, "largest": 2}
+    assert websockets[0].sent == websockets[1].sent
+    assert len(websockets[0].sent) == 2
+    assert websockets[2].sent[1] == websockets[0].sent[1]
+
+    for websocket in websockets:
+        websocket.incoming.put_nowait(None)
+    await asyncio.gather(*tasks)
+    assert len(app.state.van_subscriptions) == 0
+
+
+@pytest.mark.asyncio
+async def test_subscribe_vans_late_joiner_gets_shared_snapshot(
+    mock_fleet_args, mock_websocket
+):
+    # Arrange
+    await start_session(mock_fleet_args)
+    app = mock_fleet_args.req.app
+    first, second = [type(mock_websocket)(app=app) for _ in range(2)]
+    msg = {
+        "include": ["location"],
+        "query": {"type": "vans"},
+        "subscribe": True,
+        "deltas": True,
+    }
+    tasks = [asyncio.create_task(subscribe_vans(first))]
+    first.incoming.put_nowait(msg)
+    await asyncio.sleep(0.01)
+    now = datetime.now(timezone.utc) - timedelta(seconds=1)
+    mock_fleet_args.req.body = mock_location_body(now, 39.7530, -105.2220)
+    await post_location(mock_fleet_args.req, "1")
+    await asyncio.sleep(0.01)
+
+    # Act
+    tasks.append(asyncio.create_task(subscribe_vans(second)))
+    second.incoming.put_nowait(msg)
+    await asyncio.sleep(0.01)
+    await start_session(mock_fleet_args, van_guid="2")
+    await asyncio.sleep(0.01)
+
+    # Assert
+    snapshot, delta = second.sent
+    assert snapshot["type"] == "snapshot"
+    assert snapshot["sequence"] == first.sent[1]["sequence"]
+    assert snapshot["vans"] == first.sent[1]["vans"]
+    assert delta == first.sent[2]
+    assert [van["guid"] for van in delta["vans"]] == ["2"]
+    assert len(app.state.van_subscriptions) == 1
+
+    for websocket in (first, second):
+        websocket.incoming.put_nowait(None)
+    await asyncio.gather(*tasks)
+
+
+@pytest.mark.asyncio
+async def test_subscribe_arrivals_shares_identical_filters(
+    mock_fleet_args, mock_websocket
+):
+    # Arrange
+    await start_session(mock_fleet_args)
+    app = mock_fleet_args.req.app
+    websockets = [type(mock_websocket)(app=app) for _ in range(2)]
+    tasks = [
+        asyncio.create_task(subscribe_arrivals(websocket)) for websocket in websockets
+    ]
+    app.state.arrivals.seconds_to = MagicMock(wraps=app.state.arrivals.seconds_to)
+
+    # Act
+    websockets[0].incoming.put_nowait({"2": [1], "3": [1]})
+    websockets[1].incoming.put_nowait({"3": [1], "2": [1, 1]})
+    await asyncio.sleep(0.01)
+    stats = await get_subscription_stats(mock_fleet_args.req)
+
+    # Assert
+    assert app.state.arrivals.seconds_to.call_count == 2
+    assert websockets[0].sent == websockets[1].sent
+    assert stats["arrivals"] == {"subscriptions": 1, "clients": 2, "largest": 2}
+
+    for websocket in websockets:
+        websocket.incoming.put_nowait(None)
+    await asyncio.gather(*tasks)
+    assert len(app.state.arrival_subscriptions) == 0
+
+
+@pytest.mark.asyncio
+async def test_subscribe_arrivals_standing(
+    mock_fleet_args, mock_websocket, monkeypatch
+):
+    # Arrange
+    monkeypatch.setattr("src.handlers.vans.ARRIVALS_PUSH_INTERVAL", 0.05)
+    await start_session(mock_fleet_args)
+    websocket = mock_websocket
+    websocket.app = mock_fleet_args.req.app
+    task = asyncio.create_task(subscribe_arrivals(websocket, subscribe=True))
+    websocket.incoming.put_nowait({"2": [1], "3": [1, 2]})
+    await wait_for_sent(websocket, 1)
+
+    # Act
+    now = datetime.now(timezone.utc) - timedelta(seconds=1)
+    mock_fleet_args.req.body = mock_location_body(now, 39.7530, -105.2220)
+    await post_location(mock_fleet_args.req, "1")
+    await wait_for_sent(websocket, 2)
+    mock_fleet_args.req.body = mock_location_body(now, 39.7531, -105.2220)
+    await post_location(mock_fleet_args.req, "1")
+    await asyncio.sleep(0.01)
+    capped = len(websocket.sent)
+    await wait_for_sent(websocket, 3)
+
+    # Assert
+    first, moved, moved_again = websocket.sent
+    assert first["type"] == "arrivals"
+    assert first["arrivals"] == {}
+    assert moved["type"] == "delta"
+    assert set(moved["arrivals"]) == {"2", "3"}
+    assert set(moved["arrivals"]["3"]) == {"1"}
+    assert moved_again["sequence"] > moved["sequence"]
+    assert moved_again["arrivals"]["2"]["1"] != moved["arrivals"]["2"]["1"]
+    assert capped == 2
+
+    websocket.incoming.put_nowait(None)
+    await task
+    assert len(mock_fleet_args.req.app.state.arrival_subscriptions) == 0
+
+
+def parse_event(event: str) -> dict:
+    assert event.startswith("data: ") and event.endswith("\n\n")
+    return json.loads(event[len("data: ") :])
+
+
+@pytest.mark.asyncio
+async def test_stream_vans_shares_websocket_frames(mock_fleet_args, mock_websocket):
+    # Arrange
+    await start_session(mock_fleet_args)
+    app = mock_fleet_args.req.app
+    websocket = mock_websocket
+    websocket.app = app
+    task = asyncio.create_task(subscribe_vans(websocket))
+    websocket.incoming.put_nowait(
+        {
+            "include": ["location"],
+            "query": {"type": "vans"},
+            "subscribe": True,
+            "deltas": True,
+        }
+    )
+    await wait_for_sent(websocket, 1)
+
+    # Act
+    response = await stream_vans(
+        mock_fleet_args.req,
+        guid=None,
+        alive=None,
+        route_ids=None,
+        include=["location"],
+        deltas=True,
+        since=None,
+        epoch=None,
+    )
+    events = response.body_iterator
+    snapshot = parse_event(await anext(events))
+    now = datetime.now(timezone.utc) - timedelta(seconds=1)
+    mock_fleet_args.req.body = mock_location_body(now, 39.7530, -105.2220)
+    await post_location(mock_fleet_args.req, "1")
+    delta = parse_event(await anext(events))
+    await wait_for_sent(websocket, 2)
+    stats = await get_subscription_stats(mock_fleet_args.req)
+    await events.aclose()
+
+    # Assert
+    assert response.media_type == "text/event-stream"
+    assert snapshot == websocket.sent[0]
+    assert delta == websocket.sent[1]
+    assert [van["guid"] for van in delta["vans"]] == ["1"]
+    assert stats["vans"] == {"subscriptions": 1, "clients": 2, "largest": 2}
+    assert app.state.van_subscriptions.clients() == 1
+
+    websocket.incoming.put_nowait(None)
+    await task
+
+
+@pytest.mark.asyncio
+async def test_poll_vans(mock_fleet_args, monkeypatch):
+    # Arrange
+    monkeypatch.setattr("src.handlers.vans.POLL_TIMEOUT", 0.05)
+    await start_session(mock_fleet_args)
+    query = {
+        "guid": None,
+        "alive": None,
+        "route_ids": None,
+        "include": ["location"],
+    }
+    first = await poll_vans(mock_fleet_args.req, since=None, epoch=None, **query)
+    snapshot = json.loads(first.body)
+
+    # Act
+    waiting = asyncio.create_task(
+        poll_vans(
+            mock_fleet_args.req,
+            since=snapshot["sequence"],
+            epoch=snapshot["epoch"],
+            **query,
+        )
+    )
+    await asyncio.sleep(0.01)
+    now = datetime.now(timezone.utc) - timedelta(seconds=1)
+    mock_fleet_args.req.body = mock_location_body(now, 39.7530, -105.2220)
+    await post_location(mock_fleet_args.req, "1")
+    delta = json.loads((await waiting).body)
+    timed_out = await poll_vans(
+        mock_fleet_args.req, since=delta["sequence"], epoch=delta["epoch"], **query
+    )
+
+    # Assert
+    assert snapshot["type"] == "snapshot"
+    assert [van["guid"] for van in snapshot["vans"]] == ["1"]
+    assert delta["type"] == "delta"
+    assert delta["vans"][0]["location"] == {"latitude": 39.7530, "longitude": -105.2220}
+    assert timed_out.status_code == 204
+    assert len(mock_fleet_args.req.app.state.van_subscriptions) == 0
+
+
+@pytest.mark.asyncio
+async def test_polls_wait_through_other_routes(mock_fleet_args, monkeypatch):
+    # Arrange
+    monkeypatch.setattr("src.handlers.vans.POLL_TIMEOUT", 0.05)
+    mock_fleet_args.session.add(Route(id=2, name="Route 2", color="#00FF00"))
+    mock_fleet_args.session.commit()
+    fleet = mock_fleet_args.req.app.state.fleet
+    fleet.refresh_routes(mock_fleet_args.session)
+    await start_session(mock_fleet_args, "1")
+    query = {"guid": None, "alive": None, "route_ids": [1], "include": []}
+    snapshot = json.loads(
+        (await poll_vans(mock_fleet_args.req, since=None, epoch=None, **query)).body
+    )
+
+    # Act
+    await start_session(mock_fleet_args, "2", route_id=2)
+    vans = await poll_vans(
+        mock_fleet_args.req,
+        since=snapshot["sequence"],
+        epoch=snapshot["epoch"],
+        **query,
+    )
+    arrivals = await poll_arrivals(
+        mock_fleet_args.req,
+        stops=["2:1"],
+        since=snapshot["sequence"],
+        epoch=snapshot["epoch"],
+    )
+
+    # Assert
+    assert fleet.sequence > snapshot["sequence"]
+    assert vans.status_code == 204
+    assert arrivals.status_code == 204
+
+
+@pytest.mark.asyncio
+async def test_stream_and_poll_arrivals(mock_fleet_args, monkeypatch):
+    # Arrange
+    monkeypatch.setattr("src.handlers.vans.ARRIVALS_PUSH_INTERVAL", 0)
+    await start_session(mock_fleet_args)
+    now = datetime.now(timezone.utc) - timedelta(seconds=1)
+    mock_fleet_args.req.body = mock_location_body(now, 39.7510, -105.2220)
+    await post_location(mock_fleet_args.req, "1")
+    response = await stream_arrivals(
+        mock_fleet_args.req, stops=["2:1", "3:1"], since=None, epoch=None
+    )
+    events = response.body_iterator
+    snapshot = parse_event(await anext(events))
+
+    # Act
+    polled = await poll_arrivals(
+        mock_fleet_args.req, stops=["3:1", "2:1"], since=None, epoch=None
+    )
+    waiting = asyncio.create_task(
+        poll_arrivals(
+            mock_fleet_args.req,
+            stops=["2:1,1", "3:1"],
+            since=snapshot["sequence"],
+            epoch=snapshot["epoch"],
+        )
+    )
+    await asyncio.sleep(0.01)
+    mock_fleet_args.req.body = mock_location_body(now, 39.7530, -105.2220)
+    await post_location(mock_fleet_args.req, "1")
+    delta = parse_event(await anext(events))
+    await events.aclose()
+
+    # Assert
+    assert snapshot["type"] == "arrivals"
+    assert set(snapshot["arrivals"]) == {"2", "3"}
+    assert json.loads(polled.body) == snapshot
+    assert delta["type"] == "delta"
+    assert json.loads((await waiting).body) == delta
+    assert len(mock_fleet_args.req.app.state.arrival_subscriptions) == 0